@@ -1,4 +1,6 @@
 #include <cmath>
+#include <algorithm>
+#include <vector>
 #ifndef TOP_HAT_KERNEL
 
 /*Compute the SPH weighting for this cell, using the trapezium rule.
@@ -54,3 +56,444 @@ double compute_sph_cell_weight(double rr, double r0)
 }
 
 #endif
+
+/* Table of the cumulative projected kernel of a particle at the origin with unit smoothing length:
+ * kernel_table[i][j] is the integral of compute_sph_cell_weight over [-1, u_i] x [-1, u_j],
+ * where u_i = -1 + 2i/(KERNEL_TABLE_SIZE-1), normalised so that the whole kernel integrates to 1.
+ * The integral of the kernel over any rectangle is then found from the values at its four corners.
+ * For the top-hat kernel, the entries are exact values of its closed form. */
+#define KERNEL_TABLE_SIZE 513
+static double kernel_table[KERNEL_TABLE_SIZE][KERNEL_TABLE_SIZE];
+
+#ifndef TOP_HAT_KERNEL
+
+void init_kernel_table()
+{
+    const int nn = KERNEL_TABLE_SIZE-1;
+    const double du = 2./nn;
+    //Each table interval is integrated with an nsub x nsub midpoint rule
+    const int nsub = 4;
+    for(int i=0; i <= nn; i++){
+        kernel_table[i][0] = 0;
+        kernel_table[0][i] = 0;
+    }
+    for(int i=1; i <= nn; i++){
+        //Integral over the strip [u_{i-1}, u_i] x [-1, u_j], built up along j
+        double strip = 0;
+        for(int j=1; j <= nn; j++){
+            double cell = 0;
+            for(int ix=0; ix < nsub; ix++)
+                for(int iy=0; iy < nsub; iy++){
+                    const double xx = -1+du*(i-1+(ix+0.5)/nsub);
+                    const double yy = -1+du*(j-1+(iy+0.5)/nsub);
+                    cell += compute_sph_cell_weight(1, sqrt(xx*xx+yy*yy));
+                }
+            strip += cell*du*du/nsub/nsub;
+            kernel_table[i][j] = kernel_table[i-1][j] + strip;
+        }
+    }
+    const double total = kernel_table[nn][nn];
+    for(int i=0; i <= nn; i++)
+        for(int j=0; j <= nn; j++)
+            kernel_table[i][j] /= total;
+}
+
+#else
+
+/*Arctangent of x >= 0, to double precision. This is the rational approximation used by Cephes,
+ *inlined because the library call is most of the cost of a deposit with large smoothing lengths.*/
+static inline double atan_pos(double x)
+{
+    double y = 0;
+    double morebits = 0;
+    if(x > 2.41421356237309504880){
+        //tan(3 pi/8)
+        y = M_PI/2;
+        morebits = 6.123233995736765886130E-17;
+        x = -1/x;
+    }
+    else if(x > 0.66){
+        y = M_PI/4;
+        morebits = 0.5*6.123233995736765886130E-17;
+        x = (x-1)/(x+1);
+    }
+    const double z = x*x;
+    const double p = (((-8.750608600031904122785E-1*z - 1.615753718733365076637E1)*z - 7.500855792314704667340E1)*z - 1.228866684490136173410E2)*z - 6.485021904942025371773E1;
+    const double q = ((((z + 2.485846490142306297962E1)*z + 1.650270098316988542046E2)*z + 4.328810604912902668951E2)*z + 4.853903996359136964868E2)*z + 1.945506571482613964425E2;
+    return y + (x*z*p/q + x + morebits);
+}
+
+/*Integral of sqrt(1-x^2-y^2) over the part of [0,a] x [0,b] inside the unit circle, for 0 <= a, b <= 1*/
+static inline double tophat_quadrant(const double a, const double b)
+{
+    if(a*a+b*b < 1){
+        const double s = sqrt(1-a*a-b*b);
+        return a*b*s/3 + a*(3-a*a)/6*atan_pos(b/s) + b*(3-b*b)/6*atan_pos(a/s) - atan_pos(a*b/s)/3;
+    }
+    //The rectangle pokes out of the circle: split it at xs, where its top edge meets the circle.
+    //Left of xs the formula above has s = 0, so all the angles are pi/2. Right of xs the columns are whole quarter-circles.
+    const double xs = sqrt(1-b*b);
+    const double inside = M_PI/2*(xs*(3-xs*xs)/6 + b*(3-b*b)/6 - 1./3);
+    return inside + M_PI/4*((a-a*a*a/3)-(xs-xs*xs*xs/3));
+}
+
+/*As tophat_quadrant, but for any u and v, over [0,u] x [0,v]: odd in each argument*/
+static inline double tophat_signed(double u, double v)
+{
+    u = std::min(std::max(u,-1.),1.);
+    v = std::min(std::max(v,-1.),1.);
+    const double quad = tophat_quadrant(fabs(u), fabs(v));
+    return ((u < 0) != (v < 0)) ? -quad : quad;
+}
+
+/*Cumulative projected top-hat kernel over [-1,u] x [-1,v], in units of the smoothing length.
+ *This is the quadrant [-1,0] x [-1,0], two half-strips and [0,u] x [0,v].
+ *The kernel is normalised by the integral over a quadrant, pi/6.*/
+static inline double tophat_cumulative(const double u, const double v)
+{
+    return 0.25 + 3/(2*M_PI)*(tophat_signed(u, 1) + tophat_signed(1, v) + tophat_signed(u, v));
+}
+
+void init_kernel_table()
+{
+    const int nn = KERNEL_TABLE_SIZE-1;
+    for(int i=0; i <= nn; i++)
+        for(int j=0; j <= nn; j++)
+            kernel_table[i][j] = tophat_cumulative(-1+2.*i/nn, -1+2.*j/nn);
+}
+
+#endif
+
+/*Position of u (in units of the smoothing length) in the table: the interval i and the fraction f along it*/
+static inline void kernel_table_index(const double u, int& i, double& f)
+{
+    const int nn = KERNEL_TABLE_SIZE-1;
+    const double tu = (std::min(std::max(u,-1.),1.)+1)*nn/2.;
+    i = std::min((int) tu, nn-1);
+    f = tu - i;
+}
+
+/*compute_sph_corners by bilinear interpolation in the table*/
+static void table_corners(const double rr, const double x0, const int ncx, const double y0, const int ncy, double * corner)
+{
+    //Bilinear interpolation: the table positions of each row and column are found once
+    int ii[ncx], jj[ncy];
+    double fi[ncx], fj[ncy];
+    for(int cx=0; cx < ncx; cx++)
+        kernel_table_index((x0+cx)/rr, ii[cx], fi[cx]);
+    for(int cy=0; cy < ncy; cy++)
+        kernel_table_index((y0+cy)/rr, jj[cy], fj[cy]);
+    for(int cy=0; cy < ncy; cy++){
+        const int j = jj[cy];
+        const double fv = fj[cy];
+        for(int cx=0; cx < ncx; cx++){
+            const int i = ii[cx];
+            const double fu = fi[cx];
+            corner[cy*ncx+cx] = (1-fu)*((1-fv)*kernel_table[i][j]+fv*kernel_table[i][j+1]) + fu*((1-fv)*kernel_table[i+1][j]+fv*kernel_table[i+1][j+1]);
+        }
+    }
+}
+
+#ifndef TOP_HAT_KERNEL
+
+void compute_sph_corners(const double rr, const double x0, const int ncx, const double y0, const int ncy, double * corner)
+{
+    table_corners(rr, x0, ncx, y0, ncy, corner);
+}
+
+#else
+
+/*Kernels at least this many cells wide use the table: the closed form costs three arctangents a corner,
+ *while the error of the table is a small fraction of a cell once the kernel covers many cells.*/
+#define TOPHAT_EXACT_MAX 4
+
+void compute_sph_corners(const double rr, const double x0, const int ncx, const double y0, const int ncy, double * corner)
+{
+    if(rr >= TOPHAT_EXACT_MAX){
+        table_corners(rr, x0, ncx, y0, ncy, corner);
+        return;
+    }
+    /* As tophat_cumulative. The strips are the same for every corner in a row or column, so are found once. */
+    const double norm = 3/(2*M_PI);
+    double ex[ncx], ey[ncy];
+    for(int cx=0; cx < ncx; cx++)
+        ex[cx] = tophat_signed((x0+cx)/rr, 1);
+    for(int cy=0; cy < ncy; cy++)
+        ey[cy] = tophat_signed(1, (y0+cy)/rr);
+    for(int cy=0; cy < ncy; cy++)
+        for(int cx=0; cx < ncx; cx++)
+            corner[cy*ncx+cx] = 0.25 + norm*(ex[cx] + ey[cy] + tophat_signed((x0+cx)/rr, (y0+cy)/rr));
+}
+
+#endif
+
+/*Fraction of [-rr,rr] below x*/
+static inline double box_fraction(const double rr, const double x)
+{
+    return std::min(std::max((x+rr)/(2*rr), 0.), 1.);
+}
+
+void compute_box_corners(const double rr, const double x0, const int ncx, const double y0, const int ncy, double * corner)
+{
+    double fx[ncx];
+    for(int cx=0; cx < ncx; cx++)
+        fx[cx] = box_fraction(rr, x0+cx);
+    for(int cy=0; cy < ncy; cy++){
+        const double fy = box_fraction(rr, y0+cy);
+        for(int cx=0; cx < ncx; cx++)
+            corner[cy*ncx+cx] = fx[cx]*fy;
+    }
+}
+
+#ifdef TOP_HAT_KERNEL
+double kernel_3d(const double r)
+{
+    return r < 1 ? 1 : 0;
+}
+#else
+double kernel_3d(const double r)
+{
+    if(r < 0.5)
+        return 1-6*r*r+6*r*r*r;
+    if(r < 1)
+        return 2*(1-r)*(1-r)*(1-r);
+    return 0;
+}
+#endif
+
+/* Table of the cumulative 3D kernel of a particle at the origin with unit smoothing length:
+ * kernel_table_3d[i][j][k] is the integral of kernel_3d over [-1, u_i] x [-1, u_j] x [-1, u_k],
+ * where u_i = -1 + 2i/(KERNEL_TABLE_3D_SIZE-1), normalised so that the whole kernel integrates to 1.
+ * The integral of the kernel over any box is then found from the values at its eight corners.
+ * For the top-hat kernel, the entries are exact values of its closed form. */
+#define KERNEL_TABLE_3D_SIZE 65
+static double kernel_table_3d[KERNEL_TABLE_3D_SIZE][KERNEL_TABLE_3D_SIZE][KERNEL_TABLE_3D_SIZE];
+static bool kernel_table_3d_built = false;
+
+#ifndef TOP_HAT_KERNEL
+
+void init_kernel_table_3d()
+{
+    if(kernel_table_3d_built)
+        return;
+    const int nn = KERNEL_TABLE_3D_SIZE-1;
+    const double du = 2./nn;
+    //Each table interval is integrated with an nsub^3 midpoint rule
+    const int nsub = 4;
+    for(int i=0; i <= nn; i++)
+        for(int j=0; j <= nn; j++)
+            for(int k=0; k <= nn; k++)
+                kernel_table_3d[i][j][k] = 0;
+    for(int i=1; i <= nn; i++)
+        for(int j=1; j <= nn; j++)
+            for(int k=1; k <= nn; k++){
+                double cell = 0;
+                for(int ix=0; ix < nsub; ix++)
+                    for(int iy=0; iy < nsub; iy++)
+                        for(int iz=0; iz < nsub; iz++){
+                            const double xx = -1+du*(i-1+(ix+0.5)/nsub);
+                            const double yy = -1+du*(j-1+(iy+0.5)/nsub);
+                            const double zz = -1+du*(k-1+(iz+0.5)/nsub);
+                            cell += kernel_3d(sqrt(xx*xx+yy*yy+zz*zz));
+                        }
+                kernel_table_3d[i][j][k] = cell;
+            }
+    //Sum up along each axis in turn
+    for(int i=1; i <= nn; i++)
+        for(int j=0; j <= nn; j++)
+            for(int k=0; k <= nn; k++)
+                kernel_table_3d[i][j][k] += kernel_table_3d[i-1][j][k];
+    for(int i=0; i <= nn; i++)
+        for(int j=1; j <= nn; j++)
+            for(int k=0; k <= nn; k++)
+                kernel_table_3d[i][j][k] += kernel_table_3d[i][j-1][k];
+    for(int i=0; i <= nn; i++)
+        for(int j=0; j <= nn; j++)
+            for(int k=1; k <= nn; k++)
+                kernel_table_3d[i][j][k] += kernel_table_3d[i][j][k-1];
+    const double total = kernel_table_3d[nn][nn][nn];
+    for(int i=0; i <= nn; i++)
+        for(int j=0; j <= nn; j++)
+            for(int k=0; k <= nn; k++)
+                kernel_table_3d[i][j][k] /= total;
+    kernel_table_3d_built = true;
+}
+
+#else
+
+/* For the top-hat kernel the cumulative 3D kernel is the volume of the unit ball below a corner, which has a closed form.
+ * The ball in [0,a] x [0,b] x [0,c] is built up in slices along x: the slice at x is the disc of radius s = sqrt(1-x^2)
+ * in [0,b] x [0,c]. Where the disc covers the corner (b,c), its area is bc. Otherwise it is
+ * strip(x,b) + strip(x,c) - pi s^2/4, where strip(x,b) is the area of the quarter disc below b.
+ * All angles are found from the half-chord with atan_ratio, as asin loses precision where the disc is tangent to a side. */
+
+/*atan2(y, x) for y, x >= 0, with the inlined arctangent*/
+static inline double atan_ratio(const double y, const double x)
+{
+    if(y > x)
+        return M_PI/2 - atan_pos(x/y);
+    return x > 0 ? atan_pos(y/x) : 0;
+}
+
+/*Volume of the unit ball in [0,x] x [0,1] x [0,1]: quarter discs of area pi (1-x^2)/4, over [0,x]*/
+static inline double ball_slab(const double x)
+{
+    return M_PI/4*(x-x*x*x/3);
+}
+
+/*Integral over [0,x] of strip(x,b), the area of the part of the quarter disc of radius sqrt(1-x^2) below b, for 0 <= x, b <= 1.
+ *This is the volume of the unit ball in [0,x] x [0,b] x [0,1].*/
+static double ball_strip(const double x, const double b)
+{
+    if(b >= 1)
+        return ball_slab(x);
+    //Beyond xb the disc is below b, and strip is the whole quarter disc
+    const double k2 = 1-b*b;
+    const double xb = sqrt(k2);
+    const double xx = std::min(x, xb);
+    const double q = sqrt(std::max(k2-xx*xx, 0.));
+    const double alpha = atan_ratio(xx, q), beta = atan_ratio(b, q), gamma = atan_ratio(xx*b, q);
+    const double chord = (xx*q + k2*alpha)/2;
+    const double arc = (xx-xx*xx*xx/3)*beta - b*((k2*alpha - xx*q)/6 - 2*alpha/3) - 2*gamma/3;
+    double vol = (b*chord + arc)/2;
+    if(x > xb)
+        vol += ball_slab(x) - ball_slab(xb);
+    return vol;
+}
+
+/*Odd extension of u -> |u| clamped to [0,1]: its sign and magnitude*/
+static inline void ball_coord(const double u, double& a, double& sign)
+{
+    a = std::min(fabs(u), 1.);
+    sign = u < 0 ? -1 : 1;
+}
+
+/*compute_sph_corners_3d from the closed form*/
+static void tophat_corners_3d(const double rr, const double x0, const int ncx, const double y0, const int ncy, const double z0, const int ncz, double * corner)
+{
+    /* The fraction of the ball below (u,v,w) is the sum of its volume in the eight boxes between the origin and
+     * either the corner or the far side of the ball along each axis, as in the 2D closed form.
+     * By symmetry, the volume in [0,a] x [0,b] x [0,1] is ball_strip(a,b) along any pair of axes.
+     * Everything but the volume in [0,u] x [0,v] x [0,w] depends on at most two of the coordinates, so is found once. */
+    //One buffer for the magnitudes and signs of the coordinates, and the arrays over pairs of axes below
+    std::vector<double> work(2*((size_t) ncx+ncy+ncz) + (size_t) ncx*(ncy+ncz) + 3*(size_t) ncy*ncz);
+    double * const au = &work[0], * const su = au+ncx;
+    double * const av = su+ncx, * const sv = av+ncy;
+    double * const aw = sv+ncy, * const sw = aw+ncz;
+    for(int cx=0; cx < ncx; cx++)
+        ball_coord((x0+cx)/rr, au[cx], su[cx]);
+    for(int cy=0; cy < ncy; cy++)
+        ball_coord((y0+cy)/rr, av[cy], sv[cy]);
+    for(int cz=0; cz < ncz; cz++)
+        ball_coord((z0+cz)/rr, aw[cz], sw[cz]);
+    double * const fxy = sw+ncz, * const fxz = fxy + (size_t) ncx*ncy;
+    double * const fyz = fxz + (size_t) ncx*ncz, * const edge = fyz + (size_t) ncy*ncz, * const slab = edge + (size_t) ncy*ncz;
+    for(int cx=0; cx < ncx; cx++){
+        for(int cy=0; cy < ncy; cy++)
+            fxy[(size_t) cx*ncy+cy] = ball_strip(au[cx], av[cy]);
+        for(int cz=0; cz < ncz; cz++)
+            fxz[(size_t) cx*ncz+cz] = ball_strip(au[cx], aw[cz]);
+    }
+    for(int cy=0; cy < ncy; cy++)
+        for(int cz=0; cz < ncz; cz++){
+            const size_t o = (size_t) cy*ncz+cz;
+            const double b = av[cy], c = aw[cz];
+            fyz[o] = ball_strip(b, c);
+            //Slices nearer the origin than x1 contain the corner (b,c), so are the whole rectangle
+            const double x1 = sqrt(std::max(1-b*b-c*c, 0.));
+            edge[o] = x1;
+            slab[o] = b*c*x1 - ball_strip(x1, b) - ball_strip(x1, c) + ball_slab(x1);
+        }
+    //Normalised by the volume of the ball
+    const double norm = 3/(4*M_PI);
+    for(int cx=0; cx < ncx; cx++){
+        const double a = au[cx];
+        const double sx = su[cx];
+        for(int cy=0; cy < ncy; cy++){
+            const double b = av[cy];
+            const double sxy = sx*sv[cy];
+            const double fab = fxy[(size_t) cx*ncy+cy];
+            const double part = M_PI/6 + sx*ball_slab(a) + sv[cy]*ball_slab(b) + sxy*fab;
+            for(int cz=0; cz < ncz; cz++){
+                const size_t o = (size_t) cy*ncz+cz;
+                const double c = aw[cz];
+                const double abc = a <= edge[o] ? a*b*c : slab[o] + fab + fxz[(size_t) cx*ncz+cz] - ball_slab(a);
+                corner[((size_t) cx*ncy+cy)*ncz+cz] = norm*(part + sw[cz]*(ball_slab(c) + sx*fxz[(size_t) cx*ncz+cz] + sv[cy]*fyz[o] + sxy*abc));
+            }
+        }
+    }
+}
+
+
+void init_kernel_table_3d()
+{
+    if(kernel_table_3d_built)
+        return;
+    const int nn = KERNEL_TABLE_3D_SIZE-1;
+    //Corners one table interval apart, from -1 to 1
+    tophat_corners_3d(nn/2., -nn/2., nn+1, -nn/2., nn+1, -nn/2., nn+1, &kernel_table_3d[0][0][0]);
+    kernel_table_3d_built = true;
+}
+
+#endif
+
+/*Position of u (in units of the smoothing length) in the 3D table: the interval i and the fraction f along it*/
+static inline void kernel_table_3d_index(const double u, int& i, double& f)
+{
+    const int nn = KERNEL_TABLE_3D_SIZE-1;
+    const double tu = (std::min(std::max(u,-1.),1.)+1)*nn/2.;
+    i = std::min((int) tu, nn-1);
+    f = tu - i;
+}
+
+/*compute_sph_corners_3d by trilinear interpolation in the table*/
+static void table_corners_3d(const double rr, const double x0, const int ncx, const double y0, const int ncy, const double z0, const int ncz, double * corner)
+{
+    //Trilinear interpolation: the table positions along each axis are found once
+    int ii[ncx], jj[ncy], kk[ncz];
+    double fi[ncx], fj[ncy], fk[ncz];
+    for(int cx=0; cx < ncx; cx++)
+        kernel_table_3d_index((x0+cx)/rr, ii[cx], fi[cx]);
+    for(int cy=0; cy < ncy; cy++)
+        kernel_table_3d_index((y0+cy)/rr, jj[cy], fj[cy]);
+    for(int cz=0; cz < ncz; cz++)
+        kernel_table_3d_index((z0+cz)/rr, kk[cz], fk[cz]);
+    for(int cx=0; cx < ncx; cx++){
+        const int i = ii[cx];
+        const double fu = fi[cx];
+        for(int cy=0; cy < ncy; cy++){
+            const int j = jj[cy];
+            const double fv = fj[cy];
+            for(int cz=0; cz < ncz; cz++){
+                const int k = kk[cz];
+                const double fw = fk[cz];
+                const double lo = (1-fv)*((1-fw)*kernel_table_3d[i][j][k]+fw*kernel_table_3d[i][j][k+1]) + fv*((1-fw)*kernel_table_3d[i][j+1][k]+fw*kernel_table_3d[i][j+1][k+1]);
+                const double hi = (1-fv)*((1-fw)*kernel_table_3d[i+1][j][k]+fw*kernel_table_3d[i+1][j][k+1]) + fv*((1-fw)*kernel_table_3d[i+1][j+1][k]+fw*kernel_table_3d[i+1][j+1][k+1]);
+                corner[(cx*ncy+cy)*ncz+cz] = (1-fu)*lo + fu*hi;
+            }
+        }
+    }
+}
+
+#ifndef TOP_HAT_KERNEL
+
+void compute_sph_corners_3d(const double rr, const double x0, const int ncx, const double y0, const int ncy, const double z0, const int ncz, double * corner)
+{
+    table_corners_3d(rr, x0, ncx, y0, ncy, z0, ncz, corner);
+}
+
+#else
+
+/*Kernels at least this many cells wide use the closed form. Narrower ones use the table, which is accurate while
+ *each cell covers several table intervals, and is cheaper than the several arctangents the closed form needs at each corner.*/
+#define TOPHAT_TABLE_3D_MAX 2
+
+void compute_sph_corners_3d(const double rr, const double x0, const int ncx, const double y0, const int ncy, const double z0, const int ncz, double * corner)
+{
+    if(rr < TOPHAT_TABLE_3D_MAX)
+        table_corners_3d(rr, x0, ncx, y0, ncy, z0, ncz, corner);
+    else
+        tophat_corners_3d(rr, x0, ncx, y0, ncy, z0, ncz, corner);
+}
+
+#endif
@@ -2,6 +2,7 @@
 """Derived class for computing the integrated HI across the whole box.
 """
 import numpy as np
+import os
 import os.path as path
 import fieldize
 import numexpr as ne
@@ -12,7 +13,32 @@ import hdfsim
 from brokenpowerfit import powerfit
 import h5py
 import hsml
-from _fieldize_priv import _find_halo_kernel,_Discard_SPH_Fieldize
+import chunk_reader
+import parallel_ingest
+import tiled_slab
+import checkpoint
+from _fieldize_priv import _find_halo_kernel,_Discard_SPH_Fieldize,_Make_Target_Index
+
+def _proj_suffix(proj):
+    """Suffix of the savefile groups of projection proj: none for x, then _y and _z"""
+    return ["", "_y", "_z"][proj]
+
+#Statistics cached on the object, which are different for each projection
+_PROJ_STATS = ("pDLA", "Rho_DLA", "Omega_DLA", "cddf_bins", "cddf_f_N",
+               "sigDLA", "sigLLS", "dla_halo", "lls_halo", "field_dla", "field_lls", "dla_zdir",
+               "dla_metallicity", "lls_metallicity")
+
+def _project(ipos, proj):
+    """Reorder the columns of ipos so that column 0 is the axis projected along in projection proj,
+    followed by the other two in cyclic order: the slabs are then cut along column 0, as for x."""
+    if proj == 0:
+        return ipos
+    return ipos[:,[proj, (proj+1) % 3, (proj+2) % 3]]
+
+def _unproject(cols, proj):
+    """Inverse of _project for the three coordinate arrays of some cells, in the column order of projection proj:
+    returns them in x, y, z order."""
+    return [cols[(dim - proj) % 3] for dim in xrange(3)]
 
 class BoxHI(HaloHI):
     """Class for calculating a large grid encompassing the whole simulation.
@@ -23,14 +49,48 @@ class BoxHI(HaloHI):
         snapnum - Number of simulation
         reload_file - Ignore saved files if true
         nslice - number of slices in the z direction to divide the box into.
+        nproc - Number of processes to read snapshot files with. See parallel_ingest.
+        memmap - If true, keep the grids in files on disk next to the savefile, rather than in memory.
+                 Only the slabs being worked on then need to fit in memory.
+        ntile - If > 1, deposit onto each slab out-of-core, in ntile x ntile tiles. See tiled_slab.
+                Particles are spilled to disk and deposited when the grid is next saved.
+                Use with memmap for slabs which do not fit in memory. Requires nproc=1.
+        merge - List of the start values of earlier runs over different ranges of files.
+                If given (with reload_file), the grid is made by summing their checkpoints
+                rather than by gridding the snapshot. See merge_tmp.
+        all_axes - If true, each block of particles is projected along x, y and z in the same pass,
+                   tripling the number of sightlines. Select the projection to analyse with use_projection.
+                   While gridding, sub_nHI_grid holds the slabs of every projection, x first;
+                   afterwards it holds those of the selected projection.
+        make_grid - If false (with reload_file), set up the box and its slabs but do not grid the snapshot,
+                    for subclasses which find the statistics another way, such as sightlines.SightlineHI.
+
+    If self.coarse_hsml is set, particles with smoothing lengths above that many grid cells,
+    which touch very many cells but are far too diffuse to matter for DLAs, are deposited onto
+    a grid self.coarse_factor times coarser. This is added to the full grid when the grid is next saved,
+    and the mass lost in doing so is printed. Requires nproc=1.
     """
-    def __init__(self,snap_dir,snapnum,nslice=1,reload_file=False,savefile=None,gas=False, molec=True, start=0, end=3000, ngrid=16384):
+    coarse_hsml = None
+    coarse_factor = 8
+    #Number of projections gridded, and the one selected
+    nproj = 1
+    projection = 0
+    def __init__(self,snap_dir,snapnum,nslice=1,reload_file=False,savefile=None,gas=False, molec=True, start=0, end=3000, ngrid=16384, nproc=1, memmap=False, ntile=1, merge=None, all_axes=False, make_grid=True):
         self.snapnum=snapnum
         self.snap_dir=snap_dir
         self.molec = molec
         self.set_units()
         self.start = int(start)
         self.end = int(end)
+        self.nproc = nproc
+        self.memmap = memmap
+        self.ntile = ntile
+        if all_axes:
+            self.nproj = 3
+        if ntile > 1 and nproc > 1:
+            raise ValueError("Tiled deposit is not supported with more than one process")
+        if self.coarse_hsml != None and nproc > 1:
+            raise ValueError("Coarse deposit is not supported with more than one process")
         if savefile==None:
             savefile = "boxhi_grid_H2.hdf5"
         self.savefile = path.join(snap_dir,"snapdir_"+str(snapnum).rjust(3,'0'),savefile)
@@ -50,14 +110,23 @@ class BoxHI(HaloHI):
             #self.ngrid=np.array([int(np.ceil(40*self.npart[1]**(1./3)/self.box*2*rr)) for rr in self.sub_radii])/2.
             #Grid size constant
             self.ngrid=ngrid*np.ones(self.nhalo)
-            self.sub_nHI_grid=np.zeros([self.nhalo, ngrid,ngrid], dtype=np.float32)
-            self.sub_nHI_grid += 1e-50
+            if not make_grid:
+                return
+            if merge != None:
+                self.sub_nHI_grid=self._alloc_grid("merged", np.float32)
+                self.merge_tmp(merge, gas)
+                self._split_projections()
+                return
+            self.sub_nHI_grid=self._alloc_grid("nHI", np.float32)
+            for grid in self.sub_nHI_grid:
+                grid += 1e-50
             try:
                 thisstart = self.load_tmp()
             except IOError:
                 print "Could not load file"
                 thisstart = self.start
             self.set_nHI_grid(gas, thisstart)
+            self._split_projections()
             #Account for molecular fraction
             #This is done on the HI density now
             #self.set_stellar_grid()
@@ -69,41 +138,260 @@ class BoxHI(HaloHI):
         return
 
     def save_file(self, save_grid=False, LLS_cut = 17., DLA_cut = 20.3):
-        """Save the file, by default without the grid"""
+        """Save the file, by default without the grid.
+        Every projection is saved: the x projection in the same groups as when there is only one,
+        the y and z projections in groups with the suffixes _y and _z.
+        The statistics computed for the y and z projections go in HaloData,
+        under the names used by HaloHI with the same suffixes."""
+        current = self.projection
+        self.use_projection(0)
         HaloHI.save_file(self,save_grid)
-        #Save a list of DLA positions instead
         f=h5py.File(self.savefile,'r+')
-        ind = np.where(self.sub_nHI_grid > DLA_cut)
-        ind_LLS = np.where((self.sub_nHI_grid > LLS_cut)*(self.sub_nHI_grid < DLA_cut))
-        grp = f.create_group("abslists")
-        grp.create_dataset("DLA",data=ind)
-        grp.create_dataset("DLA_val",data=self.sub_nHI_grid[ind])
-        grp.create_dataset("LLS",data=ind_LLS)
-        grp.create_dataset("LLS_val",data=self.sub_nHI_grid[ind_LLS])
+        f["HaloData"].attrs["nproj"] = self.nproj
+        for proj in xrange(self.nproj):
+            self.use_projection(proj)
+            suffix = _proj_suffix(proj)
+            if proj > 0:
+                try:
+                    grp = f["HaloData"]
+                    grp.attrs["pDLA"+suffix]=self.pDLA
+                    grp.attrs["Rho_DLA"+suffix]=self.Rho_DLA
+                    grp.attrs["Omega_DLA"+suffix]=self.Omega_DLA
+                    grp.create_dataset('cddf_bins'+suffix,data=self.cddf_bins)
+                    grp.create_dataset('cddf_f_N'+suffix,data=self.cddf_f_N)
+                except AttributeError:
+                    pass
+            if save_grid and proj > 0:
+                grp_grid = f.create_group("GridHIData"+suffix)
+                for i in xrange(0,self.nhalo):
+                    grp_grid.create_dataset(str(i),data=self.sub_nHI_grid[i])
+            #Save a list of DLA positions instead
+            ind = self._where_slabs(lambda grid: grid > DLA_cut)
+            ind_LLS = self._where_slabs(lambda grid: (grid > LLS_cut)*(grid < DLA_cut))
+            grp = f.create_group("abslists"+suffix)
+            grp.create_dataset("DLA",data=ind)
+            grp.create_dataset("DLA_val",data=self.sub_nHI_grid[ind])
+            grp.create_dataset("LLS",data=ind_LLS)
+            grp.create_dataset("LLS_val",data=self.sub_nHI_grid[ind_LLS])
+        f.close()
+        self.use_projection(current)
+
+    def load_savefile(self,savefile=None):
+        """Load data from a file, as for HaloHI, including the number of projections
+        and the statistics saved for each of them"""
+        HaloHI.load_savefile(self,savefile)
+        #HaloHI loads the statistics of the x projection
+        self._proj_stats = {0 : self._pop_proj_stats()}
+        f=h5py.File(savefile,'r')
+        grp = f["HaloData"]
+        try:
+            self.nproj = grp.attrs["nproj"]
+        except KeyError:
+            self.nproj = 1
+        for proj in xrange(1, self.nproj):
+            suffix = _proj_suffix(proj)
+            try:
+                self._proj_stats[proj] = {"pDLA" : grp.attrs["pDLA"+suffix],
+                                          "Rho_DLA" : grp.attrs["Rho_DLA"+suffix],
+                                          "Omega_DLA" : grp.attrs["Omega_DLA"+suffix],
+                                          "cddf_bins" : np.array(grp["cddf_bins"+suffix]),
+                                          "cddf_f_N" : np.array(grp["cddf_f_N"+suffix])}
+            except KeyError:
+                pass
+        f.close()
+        self._push_proj_stats(self.projection)
+
+    def use_projection(self, proj):
+        """Select the projection analysed: 0, 1 or 2 for the grid projected along x, y or z.
+        sub_nHI_grid, and the absorbers loaded from the savefile, are then those of that projection.
+        There is only the x projection unless the grid was made with all_axes.
+        The depths, cross-sections and metallicities of the absorbers, which re-read the snapshot,
+        are computed for the selected projection and saved under its suffix, as in save_file."""
+        if proj < 0 or proj >= self.nproj:
+            raise ValueError("Projection "+str(proj)+" was not gridded: there are "+str(self.nproj))
+        #Put away the statistics computed for the old projection, and bring back any for the new one
+        try:
+            self._proj_stats[self.projection] = self._pop_proj_stats()
+        except AttributeError:
+            self._proj_stats = {self.projection : self._pop_proj_stats()}
+        self._push_proj_stats(proj)
+        self.projection = proj
+        try:
+            self.sub_nHI_grid = self.all_nHI_grid[proj*self.nhalo:(proj+1)*self.nhalo]
+        except AttributeError:
+            pass
+
+    def _pop_proj_stats(self):
+        """Remove the statistics cached for the selected projection and return them, as a dict"""
+        stats = {}
+        for name in _PROJ_STATS:
+            try:
+                stats[name] = getattr(self, name)
+                delattr(self, name)
+            except AttributeError:
+                pass
+        return stats
+
+    def _push_proj_stats(self, proj):
+        """Make the statistics cached for projection proj, if any, the current ones"""
+        try:
+            stats = self._proj_stats.pop(proj, {})
+        except AttributeError:
+            return
+        for (name, value) in stats.iteritems():
+            setattr(self, name, value)
+
+    def _split_projections(self):
+        """Once the grid is made, keep the slabs of every projection in all_nHI_grid
+        and select the x projection"""
+        self.all_nHI_grid = self.sub_nHI_grid
+        self.use_projection(0)
+
+    def _alloc_grid(self, name, dtype=np.float32, nproj=None):
+        """Allocate a zeroed grid with one ngrid x ngrid slab for each slice of each of nproj projections,
+        by default all of them.
+        If self.memmap is set, this is a np.memmap backed by the file savefile.start.name.grid.
+        The file is removed at once, so its disk space is freed when the grid is, even if the run dies."""
+        if nproj == None:
+            nproj = self.nproj
+        shape = (nproj*self.nhalo, int(self.ngrid[0]), int(self.ngrid[0]))
+        if self.memmap:
+            gridfile = self.savefile+"."+str(self.start)+"."+name+".grid"
+            grid = np.memmap(gridfile, dtype=dtype, mode='w+', shape=shape)
+            os.remove(gridfile)
+            return grid
+        return np.zeros(shape, dtype=dtype)
+
+    def load_hi_grid(self):
+        """
+        Load the HI grid from the savefile, one slab at a time
+        """
+        try:
+            f=h5py.File(self.savefile,'r')
+        except IOError:
+            raise IOError("Could not open "+self.savefile)
+        self.all_nHI_grid=self._alloc_grid("nHI", np.float64)
+        for proj in xrange(self.nproj):
+            grp = f["GridHIData"+_proj_suffix(proj)]
+            [ grp[str(i)].read_direct(self.all_nHI_grid[proj*self.nhalo+i]) for i in xrange(0,self.nhalo)]
         f.close()
+        self.use_projection(self.projection)
+
+    def merge_tmp(self, starts, gas=False, fill=1e-50):
+        """Make sub_nHI_grid by summing the checkpointed grids of several earlier runs,
+        each started with a different start value and covering a different range of files.
+        Both serial checkpoints and the partial grids of parallel runs are used.
+        The file ledgers are checked to cover every snapshot file exactly once.
+        Grids are summed one tile at a time, so only the output grid (which may be memmapped)
+        and one tile from each run are in memory. The units are then fixed as in set_nHI_grid.
+        Arguments:
+            starts - List of the start values of the runs
+            gas - Merge the runs of the total gas grid rather than HI
+            fill - Value each serial run added to its grid before gridding: this is removed from all but one.
+        """
+        sources = []
+        nserial = 0
+        for start in starts:
+            tmpbase = self.savefile+"."+str(start)+".tmp"
+            if gas:
+                tmpbase+=".gas"
+            try:
+                reader = checkpoint.CheckpointReader(tmpbase)
+                sources.append((reader, range(start, int(reader.state)+1)))
+                nserial += 1
+            except IOError:
+                pass
+            for part in parallel_ingest.completed_files(tmpbase).keys():
+                reader = checkpoint.CheckpointReader(part)
+                sources.append((reader, list(reader.state)))
+        if len(sources) == 0:
+            raise IOError("No checkpoints found to merge")
+        try:
+            self._merge_sources(sources, nserial, fill)
+        finally:
+            for (reader, _) in sources:
+                reader.close()
+        self.set_nHI_units()
+        return
+
+    def _merge_sources(self, sources, nserial, fill):
+        """Check the file ledgers of a list of (CheckpointReader, files) and sum them into sub_nHI_grid. For merge_tmp."""
+        #Check that every file is in exactly one run
+        nfiles = np.size(hdfsim.get_all_files(self.snapnum, self.snap_dir))
+        count = np.bincount(np.concatenate([np.array(files, dtype=np.int64) for (_, files) in sources]), minlength=nfiles)
+        if np.any(count > 1):
+            raise ValueError("Files gridded more than once: "+str(np.where(count > 1)[0]))
+        if np.size(count) > nfiles:
+            raise ValueError("Files gridded which are not in the snapshot: "+str(np.arange(nfiles,np.size(count))))
+        if np.any(count == 0):
+            raise ValueError("Files not gridded: "+str(np.where(count == 0)[0]))
+        for (reader, _) in sources:
+            if reader.shapes != [np.shape(grid) for grid in self.sub_nHI_grid]:
+                raise ValueError("Grid shape of "+reader.tmpbase+" does not match")
+        print "Merging ",len(sources)," partial grids covering ",nfiles," files"
+        for (name, gg, sl) in sources[0][0].tiles():
+            tile = np.zeros(np.shape(self.sub_nHI_grid[gg][sl]), dtype=np.float64)
+            for (reader, _) in sources:
+                data = reader.read(name)
+                if data is not None:
+                    tile += data
+            tile -= (nserial-1)*fill
+            self.sub_nHI_grid[gg][sl] = tile
+        return
+
+    def _where_slabs(self, cond):
+        """Equivalent to np.where(cond(self.sub_nHI_grid)), but evaluated one slab at a time,
+        so that no temporary the size of the whole grid is needed."""
+        inds = [np.where(cond(self.sub_nHI_grid[ii])) for ii in xrange(self.nhalo)]
+        slabs = np.concatenate([ii*np.ones_like(inds[ii][0]) for ii in xrange(self.nhalo)])
+        return (slabs, np.concatenate([ind[0] for ind in inds]), np.concatenate([ind[1] for ind in inds]))
 
-    def _find_particles_in_slab(self,ii,ipos,ismooth, mHI):
-        """Find particles in the slab and convert their units to grid units"""
-        #At the moment any particle which is located in the slice is wholly in the slice:
-        #no periodicity or smoothing.
-        #Gather all particles in this slice
-        #Is the avg smoothing length is ~100 kpc and the slice is ~2.5 Mpc wide, this will be a small effect.
-        jpos = self.sub_cofm[ii,0]
+    def _bin_particles_by_slab(self, ipos, ismooth, mHI):
+        """Sort the particles from one file by the slab they are in, so that every slab
+        can be gridded from a contiguous view after a single pass over the particles.
+        A particle whose smoothing sphere crosses a slab boundary (or the periodic edge of the box)
+        is placed in every slab it touches, with its mass split by the fraction of the kernel volume
+        in each slab. The split uses the top-hat kernel (the Makefile default).
+        Returns (ipos, ismooth, mHI, offsets): slab ii is the range offsets[ii]:offsets[ii+1]."""
+        npart = np.shape(ipos)[0]
+        if self.nhalo == 1:
+            return (ipos, ismooth, mHI, np.array([0, npart]))
+        width = self.box/(1.*self.nhalo)
         jjpos = ipos[:,0]
-        grid_radius = self.box/self.nhalo/2.
-        indj = np.where(ne.evaluate("abs(jjpos-jpos) < grid_radius"))
-        del jjpos
-        if np.size(indj) == 0:
-            return (None, None, None)
+        lowslab = np.floor((jjpos-ismooth)/width).astype(np.int64)
+        nspan = np.floor((jjpos+ismooth)/width).astype(np.int64) - lowslab + 1
+        #Most particles are wholly within one slab
+        single = np.where(nspan == 1)[0]
+        cross = np.where(nspan > 1)[0]
+        #Each crossing particle contributes one piece to each slab it overlaps
+        pind = np.repeat(cross, nspan[cross])
+        first = np.cumsum(nspan[cross])-nspan[cross]
+        piece = lowslab[pind]+np.arange(np.size(pind))-np.repeat(first, nspan[cross])
+        #Fraction of a uniform sphere between the slab walls, in units of the smoothing length
+        xx = jjpos[pind]
+        hh = ismooth[pind]
+        tlow = np.clip((piece*width-xx)/hh,-1,1)
+        tup = np.clip(((piece+1)*width-xx)/hh,-1,1)
+        frac = ne.evaluate("(3*(tup-tlow) - (tup**3-tlow**3))/4.")
+        pind = np.concatenate([single, pind])
+        slab = np.concatenate([lowslab[single], piece]) % self.nhalo
+        #Sort as a small integer type, which is cheaper to sort. The sort is stable, so the
+        #particles in each slab stay in file order.
+        if self.nhalo < 2**15:
+            slab = slab.astype(np.int16)
+        order = np.argsort(slab, kind='mergesort')
+        offsets = np.concatenate([[0],np.cumsum(np.bincount(slab, minlength=self.nhalo))])
+        mHI_slab = mHI[pind]
+        #mHI may have a column for each of several quantities
+        mHI_slab[np.size(single):] = (mHI_slab[np.size(single):].T*frac).T
+        mHI_slab = mHI_slab[order]
+        pind = pind[order]
+        return (ipos[pind], ismooth[pind], mHI_slab, offsets)
 
-        ipos_slab = ipos[indj]
-        # Update smooth and rho arrays as well:
-        ismooth_slab = ismooth[indj]
-        mHI_slab = mHI[indj]
-        del indj
+    def _slab_grid_units(self, ii, ipos, ismooth):
+        """Convert the positions and smoothing lengths of the particles in a slab to grid units"""
         #coords in grid units
-        coords=fieldize.convert(ipos_slab,self.ngrid[0],self.box)
-        del ipos_slab
+        coords=fieldize.convert(ipos,self.ngrid[0],self.box)
         # Convert each particle's density to column density by multiplying by the smoothing length once (in physical cm)!
         cellspkpc=(self.ngrid[0]/self.box)
         if self.once:
@@ -111,9 +399,18 @@ class BoxHI(HaloHI):
             print ii," Av. smoothing length is ",avgsmth," kpc/h ",avgsmth*cellspkpc, "grid cells min: ",np.min(ismooth)*cellspkpc
             self.once=False
         #Convert smoothing lengths to grid coordinates.
-        return (coords, ismooth_slab*cellspkpc, mHI_slab)
+        return (coords, ismooth*cellspkpc)
 
-    def sub_gridize_single_file(self,ii,ipos,ismooth,mHI,sub_nHI_grid,weights=None):
+    def _find_particles_in_slab(self,ii,ipos,ismooth, mHI, offsets):
+        """Find particles in the slab and convert their units to grid units.
+        The particles should be sorted into slabs by _bin_particles_by_slab, which also returns offsets."""
+        if offsets[ii+1] == offsets[ii]:
+            return (None, None, None)
+        slab = slice(offsets[ii], offsets[ii+1])
+        (coords, ismooth_slab) = self._slab_grid_units(ii, ipos[slab], ismooth[slab])
+        return (coords, ismooth_slab, mHI[slab])
+
+    def sub_gridize_single_file(self,ii,ipos,ismooth,mHI,sub_nHI_grid,weights=None,offsets=None):
         """Helper function for sub_nHI_grid
             that puts data arrays loaded from a particular file onto the grid.
             Arguments:
@@ -121,16 +418,125 @@ class BoxHI(HaloHI):
                 rho - Density array to be interpolated
                 smooth - Smoothing lengths
                 sub_grid - Grid to add the interpolated data to
+                offsets - If given, the particles are already sorted into slabs by _bin_particles_by_slab,
+                          which returns this. To grid every slab of a file, sort it once and pass offsets,
+                          rather than have each call sort the whole file again.
         """
-        (coords, ismooth, mHI) = self._find_particles_in_slab(ii,ipos,ismooth, mHI)
+        if offsets is None:
+            (ipos, ismooth, mHI, offsets) = self._bin_particles_by_slab(ipos, ismooth, mHI)
+        (coords, ismooth, mHI) = self._find_particles_in_slab(ii,ipos,ismooth, mHI, offsets)
         if np.size(coords) == 1 and coords == None:
             return
-        fieldize.sph_str(coords,mHI,sub_nHI_grid[ii],ismooth,weights=weights, periodic=True)
+        fieldize.sph_str(coords,mHI,sub_nHI_grid[ii],ismooth,weights=weights, periodic=True, morton=self.morton_deposit)
         del coords
         del mHI
         del ismooth
         return
 
+    def gridize_single_file(self,ipos,ismooth,mHI,sub_nHI_grid):
+        """Put the particles from one file onto every slab, sorting them into slabs only once.
+        If sub_nHI_grid has the slabs of several projections, the particles are projected onto each."""
+        for proj in xrange(len(sub_nHI_grid)/self.nhalo):
+            self._gridize_projection(proj, _project(ipos, proj), ismooth, mHI, sub_nHI_grid)
+        return
+
+    def _gridize_projection(self,proj,ipos,ismooth,mHI,sub_nHI_grid):
+        """Put the particles from one file onto every slab of projection proj, for gridize_single_file.
+        ipos should already have the axis projected along first."""
+        (ipos, ismooth, mHI, offsets) = self._bin_particles_by_slab(ipos, ismooth, mHI)
+        for ii in xrange(0,self.nhalo):
+            if offsets[ii+1] == offsets[ii]:
+                continue
+            #Index of the slab in sub_nHI_grid
+            gg = proj*self.nhalo+ii
+            slab = slice(offsets[ii], offsets[ii+1])
+            (coords, ismooth_slab) = self._slab_grid_units(ii, ipos[slab], ismooth[slab])
+            mHI_slab = mHI[slab]
+            if self.coarse_hsml != None:
+                big = np.where(ismooth_slab > self.coarse_hsml)
+                if np.size(big) > 0:
+                    (coarse, scale, sent) = self._get_coarse_slab(sub_nHI_grid, gg)
+                    fieldize.sph_str(coords[big]*scale,mHI_slab[big],coarse,ismooth_slab[big]*scale, periodic=True)
+                    sent[0] += np.sum(mHI_slab[big], dtype=np.float64)
+                    small = np.where(ismooth_slab <= self.coarse_hsml)
+                    (coords, ismooth_slab, mHI_slab) = (coords[small], ismooth_slab[small], mHI_slab[small])
+            if self.ntile > 1:
+                self._get_tiled_slab(sub_nHI_grid, gg).add_particles(coords, ismooth_slab, mHI_slab)
+            else:
+                fieldize.sph_str(coords,mHI_slab,sub_nHI_grid[gg],ismooth_slab, periodic=True, morton=self.morton_deposit)
+        return
+
+    def _get_coarse_slab(self, grid, ii):
+        """Get the coarse grid for the large particles of slab ii of grid, making it if needed.
+        Returns (coarse grid, factor to scale grid units by for it,
+        one-element list holding the mass of the particles deposited onto it)"""
+        try:
+            self._coarse_slabs
+        except AttributeError:
+            self._coarse_slabs = {}
+        key = (id(grid), ii)
+        nx = np.shape(grid[ii])[0]
+        nc = (nx-1)/self.coarse_factor+1
+        if key not in self._coarse_slabs:
+            self._coarse_slabs[key] = (grid, ii, np.zeros((nc, nc)), [0.])
+        (_, _, coarse, sent) = self._coarse_slabs[key]
+        return (coarse, fieldize.coarse_scale(nx, nc), sent)
+
+    def _get_tiled_slab(self, grid, ii):
+        """Get the TiledSlab which deposits onto slab ii of grid, making it if needed"""
+        try:
+            self._tiled_slabs
+        except AttributeError:
+            self._tiled_slabs = {}
+        key = (id(grid), ii)
+        if key not in self._tiled_slabs:
+            spillbase = self.savefile+"."+str(self.start)+".spill"+str(len(self._tiled_slabs))
+            self._tiled_slabs[key] = tiled_slab.TiledSlab(grid[ii], self.ntile, spillbase)
+        return self._tiled_slabs[key]
+
+    def flush_tiles(self):
+        """Deposit all particles waiting in tiled slabs onto their grids, and add any coarse grids to theirs.
+        Does nothing if the deposit is neither tiled nor coarse."""
+        try:
+            for tiled in self._tiled_slabs.values():
+                tiled.flush()
+        except AttributeError:
+            pass
+        self._flush_coarse()
+
+    def _flush_coarse(self):
+        """Add the coarse grids of large particles to the grids they belong to, and empty them.
+        Prints the relative difference between the mass added to the grids and the mass of the particles."""
+        try:
+            coarse_slabs = self._coarse_slabs
+        except AttributeError:
+            return
+        sent = 0.
+        added = 0.
+        for (grid, ii, coarse, slab_sent) in coarse_slabs.values():
+            sent += slab_sent[0]
+            added += fieldize.add_coarse(coarse, grid[ii])
+            coarse[:] = 0
+            slab_sent[0] = 0.
+        if sent > 0:
+            print "Added coarse grids for particles of mass ",sent," relative mass conservation error ",(added-sent)/sent
+
+    def set_nHI_units(self):
+        """Convert sub_nHI_grid from the gridded mass to log10 of the column density, as for HaloHI,
+        for the slabs of every projection"""
+        massg=self.UnitMass_in_g/self.hubble/self.protonmass
+        epsilon=2.*self.sub_radii[0]/(self.ngrid[0])*self.UnitLength_in_cm/self.hubble/(1+self.redshift)
+        for grid in self.sub_nHI_grid:
+            grid*=(massg/epsilon**2)
+            np.log10(grid,grid)
+        return
+
+    def save_tmp(self, location, force=False):
+        """Checkpoint a partially completed grid, as for HaloHI, first finishing any tiled deposits"""
+        if force or self._get_checkpointer().due():
+            self.flush_tiles()
+        return HaloHI.save_tmp(self, location, force)
+
     def set_stellar_grid(self):
         """Set up a grid around each halo containing the stellar column density
         """
@@ -140,20 +546,11 @@ class BoxHI(HaloHI):
         files = hdfsim.get_all_files(self.snapnum, self.snap_dir)
         #Larger numbers seem to be towards the beginning
         files.reverse()
-        for ff in files:
-            f = h5py.File(ff,"r")
-            print "Starting file ",ff
-            bar=f["PartType4"]
-            ipos=np.array(bar["Coordinates"])
-            #Get HI mass in internal units
-            mass=np.array(bar["Masses"])
-            smooth = np.array(bar["SubfindHsml"])
-            [self.sub_gridize_single_file(ii,ipos,smooth,mass,self.sub_star_grid) for ii in xrange(0,self.nhalo)]
-            f.close()
-            #Explicitly delete some things.
-            del ipos
-            del mass
-            del smooth
+        decode = lambda bar: (bar["Coordinates"], np.array(bar["SubfindHsml"]), np.array(bar["Masses"]))
+        for (nfile, data) in chunk_reader.prefetch_chunks(files, 4, decode):
+            if data is not None:
+                self.gridize_single_file(data[0], data[1], data[2], self.sub_star_grid)
+        self.flush_tiles()
         #we calculated things in internal gadget /cell and we want atoms/cm^2
         #So the conversion is mass/(cm/cell)^2
         for ii in xrange(0,self.nhalo):
@@ -172,77 +569,116 @@ class BoxHI(HaloHI):
     def set_zdir_grid(self, dlaind, gas=False, key="zpos", ion=-1):
         """Set up the grid around each halo where the HI is calculated.
         """
+        self.xslab = self.set_zdir_grids(dlaind, [(key, ion, gas)])[0]
+        return self.xslab
+
+    def set_zdir_grids(self, dlaind, specs):
+        """Compute several HI (or gas) weighted quantities for the cells in dlaind,
+        in a single pass through the snapshot files.
+        Arguments:
+            dlaind - Cells to compute the quantities for, as from _load_dla_index
+            specs - List of (key, ion, gas) for each quantity, as the arguments of set_zdir_grid
+        Returns:
+            Array with one row for each quantity, containing its column density in each cell.
+        """
         star=cold_gas.RahmatiRT(self.redshift, self.hubble, molec=self.molec)
         self.once=True
         #Now grid the HI for each halo
         files = hdfsim.get_all_files(self.snapnum, self.snap_dir)
         #Larger numbers seem to be towards the beginning
         files.reverse()
-        self.xslab = np.zeros_like(dlaind[0], dtype=np.float64)
+        #One row per quantity, so that the parallel ingest can checkpoint it as a 2D grid
+        xslabs = np.zeros((len(specs), np.size(dlaind[0])), dtype=np.float64)
+        key = "".join([spec[0]+str(spec[1])+str(int(spec[2])) for spec in specs])
         try:
             start = self.load_fast_tmp(self.start, key)
         except IOError:
             start = self.start
         end = np.min([np.size(files),self.end])
-        for xx in xrange(start,end):
-            ff = files[xx]
-            f = h5py.File(ff,"r")
-            print "Starting file ",ff
-            bar=f["PartType0"]
-            ipos=np.array(bar["Coordinates"])
-            #Get HI mass in internal units
-            mass=np.array(bar["Masses"])
+        #Which DLAs are in each slab
+        slabind = [np.where(dlaind[0] == slab) for slab in xrange(self.nhalo)]
+        #Index the DLA cells of each slab once, rather than for every file
+        targets = [self._target_index(dlaind[1][ind], dlaind[2][ind]) for ind in slabind]
+        decode = lambda bar: self._read_zdir_chunk(bar, star, specs)
+        grid_chunk = lambda data, grids: self._grid_zdir_chunk(data, grids[0], targets, slabind)
+        if self.nproc > 1:
+            parallel_ingest.ingest_files(decode, grid_chunk, files, [xslabs], self.tmpfile+".zdir"+key, self.nproc, start, end)
+        else:
+            for (nfile, data) in chunk_reader.prefetch_chunks(files[start:end], 0, decode):
+                if data is not None:
+                    grid_chunk(data, [xslabs])
+                else:
+                    self.save_fast_tmp(start,key)
+
+        #Fix the units:
+        #we calculated things in internal gadget /cell and we want atoms/cm^2
+        #So the conversion is mass/(cm/cell)^2
+        massg=self.UnitMass_in_g/self.hubble/self.protonmass
+        epsilon=2.*self.sub_radii[0]/(self.ngrid[0])*self.UnitLength_in_cm/self.hubble/(1+self.redshift)
+        xslabs*=(massg/epsilon**2)
+        return xslabs
+
+    def _read_zdir_chunk(self, bar, star, specs):
+        """Get the particles from a block which are needed for set_zdir_grids, binned by slab.
+        Returns (ipos, smooth, mass, offsets) as from _bin_particles_by_slab,
+        where mass has one column for each quantity in specs.
+        The positions are those of the selected projection, so "zpos" is the depth along its axis."""
+        ipos=bar["Coordinates"]
+        #Get HI mass in internal units
+        gmass=np.array(bar["Masses"])
+        nhi = self._derived(bar, "RahmatiRT_HI", star.get_reproc_HI)
+        ind = np.where(nhi > 1.e-3)
+        ipos = _project(ipos[ind,:][0], self.projection)
+        gmass = gmass[ind]
+        mass = np.empty((np.size(gmass), len(specs)), dtype=gmass.dtype)
+        for (ii, (key, ion, gas)) in enumerate(specs):
+            mass[:,ii] = gmass
             if not gas:
                 #Hydrogen mass fraction
                 try:
-                    mass *= np.array(bar["GFM_Metals"][:,0])
+                    mass[:,ii] *= np.array(bar["GFM_Metals"][:,0])[ind]
                 except KeyError:
-                    mass *= self.hy_mass
-            nhi = star.get_reproc_HI(bar)
-            ind = np.where(nhi > 1.e-3)
-            ipos = ipos[ind,:][0]
-            mass = mass[ind]
+                    mass[:,ii] *= self.hy_mass
+                mass[:,ii] *= nhi[ind]
             #Get x * m for the weighted z direction
-            if not gas:
-                mass *= nhi[ind]
             if key == "zpos":
-                mass*=ipos[:,0]
+                mass[:,ii]*=ipos[:,0]
             elif key != "":
-                mass *= self._get_secondary_array(ind,bar,key, ion)
-            smooth = hsml.get_smooth_length(bar)[ind]
-            for slab in xrange(self.nhalo):
-                ind = np.where(dlaind[0] == slab)
-                self.xslab[ind] += self.sub_list_grid_file(slab,ipos,smooth,mass,dlaind[1][ind], dlaind[2][ind])
+                mass[:,ii] *= self._get_secondary_array(ind,bar,key, ion)
+        smooth = self._derived(bar, "hsml", hsml.get_smooth_length)[ind]
+        return self._bin_particles_by_slab(ipos, smooth, mass)
 
-            f.close()
-            #Explicitly delete some things.
-            del ipos
-            del mass
-            del smooth
-            self.save_fast_tmp(start,key)
+    def _grid_zdir_chunk(self, data, xslabs, targets, slabind):
+        """Add a block of particles from _read_zdir_chunk to the list of cells in each slab, for set_zdir_grids.
+        targets is the index of the cells in each slab from _target_index, slabind their positions in xslabs."""
+        (ipos, smooth, mass, offsets) = data
+        for slab in xrange(self.nhalo):
+            if offsets[slab] == offsets[slab+1]:
+                continue
+            ind = slabind[slab]
+            sl = slice(offsets[slab], offsets[slab+1])
+            xslabs[:,ind[0]] += self.sub_list_grid_file(slab,ipos[sl],smooth[sl],mass[sl],targets[slab])
+        return
 
-        #Fix the units:
-        #we calculated things in internal gadget /cell and we want atoms/cm^2
-        #So the conversion is mass/(cm/cell)^2
-        massg=self.UnitMass_in_g/self.hubble/self.protonmass
-        epsilon=2.*self.sub_radii[0]/(self.ngrid[0])*self.UnitLength_in_cm/self.hubble/(1+self.redshift)
-        self.xslab*=(massg/epsilon**2)
-        return self.xslab
+    def _target_index(self, yslab, zslab):
+        """Index the cells (yslab, zslab) of a slab, for sub_list_grid_file"""
+        return _Make_Target_Index(yslab.astype(np.int64)*int(self.ngrid[0])+zslab, int(self.ngrid[0]))
 
     def _get_secondary_array(self, ind, bar, key, ion=1):
         """Get the array whose HI weighted amount we want to compute. Throws ValueError
         if key is not a desired species."""
         raise NotImplementedError("Not valid species")
 
-    def sub_list_grid_file(self,ii,ipos,ismooth,mHI,yslab, zslab):
-        """Like sub_gridize_single_file for set_zdir_grid
+    def sub_list_grid_file(self,ii,ipos,ismooth,mHI,targets):
+        """Like sub_gridize_single_file for set_zdir_grid.
+        The particles passed should already be those in slab ii, and there should be some.
+        targets is an index of the cells to keep, from _target_index.
+        mHI may have one column for each of several quantities,
+        in which case the result has one row for each quantity.
         """
-        (coords, ismooth, mHI) = self._find_particles_in_slab(ii,ipos,ismooth, mHI)
-        if np.size(coords) == 1 and coords == None:
-            return np.zeros_like(yslab)
+        (coords, ismooth) = self._slab_grid_units(ii, ipos, ismooth)
 
-        slablist = yslab*int(self.ngrid[0])+zslab
-        xslab = _Discard_SPH_Fieldize(slablist, coords, ismooth, mHI, np.array([0.]),True,int(self.ngrid[0]))
+        xslab = _Discard_SPH_Fieldize(targets, coords, ismooth, mHI, np.array([0.]),True,int(self.ngrid[0]))
         return xslab
 
     def absorption_distance(self):
@@ -278,11 +714,14 @@ class BoxHI(HaloHI):
             self.sub_nHI_grid
         except AttributeError:
             self.load_hi_grid()
-        if thresh > 0:
-            grids=self.sub_nHI_grid
-            HImass = np.sum(10**grids[np.where((grids < upthresh)*(grids > thresh))])/np.size(grids)
-        else:
-            HImass = np.mean(10**self.sub_nHI_grid)
+        #Sum one slab at a time
+        HImass = 0
+        for grid in self.sub_nHI_grid:
+            if thresh > 0:
+                HImass += np.sum(10**grid[np.where((grid < upthresh)*(grid > thresh))])
+            else:
+                HImass += np.sum(10**grid)
+        HImass /= np.size(self.sub_nHI_grid)
         #Avg. Column density of HI in g cm^-2 (comoving)
         HImass = self.protonmass * HImass/(1+self.redshift)**2
         #Length of column in comoving cm
@@ -349,7 +788,7 @@ class BoxHI(HaloHI):
         try:
             return self.pDLA
         except AttributeError:
-            DLAs = 1.*np.sum(self.sub_nHI_grid > thresh)
+            DLAs = 1.*np.sum([np.sum(grid > thresh) for grid in self.sub_nHI_grid])
             size = 1.*np.sum(self.ngrid**2)
             pDLA = DLAs/size/self.absorption_distance()
             self.pDLA = pDLA
@@ -393,7 +832,7 @@ class BoxHI(HaloHI):
         """Generate and save sigma_LLS to the savefile"""
         (self.real_sub_mass, self.sigLLS, self.field_lls, self.lls_halo) = self.find_cross_section(False, 0, 2.)
         f=h5py.File(self.savefile,'r+')
-        mgrp = f["CrossSection"]
+        mgrp = f["CrossSection"+_proj_suffix(self.projection)]
         try:
             del mgrp["sigLLS"]
             del mgrp["LLS_halo"]
@@ -408,7 +847,7 @@ class BoxHI(HaloHI):
         """Load sigma_LLS from a file"""
         f=h5py.File(self.savefile,'r')
         try:
-            mgrp = f["CrossSection"]
+            mgrp = f["CrossSection"+_proj_suffix(self.projection)]
             self.real_sub_mass = np.array(mgrp["sub_mass"])
             self.sigLLS = np.array(mgrp["sigLLS"])
             self.lls_halo = np.array(mgrp["LLS_halo"])
@@ -423,9 +862,9 @@ class BoxHI(HaloHI):
         (self.real_sub_mass, self.sigDLA, self.field_dla,self.dla_halo) = self.find_cross_section(True, 0, 1.)
         f=h5py.File(self.savefile,'r+')
         try:
-            mgrp = f.create_group("CrossSection")
+            mgrp = f.create_group("CrossSection"+_proj_suffix(self.projection))
         except ValueError:
-            mgrp = f["CrossSection"]
+            mgrp = f["CrossSection"+_proj_suffix(self.projection)]
         try:
             del mgrp["sub_mass"]
             del mgrp["sigDLA"]
@@ -444,7 +883,7 @@ class BoxHI(HaloHI):
         """Load sigma_DLA from a file"""
         f=h5py.File(self.savefile,'r')
         try:
-            mgrp = f["CrossSection"]
+            mgrp = f["CrossSection"+_proj_suffix(self.projection)]
             self.real_sub_mass = np.array(mgrp["sub_mass"])
             self.sigDLA = np.array(mgrp["sigDLA"])
             self.dla_halo = np.array(mgrp["DLA_halo"])
@@ -461,12 +900,11 @@ class BoxHI(HaloHI):
         (halo_mass, halo_cofm, halo_radii, sub_pos, sub_radii, sub_index) = self._load_halo(0, True)
         dlaind = self._load_dla_index(dla)
         #Computing z distances
-        xslab = self._get_dla_zpos(dlaind,dla)
-        self.dla_zdir=xslab
+        self.dla_zdir = self._get_dla_zpos(dlaind,dla)
         dla_cross = np.zeros_like(halo_mass)
         celsz = 1.*self.box/self.ngrid[0]
-        yslab = (dlaind[1]+0.5)*celsz
-        zslab = (dlaind[2]+0.5)*celsz
+        #Positions of the DLA cells along the x, y and z axes of the box
+        (xslab, yslab, zslab) = _unproject([self.dla_zdir, (dlaind[1]+0.5)*celsz, (dlaind[2]+0.5)*celsz], self.projection)
         assigned_halo = np.zeros_like(yslab, dtype=np.int32)
         assigned_halo-=1
         print "Starting find_halo_kernel"
@@ -477,12 +915,12 @@ class BoxHI(HaloHI):
         return (halo_mass, dla_cross, 100.*field_dla/np.shape(dlaind)[1],assigned_halo)
 
     def _get_dla_zpos(self,dlaind,dla=True):
-        """Load or compute the depth of the DLAs"""
+        """Load or compute the depth of the DLAs along the axis of the selected projection"""
         if dla == False:
             raise NotImplementedError("Does not work for LLS")
         f=h5py.File(self.savefile,'r')
         try:
-            xslab = np.array(f["CrossSection"]["DLAzdir"])
+            xslab = np.array(f["CrossSection"+_proj_suffix(self.projection)]["DLAzdir"])
         except KeyError:
             xhimass = self.set_zdir_grid(dlaind)
             xslab = xhimass/10**self._load_dla_val(dla)
@@ -490,10 +928,10 @@ class BoxHI(HaloHI):
         return xslab
 
     def _load_dla_index(self, dla=True):
-        """Load the positions of DLAs or LLS from savefile"""
+        """Load the positions of DLAs or LLS from savefile, for the selected projection"""
         #Load the DLA/LLS positions
         f=h5py.File(self.savefile,'r')
-        grp = f["abslists"]
+        grp = f["abslists"+_proj_suffix(self.projection)]
         #This is needed to make the dimensions right
         if dla:
             ind = (grp["DLA"][0,:],grp["DLA"][1,:],grp["DLA"][2,:])
@@ -503,10 +941,10 @@ class BoxHI(HaloHI):
         return ind
 
     def _load_dla_val(self, dla=True):
-        """Load the values of DLAs or LLS from savefile"""
+        """Load the values of DLAs or LLS from savefile, for the selected projection"""
         #Load the DLA/LLS positions
         f=h5py.File(self.savefile,'r')
-        grp = f["abslists"]
+        grp = f["abslists"+_proj_suffix(self.projection)]
         #This is needed to make the dimensions right
         if dla:
             nhi = np.array(grp["DLA_val"])
@@ -596,8 +1034,11 @@ class BoxHI(HaloHI):
             ind = np.where((self.halo_mass < 10.**maxM)*(self.halo_mass > 10.**minM))
             tot_f_N = np.histogram(np.ravel(grids[ind]),np.log10(NHI_table))[0]
         else:
-            ind = np.where(grids >= minN)
-            tot_f_N = np.histogram(np.ravel(grids[ind]),np.log10(NHI_table))[0]
+            #Histogram one slab at a time
+            tot_f_N = np.zeros(np.size(NHI_table)-1)
+            for grid in grids:
+                ind = np.where(grid >= minN)
+                tot_f_N += np.histogram(np.ravel(grid[ind]),np.log10(NHI_table))[0]
         tot_f_N=(tot_f_N)/(width*dX*tot_cells)
         return (center, tot_f_N)
 
@@ -608,7 +1049,7 @@ class BoxHI(HaloHI):
             return self.dla_metallicity-np.log10(self.solarz)
         except AttributeError:
             ff = h5py.File(self.savefile,"r")
-            self.dla_metallicity = np.array(ff["Metallicities"]["DLA"])
+            self.dla_metallicity = np.array(ff["Metallicities"+_proj_suffix(self.projection)]["DLA"])
             ff.close()
             return self.dla_metallicity-np.log10(self.solarz)
 
@@ -616,11 +1057,12 @@ class BoxHI(HaloHI):
         """Get the metallicity derived from an ionic species"""
         f=h5py.File(self.savefile,'r')
         grp = f[species][str(ion)]
+        suffix = _proj_suffix(self.projection)
         #This is needed to make the dimensions right
         if dla:
-            spec = np.array(grp["DLA"])
+            spec = np.array(grp["DLA"+suffix])
         else:
-            spec = np.array(grp["LLS"])
+            spec = np.array(grp["LLS"+suffix])
         f.close()
         #Divide by H column density
         hi = self._load_dla_val(dla)
@@ -634,7 +1076,7 @@ class BoxHI(HaloHI):
             return self.lls_metallicity-np.log10(self.solarz)
         except AttributeError:
             ff = h5py.File(self.savefile,"r")
-            self.lls_metallicity = np.array(ff["Metallicities"]["LLS"])
+            self.lls_metallicity = np.array(ff["Metallicities"+_proj_suffix(self.projection)]["LLS"])
             ff.close()
             return self.lls_metallicity-np.log10(self.solarz)
 
@@ -701,9 +1143,8 @@ class BoxHI(HaloHI):
         ind = np.where(self.dla_halo >= 0)
         halopos = halo_cofm[self.dla_halo[ind]]
         #Computing z distances
-        xslab = self._get_dla_zpos(dlaind,True)
-        yslab = (dlaind[1]+0.5)*self.box*1./self.ngrid[0]
-        zslab = (dlaind[2]+0.5)*self.box*1./self.ngrid[0]
+        celsz = self.box*1./self.ngrid[0]
+        (xslab, yslab, zslab) = _unproject([self._get_dla_zpos(dlaind,True), (dlaind[1]+0.5)*celsz, (dlaind[2]+0.5)*celsz], self.projection)
         #Total distance
         xdist = np.abs(xslab[ind]-halopos[:,0])
         ydist = np.abs(yslab[ind]-halopos[:,1])
@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""Incremental checkpoints of a set of large grids, for restarting an interrupted run.
+
+Each grid is divided into square tiles. A checkpoint records only the tiles which have changed
+since the previous checkpoint, found by comparing a CRC of each tile. Tiles are zlib-compressed
+and written on a background thread while gridding continues.
+
+The first checkpoint, and any checkpoint where the changed tiles since the last full checkpoint
+would outnumber the tiles in a full one, is a base: it contains every tile and is written in the
+calling thread, as copying the whole grid for the writer would double the memory used.
+Restoring reads the latest base and the deltas after it, taking the newest copy of each tile.
+
+Checkpoints are written to tmpbase.ckpt<n>, under a temporary name which is then renamed,
+so a crash while writing leaves the earlier checkpoints intact.
+
+Classes:
+    TileCheckpointer - Writes and restores incremental checkpoints
+    CheckpointReader - Reads the latest checkpointed grids one tile at a time
+"""
+import glob
+import os
+import sys
+import threading
+import time
+import zlib
+import numpy as np
+import h5py
+
+def _existing(tmpbase):
+    """Sorted list of the sequence numbers of the checkpoints of tmpbase on disk"""
+    seqs = []
+    for ckpt in glob.glob(tmpbase+".ckpt*"):
+        #Ignore checkpoints which were being written when we crashed
+        if ckpt.endswith(".new"):
+            continue
+        try:
+            seqs.append(int(ckpt[len(tmpbase+".ckpt"):]))
+        except ValueError:
+            pass
+    return sorted(seqs)
+
+def _tiles(shapes, tile):
+    """Iterate over every tile of grids with the given shapes, yielding (name, grid number, slices)"""
+    for gg in xrange(len(shapes)):
+        (nx, ny) = shapes[gg]
+        for tx in xrange(0, nx, tile):
+            for ty in xrange(0, ny, tile):
+                name = str(gg)+"_"+str(tx/tile)+"_"+str(ty/tile)
+                yield (name, gg, (slice(tx, tx+tile), slice(ty, ty+tile)))
+
+class TileCheckpointer:
+    """Incremental, asynchronously written checkpoints of a list of 2D grids.
+
+    Parameters:
+        tmpbase - Checkpoints are written to tmpbase.ckpt<n>
+        grids - List of 2D arrays to checkpoint. They need not be the same size.
+        interval - Minimum time between checkpoints, in seconds
+        tile - Linear size of a tile, in cells
+    """
+    def __init__(self, tmpbase, grids, interval=600, tile=1024):
+        self.tmpbase = tmpbase
+        self.grids = grids
+        self.interval = interval
+        self.tile = tile
+        self.last_time = time.time()
+        existing = _existing(tmpbase)
+        self.seq = existing[-1]+1 if len(existing) > 0 else 0
+        #CRC of each tile at the last checkpoint. None means the next checkpoint must be a base.
+        self.crcs = None
+        #Number of tiles in the deltas since the last base
+        self.delta_tiles = 0
+        self.thread = None
+        self.error = None
+
+    def _ckptfile(self, seq):
+        """Name of checkpoint number seq"""
+        return self.tmpbase+".ckpt"+str(seq)
+
+    def _tiles(self):
+        """Iterate over every tile, yielding (name, grid number, slices)"""
+        return _tiles([np.shape(grid) for grid in self.grids], self.tile)
+
+    def _crcs(self):
+        """Compute the CRC of every tile"""
+        return dict([(name, zlib.crc32(np.ascontiguousarray(self.grids[gg][sl]))) for (name, gg, sl) in self._tiles()])
+
+    def due(self):
+        """Is it time for another checkpoint?"""
+        return time.time() - self.last_time >= self.interval
+
+    def wait(self):
+        """Wait for the background writer to finish, raising any error it had"""
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+        if self.error != None:
+            error = self.error
+            self.error = None
+            raise error[0], error[1], error[2]
+
+    def save(self, state, force=False):
+        """Write a checkpoint, if one is due or force is set.
+        state is stored with the checkpoint and returned by restore:
+        it should say which snapshot files are in the grids.
+        Returns True if a checkpoint was started."""
+        if not force and not self.due():
+            return False
+        self.wait()
+        crcs = self._crcs()
+        if self.crcs == None:
+            dirty = crcs.keys()
+        else:
+            dirty = [name for name in crcs.keys() if crcs[name] != self.crcs[name]]
+        if self.crcs == None or self.delta_tiles + len(dirty) > len(crcs):
+            self._write(self.seq, ((name, self.grids[gg][sl]) for (name, gg, sl) in self._tiles()), state, True)
+            #Earlier checkpoints are no longer needed
+            for seq in _existing(self.tmpbase):
+                if seq < self.seq:
+                    os.remove(self._ckptfile(seq))
+            self.delta_tiles = 0
+        else:
+            #Copy the changed tiles, as gridding will carry on modifying the grids while they are written
+            dirty = set(dirty)
+            tiles = [(name, np.array(self.grids[gg][sl])) for (name, gg, sl) in self._tiles() if name in dirty]
+            self.thread = threading.Thread(target=self._write_thread, args=(self.seq, tiles, state))
+            self.thread.start()
+            self.delta_tiles += len(dirty)
+        self.crcs = crcs
+        self.seq += 1
+        self.last_time = time.time()
+        return True
+
+    def _write_thread(self, seq, tiles, state):
+        """Write a delta checkpoint, on the background thread"""
+        try:
+            self._write(seq, tiles, state, False)
+        except Exception:
+            self.error = sys.exc_info()
+
+    def _write(self, seq, tiles, state, base):
+        """Write a checkpoint file from an iterable of (name, tile) pairs"""
+        ckpt = self._ckptfile(seq)
+        f = h5py.File(ckpt+".new",'w')
+        grp = f.create_group("Tiles")
+        for (name, data) in tiles:
+            packed = zlib.compress(np.ascontiguousarray(data), 1)
+            grp.create_dataset(name, data=np.frombuffer(packed, dtype=np.uint8))
+        f.attrs["state"] = state
+        f.attrs["base"] = base
+        #Enough to read the tiles back without the grids
+        f.attrs["tile"] = self.tile
+        f.attrs["shapes"] = np.array([np.shape(grid) for grid in self.grids])
+        f.attrs["dtypes"] = np.array([str(grid.dtype) for grid in self.grids])
+        f.close()
+        os.rename(ckpt+".new", ckpt)
+
+    def restore(self, add=False):
+        """Rebuild the grids from the latest base checkpoint and the deltas after it.
+        If add is True, the checkpointed grids are added to the grids rather than replacing them.
+        Returns the state saved with the last checkpoint. Raises IOError if there is no checkpoint."""
+        reader = CheckpointReader(self.tmpbase)
+        try:
+            for (name, gg, sl) in self._tiles():
+                data = reader.read(name)
+                if data is None:
+                    continue
+                if add:
+                    self.grids[gg][sl] += data
+                else:
+                    self.grids[gg][sl] = data
+        finally:
+            reader.close()
+        if not add:
+            #Carry on from here. Delta checkpoints after the base are counted as a full base's worth,
+            #so the next checkpoint is a new base and the old chain can be removed.
+            self.crcs = self._crcs()
+            self.delta_tiles = len(self.crcs) if len(reader.chain) > 1 else 0
+        return reader.state
+
+    def latest_state(self):
+        """The state saved with the newest checkpoint, or None if there is none"""
+        existing = _existing(self.tmpbase)
+        if len(existing) == 0:
+            return None
+        f = h5py.File(self._ckptfile(existing[-1]),'r')
+        state = f.attrs["state"]
+        f.close()
+        return state
+
+class CheckpointReader:
+    """Reads the grids in the latest checkpoint of tmpbase (a base and the deltas after it),
+    one tile at a time, without needing the grids themselves.
+    Raises IOError if there is no complete checkpoint.
+
+    Attributes:
+        state - The state saved with the newest checkpoint
+        shapes, dtypes - Shape and type of each grid
+        chain - Sequence numbers of the checkpoints used, newest first
+    """
+    def __init__(self, tmpbase):
+        self.tmpbase = tmpbase
+        self.chain = []
+        self.files = []
+        for seq in _existing(tmpbase)[::-1]:
+            f = h5py.File(tmpbase+".ckpt"+str(seq),'r')
+            self.chain.append(seq)
+            self.files.append(f)
+            if f.attrs["base"]:
+                break
+        else:
+            self.close()
+            raise IOError("No complete checkpoint for "+tmpbase)
+        newest = self.files[0]
+        self.state = newest.attrs["state"]
+        self.tile = newest.attrs["tile"]
+        self.shapes = [tuple(shape) for shape in newest.attrs["shapes"]]
+        self.dtypes = [np.dtype(dtype) for dtype in newest.attrs["dtypes"]]
+        #Which checkpoint has the newest copy of each tile
+        self.index = {}
+        for f in self.files[::-1]:
+            for name in f["Tiles"].keys():
+                self.index[name] = f
+
+    def tiles(self):
+        """Iterate over every tile, yielding (name, grid number, slices)"""
+        return _tiles(self.shapes, self.tile)
+
+    def read(self, name):
+        """Read the newest copy of a tile, or None if it was never checkpointed"""
+        try:
+            f = self.index[name]
+        except KeyError:
+            return None
+        gg = int(name.split("_")[0])
+        tx, ty = [int(t) for t in name.split("_")[1:]]
+        shape = (np.min([self.tile, self.shapes[gg][0]-tx*self.tile]), np.min([self.tile, self.shapes[gg][1]-ty*self.tile]))
+        return np.frombuffer(zlib.decompress(np.array(f["Tiles"][name]).tostring()), dtype=self.dtypes[gg]).reshape(shape)
+
+    def close(self):
+        """Close the checkpoint files"""
+        for f in self.files:
+            f.close()
+        self.files = []
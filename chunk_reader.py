@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""Read particles from a snapshot file in fixed-size blocks, into reusable buffers.
+
+Reading a whole file with np.array(bar["Coordinates"]) allocates a new array the size of the file
+for every field, every file. Here each block of particles is read with read_direct into buffers
+taken from a pool, which are allocated once (sized from NumPart_ThisFile) and reused for every
+block of every file. Peak memory is then set by the block size, not the file size.
+
+prefetch_chunks also reads and decodes the next blocks on a background thread while the
+current block is being gridded, so that the disk and the CPU are busy at the same time.
+The SPH deposit releases the GIL, so the two really do run concurrently.
+
+Classes:
+    BufferPool - A set of reusable read buffers
+    ChunkView - Looks like an HDF5 particle group, but holds only one block of particles
+
+Functions:
+    read_chunks - Iterate over a particle type in a snapshot file in blocks
+    prefetch_chunks - Iterate over decoded blocks from a list of snapshot files, reading ahead in the background
+"""
+import sys
+import threading
+import Queue
+import numpy as np
+import h5py
+
+class BufferPool:
+    """A pool of reusable buffers for reading particle data, one for each field in each of nslots slots.
+    A block of particles is read into one slot, so nslots blocks may be in use at once."""
+    def __init__(self, nslots=1):
+        self.nslots = nslots
+        self.buffers = [dict() for _ in xrange(nslots)]
+        self.next_slot = 0
+
+    def get_slot(self):
+        """Get the slot for the next block of particles, cycling through the slots"""
+        slot = self.next_slot
+        self.next_slot = (self.next_slot + 1) % self.nslots
+        return slot
+
+    def get(self, slot, name, shape, dtype):
+        """Get a buffer of the given shape and type for field name.
+        The buffer is only reallocated if it is too small or of the wrong type,
+        so it ends up sized for the largest block read: min(chunk, NumPart_ThisFile)."""
+        size = int(np.prod(shape))
+        try:
+            buf = self.buffers[slot][name]
+            if buf.dtype != dtype or np.size(buf) < size:
+                raise KeyError
+        except KeyError:
+            buf = np.empty(size, dtype=dtype)
+            self.buffers[slot][name] = buf
+        return buf[:size].reshape(shape)
+
+#Shared by all readers in a process
+default_pool = BufferPool()
+
+class ChunkView:
+    """Looks like an HDF5 particle group (eg, f["PartType0"]) but contains only the particles start:end
+    of the npart in the group. This means it can be passed to anything which takes a particle group.
+    Each field is read into a pooled buffer the first time it is asked for.
+    The returned arrays are read-only views of the buffer, which is reused for the next block:
+    copy anything that needs to outlive the block, or be modified in place."""
+    def __init__(self, group, start, end, npart, pool, slot):
+        self.group = group
+        self.start = start
+        self.end = end
+        self.npart = npart
+        self.pool = pool
+        self.slot = slot
+        self.cache = {}
+
+    def keys(self):
+        """Names of the fields available"""
+        return self.group.keys()
+
+    def __contains__(self, name):
+        return name in self.group
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, name):
+        try:
+            return self.cache[name]
+        except KeyError:
+            pass
+        dset = self.group[name]
+        shape = (self.end-self.start,)+dset.shape[1:]
+        buf = self.pool.get(self.slot, name, shape, dset.dtype)
+        if self.end > self.start:
+            dset.read_direct(buf, source_sel=np.s_[self.start:self.end])
+        buf.flags.writeable = False
+        self.cache[name] = buf
+        return buf
+
+def read_chunks(f, ptype=0, chunk=2**21, pool=None):
+    """Iterate over the particles of type ptype in the open snapshot file f, in blocks of at most chunk particles.
+    Yields a ChunkView for each block."""
+    if pool == None:
+        pool = default_pool
+    npart = int(f["Header"].attrs["NumPart_ThisFile"][ptype])
+    group = f["PartType"+str(ptype)]
+    for start in xrange(0, npart, chunk):
+        yield ChunkView(group, start, min(start+chunk, npart), npart, pool, pool.get_slot())
+
+def prefetch_chunks(files, ptype, decode, depth=1, chunk=2**21):
+    """Iterate over the particles of type ptype in a list of snapshot files, in blocks.
+    A background thread opens each file, reads each block and calls decode on it,
+    staying at most depth blocks ahead of the caller.
+    Arguments:
+        files - List of snapshot files
+        ptype - Particle type to read
+        decode - Function called as decode(bar) on the ChunkView for each block, returning the data to grid.
+                 This runs on the background thread.
+        depth - Number of decoded blocks which may wait in the queue.
+                Memory used is about (depth+2) blocks of particle data.
+    Yields (nfile, data) for each block, where nfile is the index of the file in files.
+    After the last block of each file, yields (nfile, None), so the caller knows the file is done.
+    """
+    if len(files) == 0:
+        return
+    #One slot for the block being gridded, depth for blocks in the queue, one being read.
+    pool = BufferPool(depth+2)
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    def _put(item):
+        """Put an item on the queue, giving up if the caller has gone away"""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def _reader():
+        """Read and decode the files, on the background thread"""
+        try:
+            for nfile in xrange(len(files)):
+                f = h5py.File(files[nfile],"r")
+                print "Starting file ",files[nfile]
+                try:
+                    for bar in read_chunks(f, ptype, chunk, pool):
+                        if not _put((nfile, decode(bar), None)):
+                            return
+                finally:
+                    f.close()
+                if not _put((nfile, None, None)):
+                    return
+        except Exception:
+            #Pass the error on to be raised in the caller
+            _put((None, None, sys.exc_info()))
+    thread = threading.Thread(target=_reader)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            (nfile, data, exc) = queue.get()
+            if exc != None:
+                raise exc[0], exc[1], exc[2]
+            yield (nfile, data)
+            if data is None and nfile == len(files)-1:
+                break
+    finally:
+        stop.set()
+        thread.join()
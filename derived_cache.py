@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""Cache of derived per-particle fields (neutral fraction, smoothing length, temperature...) for snapshot files.
+
+Computing the self-shielded neutral fraction and the smoothing length of every particle is
+expensive, and the same values are needed by every gridding pass over a snapshot.
+Here each derived field is stored in a .npy file next to the snapshot file it came from
+(or in a separate directory), which later passes and later runs memory-map instead of recomputing.
+
+The cache files are named snapfile.derived.tag.field.model.npy. model is a hash of CACHE_VERSION,
+the function computing the field and, if it is a method, the class and scalar attributes of its object:
+eg, the redshift, hubble and molec of a cold_gas.RahmatiRT. tag should identify anything else
+the field depends on beyond the snapshot itself. Bump CACHE_VERSION when a field is computed
+differently with the same parameters, so that older cache files are no longer used.
+A cache file is filled one block of particles at a time as the snapshot file is read,
+under a temporary name which is renamed once every particle in the file has been written,
+so an interrupted pass never leaves a partly filled cache file.
+
+Classes:
+    DerivedCache - Gets derived fields of blocks of particles, from the cache if possible
+Functions:
+    model_tag - Hash identifying the function computing a field and its parameters
+"""
+import os
+import hashlib
+import inspect
+import numpy as np
+
+#Version of the derived fields, part of the name of every cache file
+CACHE_VERSION = "1"
+
+def model_tag(compute):
+    """Short hash identifying compute, a function calculating a derived field, and its parameters.
+    If compute is a method, the parameters are the class and the scalar attributes of its object;
+    anything else it holds, such as tables, is assumed to be set by these."""
+    desc = [CACHE_VERSION, getattr(compute, "__module__", ""), getattr(compute, "__name__", "")]
+    if inspect.ismethod(compute) and compute.__self__ is not None:
+        model = compute.__self__
+        desc.append(type(model).__name__)
+        attrs = getattr(model, "__dict__", {})
+        desc += [name+"="+repr(value) for (name, value) in sorted(attrs.items()) if np.isscalar(value)]
+    return hashlib.md5(" ".join(desc)).hexdigest()[:12]
+
+class DerivedCache:
+    """Derived per-particle fields of snapshot files, cached on disk.
+
+    Parameters:
+        tag - String identifying the parameters the fields depend on
+        cachedir - Directory for the cache files. If None, they are put next to the snapshot files.
+    """
+    def __init__(self, tag, cachedir=None):
+        self.tag = tag
+        self.cachedir = cachedir
+        #Snapshot file the open cache files belong to
+        self.snapfile = None
+        #Memory-mapped complete cache files, by path
+        self.readers = {}
+        #Cache files being filled: path -> (array, number of particles written)
+        self.writers = {}
+        #model_tag of each method computing a field, found on its first call, in case the model
+        #changes its own attributes: (id of model, method name) -> (model, tag)
+        self.model_tags = {}
+
+    def _model_tag(self, compute):
+        """model_tag of compute, as it was when the method was first called"""
+        if not inspect.ismethod(compute) or compute.__self__ is None:
+            return model_tag(compute)
+        key = (id(compute.__self__), compute.__name__)
+        try:
+            return self.model_tags[key][1]
+        except KeyError:
+            tag = model_tag(compute)
+            self.model_tags[key] = (compute.__self__, tag)
+            return tag
+
+    def _path(self, snapfile, name, compute):
+        """Name of the cache file for field name of snapfile, computed by compute"""
+        if self.cachedir == None:
+            base = snapfile
+        else:
+            base = os.path.join(self.cachedir, os.path.basename(snapfile))
+        return base+".derived."+self.tag+"."+name+"."+self._model_tag(compute)+".npy"
+
+    def _abandon(self, path):
+        """Stop filling a cache file and remove it"""
+        del self.writers[path]
+        os.remove(path+".new")
+
+    def _set_snapfile(self, snapfile):
+        """Move on to a new snapshot file, closing the cache files of the last one.
+        Any not yet filled were only partly read, so are thrown away."""
+        if snapfile == self.snapfile:
+            return
+        self.readers = {}
+        for path in self.writers.keys():
+            self._abandon(path)
+        self.snapfile = snapfile
+
+    def get(self, bar, name, compute):
+        """Get a derived field for a block of particles.
+        Arguments:
+            bar - Block of particles, a chunk_reader.ChunkView
+            name - Name of the field
+            compute - Function called as compute(bar) to calculate the field if it is not cached.
+                      The result must have one row per particle.
+        Returns:
+            The field, as a new array which may be modified.
+        Anything but a ChunkView does not say which particles of which file it holds, so is never cached."""
+        try:
+            (snapfile, start, end, npart) = (bar.group.file.filename, bar.start, bar.end, bar.npart)
+        except AttributeError:
+            return compute(bar)
+        self._set_snapfile(snapfile)
+        path = self._path(snapfile, name, compute)
+        try:
+            return np.array(self.readers[path][start:end])
+        except KeyError:
+            pass
+        if os.path.exists(path):
+            self.readers[path] = np.load(path, mmap_mode='r')
+            return np.array(self.readers[path][start:end])
+        values = compute(bar)
+        if np.shape(values)[0] == end-start:
+            self._store(path, start, npart, values)
+        return values
+
+    def _store(self, path, start, npart, values):
+        """Write the field for a block of particles into a cache file being filled.
+        Blocks must come in order: if one is missed, the file is not cached on this pass."""
+        if start == 0:
+            #Reading the file again from the start
+            if path in self.writers:
+                self._abandon(path)
+            arr = np.lib.format.open_memmap(path+".new", mode='w+', dtype=values.dtype, shape=(npart,)+np.shape(values)[1:])
+            filled = 0
+        else:
+            try:
+                (arr, filled) = self.writers[path]
+            except KeyError:
+                return
+            if start != filled:
+                self._abandon(path)
+                return
+        arr[start:start+np.shape(values)[0]] = values
+        filled += np.shape(values)[0]
+        if filled < npart:
+            self.writers[path] = (arr, filled)
+            return
+        self.writers.pop(path, None)
+        arr.flush()
+        del arr
+        os.rename(path+".new", path)
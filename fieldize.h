@@ -1,22 +1,30 @@
 #include <Python.h>
 #include "numpy/arrayobject.h"
 #include <new>
-#include <map>
+#include <vector>
+#include <algorithm>
+#include <stdint.h>
 
-class Summer
+//F is the type of the field: float or double.
+//The field may have several channels, one after another, stride apart:
+//doSum adds to channel chan.
+template <typename F> class Summer
 {
     public:
-        Summer(double * field_i, int nx_i):
-           field(field_i), nx(nx_i)
+        Summer(F * field_i, int nx_i, npy_intp stride_i=0):
+           field(field_i), nx(nx_i), stride(stride_i)
         {};
-/*         virtual void doSum(const double input, const int xoff, const int yoff); */
+/*         virtual void doSum(const double input, const int xoff, const int yoff, const int chan); */
     protected:
-        double * const field;
+        F * const field;
         const int nx;
+        const npy_intp stride;
 };
 
-//A class which interpolates data onto a regular grid, projecting
-//in the x direction and using SPH interpolation.
+//Particles are deposited in parallel, one thread per block of DEPOSIT_BLOCK x DEPOSIT_BLOCK cells.
+//Particles wider than half a block are deposited one at a time, with the threads sharing the cells.
+#define DEPOSIT_BLOCK 64
+
 template <class T> class SphInterp
 {
     public:
@@ -24,48 +32,61 @@ template <class T> class SphInterp
         //comp: pointer to temporary memory for Kahan summation. Not used if NO_KAHAN is defined
         //nx: size of the above arrays is nx*nx
         //periodic: should we assume input array is periodic?
-        SphInterp(T& sum_i, int nx_i, bool periodic_i):
-          sum(sum_i), nx(nx_i), periodic(periodic_i)
+        //box: use the stretched CIC kernel, spreading each particle evenly over a square of half-width radii,
+        //     rather than the SPH kernel
+        SphInterp(T& sum_i, int nx_i, bool periodic_i, bool box_i=false):
+          sum(sum_i), nx(nx_i), periodic(periodic_i), box(box_i)
         {};
         //pos: array of particle positions
         //radii: particule smoothing lengths
-        //value: amount to interpolate to grid
+        //value: amount to interpolate to grid. If this is 2D, with K columns,
+        //       column k goes to channel k of the field, using the same kernel weights.
         //weights: weights with which to interpolate
         //nval: size of the above arrays
         int do_work(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval);
-/*         { */
-/*  */
-/*             return 0; */
-/*         }; */
 
     private:
+        //Deposit particle p. If shared is true, the cells of the particle are split between threads.
+        int deposit(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval, const npy_intp p, const bool shared);
+        //Add val/norm times the cell weights sph_w (a (upgy-lowgy+1) x (upgx-lowgx+1) array) to the grid,
+        //wrapping cells off the edge around if periodic. val has one entry for each channel.
+        void add_to_cells(const double * sph_w, const double * val, const double norm, const int lowgx, const int lowgy, const int upgx, const int upgy, const bool shared);
+        //Add val times the weight w of cell (gx, gy) to each channel
+        inline void add_to_cell(const double w, const double * val, const int gx, const int gy)
+        {
+            for(int k=0; k < nchan; k++)
+                sum.doSum(val[k]*w, gx, gy, k);
+        }
         T& sum;
         const int nx;
         const bool periodic;
+        const bool box;
+        //Number of channels: columns of value
+        int nchan;
 
 };
 
-class SimpleSummer: public Summer
+template <typename F> class SimpleSummer: public Summer<F>
 {
     public:
-        SimpleSummer(double * field_i, int nx_i):
-            Summer(field_i, nx_i)
+        SimpleSummer(F * field_i, int nx_i):
+            Summer<F>(field_i, nx_i, (npy_intp) nx_i*nx_i)
         {};
-        inline void doSum(const double input, const int xoff, const int yoff)
+        inline void doSum(const double input, const int xoff, const int yoff, const int chan)
         {
-            field[nx*xoff+yoff]+=input;
+            this->field[chan*this->stride+this->nx*xoff+yoff]+=input;
         }
 };
 
 //As above, but interpolation uses Kahan Summation
-class KahanSummer: public Summer
+template <typename F> class KahanSummer: public Summer<F>
 {
     public:
-        KahanSummer(double * field_i, int nx_i):
-            Summer(field_i, nx_i)
+        KahanSummer(F * field_i, int nx_i, int nchan=1):
+            Summer<F>(field_i, nx_i, (npy_intp) nx_i*nx_i)
         {
             //Allocate Kahan compensation array, and throw if we can't.
-            comp = (double *) calloc(nx*nx,sizeof(double));
+            comp = (F *) calloc(nchan*this->stride,sizeof(F));
             if( !comp )
                 throw std::bad_alloc();
         }
@@ -75,54 +96,159 @@ class KahanSummer: public Summer
         };
         /*Evaluate one iteration of Kahan Summation: sum is the current value of the field,
          *comp the compensation array, input the value to add this time.*/
-        inline void doSum(const double input, const int xoff, const int yoff)
+        inline void doSum(const double input, const int xoff, const int yoff, const int chan)
         {
-            const int off = nx*xoff+yoff;
-            const double yy = input - *(comp+off);
-            const double temp = *(field+off)+yy;     //Alas, field is big, y small, so low-order digits of y are lost.
+            F * const field = this->field;
+            const npy_intp off = chan*this->stride+this->nx*xoff+yoff;
+            const F yy = input - *(comp+off);
+            const F temp = *(field+off)+yy;     //Alas, field is big, y small, so low-order digits of y are lost.
             *(comp+off) = (temp - *(field+off)) -yy; //(t - field) recovers the high-order part of y; subtracting y recovers -(low part of y)
             *(field+off) = temp;               //Algebraically, c should always be zero. Beware eagerly optimising compilers!
         }
     private:
-        double * comp;
+        F * comp;
+};
+
+
+//As SimpleSummer, but the field is only a tnx*tny tile of the full nx*nx grid,
+//starting at (x0, y0). Interpolation onto cells outside the tile is discarded.
+template <typename F> class TileSummer: public Summer<F>
+{
+    public:
+        TileSummer(F * field_i, int tnx_i, int tny_i, int x0_i, int y0_i):
+            Summer<F>(field_i, tny_i, (npy_intp) tnx_i*tny_i), tnx(tnx_i), x0(x0_i), y0(y0_i)
+        {};
+        inline void doSum(const double input, const int xoff, const int yoff, const int chan)
+        {
+            const int xx = xoff - x0;
+            const int yy = yoff - y0;
+            if(xx >= 0 && xx < tnx && yy >= 0 && yy < this->nx)
+                this->field[chan*this->stride+this->nx*xx+yy]+=input;
+        }
+    private:
+        const int tnx;
+        const int x0;
+        const int y0;
 };
 
+//Index of a list of target cells in an nx*nx grid, for DiscardingSummer.
+//A bitmap over the grid rejects cells which are not targets with a single lookup;
+//the position of a target in the list is then found in an open addressing hash table.
+//Building this is the expensive part, so it can be made once and used for many calls.
+class TargetIndex
+{
+    public:
+        //cells: offsets nx*x+y of the targets in the grid
+        TargetIndex(const int64_t * cells, const npy_intp nlist_i, const int nx_i):
+            nlist(nlist_i), nx(nx_i), bits(NULL), keys(NULL), vals(NULL)
+        {
+            const int64_t ncells = (int64_t) nx*nx;
+            //The table has a power of two size at least twice the number of targets, so that probe sequences are short
+            int logsize = 1;
+            while(((npy_intp) 1 << logsize) < 2*nlist)
+                logsize++;
+            const npy_intp size = (npy_intp) 1 << logsize;
+            mask = size - 1;
+            shift = 64 - logsize;
+            bits = (uint64_t *) calloc(ncells/64+1, sizeof(uint64_t));
+            keys = (int64_t *) malloc(size*sizeof(int64_t));
+            vals = (npy_intp *) malloc(size*sizeof(npy_intp));
+            if( !bits || !keys || !vals ){
+                release();
+                throw std::bad_alloc();
+            }
+            for(npy_intp i=0; i < size; i++)
+                keys[i] = -1;
+            for(npy_intp i=0; i < nlist; i++){
+                const int64_t cell = cells[i];
+                //Cells outside the grid are never deposited onto
+                if(cell < 0 || cell >= ncells)
+                    continue;
+                bits[cell/64] |= ((uint64_t) 1 << (cell % 64));
+                npy_intp slot = hash(cell);
+                while(keys[slot] != -1 && keys[slot] != cell)
+                    slot = (slot+1) & mask;
+                //If a cell is listed twice, the first entry gets the interpolation and the others stay zero
+                if(keys[slot] == -1){
+                    keys[slot] = cell;
+                    vals[slot] = i;
+                }
+            }
+        }
+        ~TargetIndex()
+        {
+            release();
+        }
+        //Position of cell in the list of targets, or -1 if it is not a target
+        inline npy_intp find(const int64_t cell) const
+        {
+            if(cell < 0 || cell >= (int64_t) nx*nx || !(bits[cell/64] & ((uint64_t) 1 << (cell % 64))))
+                return -1;
+            //The bitmap says the cell is in the table, so this terminates
+            npy_intp slot = hash(cell);
+            while(keys[slot] != cell)
+                slot = (slot+1) & mask;
+            return vals[slot];
+        }
+        const npy_intp nlist;
+        const int nx;
+    private:
+        //Fibonacci hashing: the top bits of the product are well mixed
+        inline npy_intp hash(const int64_t cell) const
+        {
+            return (npy_intp) (((uint64_t) cell * 11400714819323198485ull) >> shift);
+        }
+        void release()
+        {
+            free(bits);
+            free(keys);
+            free(vals);
+        }
+        //Not copyable: the copy would free the tables twice
+        TargetIndex(const TargetIndex &);
+        TargetIndex & operator=(const TargetIndex &);
+        uint64_t * bits;
+        int64_t * keys;
+        npy_intp * vals;
+        npy_intp mask;
+        int shift;
+};
 
 //As above, but discard all interpolation except
-//onto a predefined list of array elements
-class DiscardingSummer: public Summer
+//onto a predefined list of array elements. Each channel of the field is a list of nlist values.
+class DiscardingSummer: public Summer<double>
 {
     public:
-        DiscardingSummer(double * field_i, PyArrayObject * positions, int nx_i):
-            Summer(field_i, nx_i)
+        DiscardingSummer(double * field_i, const TargetIndex & index_i, int nx_i, int nchan=1):
+            Summer<double>(field_i, nx_i, index_i.nlist), index(index_i)
         {
-            npy_intp nlist = PyArray_SIZE(positions);
-            //Build an index of the actual positions of each item we want in the output array.
-            for(int i=0; i<nlist;i++)
-                index.insert(std::pair<int,int>(*(int64_t *)PyArray_GETPTR1(positions,i),i));
             //Allocate Kahan compensation array, and throw if we can't.
-            comp = (double *) calloc(nlist,sizeof(double));
+            comp = (double *) calloc(nchan*index.nlist,sizeof(double));
             if( !comp )
                 throw std::bad_alloc();
         }
+        ~DiscardingSummer()
+        {
+            free(comp);
+        };
 
         /*Evaluate one iteration of Kahan Summation: sum is the current value of the field,
          *comp the compensation array, input the value to add this time.*/
-        inline void doSum(const double input, const int xoff, const int yoff)
+        inline void doSum(const double input, const int xoff, const int yoff, const int chan)
         {
-            const int off = nx*xoff+yoff;
-            std::map<const int, const int>::const_iterator it = index.find(off);
-            if(it != index.end())
+            npy_intp it = index.find((int64_t) nx*xoff+yoff);
+            if(it >= 0)
             {
-                const double yy = input - comp[it->second];
-                const double temp = field[it->second]+yy;     //Alas, field is big, y small, so low-order digits of y are lost.
-                comp[it->second] = temp - field[it->second] -yy; //(t - field) recovers the high-order part of y; subtracting y recovers -(low part of y)
-                field[it->second] = temp;               //Algebraically, c should always be zero. Beware eagerly optimising compilers!
+                it += chan*stride;
+                const double yy = input - comp[it];
+                const double temp = field[it]+yy;     //Alas, field is big, y small, so low-order digits of y are lost.
+                comp[it] = temp - field[it] -yy; //(t - field) recovers the high-order part of y; subtracting y recovers -(low part of y)
+                field[it] = temp;               //Algebraically, c should always be zero. Beware eagerly optimising compilers!
             }
         }
 
     private:
-        std::map<const int, const int> index;
+        const TargetIndex & index;
         double * comp;
 };
 
@@ -131,19 +257,115 @@ class DiscardingSummer: public Summer
  * rr is the smoothing length, r0 is the distance of the cell from the center*/
 double compute_sph_cell_weight(double rr, double r0);
 
+/*Fraction of the projected kernel of a particle with smoothing length rr at the origin
+ * which falls in [-inf,x] x [-inf,y], for the ncx x ncy corners (x,y) = (x0+cx, y0+cy) of a block of cells.
+ * corner is an ncy x ncx array, with x varying fastest.
+ * Uses a table built by init_kernel_table, except for top-hat kernels a few cells wide, which use its closed form.*/
+void compute_sph_corners(const double rr, const double x0, const int ncx, const double y0, const int ncy, double * corner);
+
+/*As compute_sph_corners, for a particle spread evenly over the square [-rr,rr] x [-rr,rr]:
+ * the stretched CIC kernel of fieldize.cic_str.*/
+void compute_box_corners(const double rr, const double x0, const int ncx, const double y0, const int ncy, double * corner);
+
+/*Build the table for compute_sph_corners. Call once before any interpolation.*/
+void init_kernel_table();
+
+/*The 3D kernel at radius r, in units of the smoothing length. It is not normalised.*/
+double kernel_3d(const double r);
+
+/*As compute_sph_corners, for the 3D kernel: the fraction in [-inf,x] x [-inf,y] x [-inf,z] for the
+ * ncx x ncy x ncz corners (x0+cx, y0+cy, z0+cz). corner is an ncx x ncy x ncz array, with z varying fastest.
+ * Uses a table built by init_kernel_table_3d, except for top-hat kernels two or more cells wide, which use its closed form.*/
+void compute_sph_corners_3d(const double rr, const double x0, const int ncx, const double y0, const int ncy, const double z0, const int ncz, double * corner);
+
+/*Build the table for compute_sph_corners_3d, if it has not been built already.
+ * Call, holding the GIL, before any 3D interpolation.*/
+void init_kernel_table_3d();
+
 /**
  Do the hard work interpolating with an SPH kernel particles handed to us from python.
- This is declared here to avoid messing with template instantiation
+ This is declared here to avoid messing with template instantiation.
+
+ The grid is divided into blocks, coloured like a chessboard in each direction, so there are four colours.
+ A particle is placed in the block containing the low corner of its kernel, and a particle less than
+ half a block wide can only reach cells in its own block and the next blocks up.
+ Blocks of one colour therefore never share a cell, and each is deposited by one thread, in particle order.
+ The colours are done one after another, then the particles which are too wide for a block,
+ or which cross the edge of the grid, one at a time.
+ The order of the additions to each cell does not depend on the number of threads, so neither does the result.
 */
 template <class T> int SphInterp<T>::do_work(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval)
 {
-    for(int p=0;p<nval;p++){
+    nchan = PyArray_NDIM(value) == 2 ? PyArray_DIM(value,1) : 1;
+    const int nblock = (nx+DEPOSIT_BLOCK-1)/DEPOSIT_BLOCK;
+    const npy_intp nblocks = (npy_intp) nblock*nblock;
+    //Block of each particle, or nblocks for particles deposited one at a time
+    std::vector<npy_intp> block(nval);
+    for(npy_intp p=0;p<nval;p++){
+        const float ppx= *(float *)PyArray_GETPTR2(pos,p,1);
+        const float ppy= *(float *)PyArray_GETPTR2(pos,p,2);
+        const float rr= *((float *)PyArray_GETPTR1(radii,p));
+        const int lowgx = floor(ppx-rr);
+        const int lowgy = floor(ppy-rr);
+        const int upgx = floor(ppx+rr);
+        const int upgy = floor(ppy+rr);
+        //Cells 0 and nx-1 are where the periodic wrapping happens
+        if(lowgx > 0 && lowgy > 0 && upgx < nx-1 && upgy < nx-1 && 2*(upgx-lowgx+1) <= DEPOSIT_BLOCK && 2*(upgy-lowgy+1) <= DEPOSIT_BLOCK)
+            block[p] = (npy_intp) (lowgx/DEPOSIT_BLOCK)*nblock + lowgy/DEPOSIT_BLOCK;
+        else
+            block[p] = nblocks;
+    }
+    //Sort the particles by block, keeping them in order within each block
+    std::vector<npy_intp> start(nblocks+2, 0);
+    for(npy_intp p=0;p<nval;p++)
+        start[block[p]+1]++;
+    for(npy_intp b=0;b<=nblocks;b++)
+        start[b+1]+=start[b];
+    std::vector<npy_intp> order(nval);
+    {
+        std::vector<npy_intp> next(start.begin(), start.end()-1);
+        for(npy_intp p=0;p<nval;p++)
+            order[next[block[p]]++] = p;
+    }
+    int massless = 0;
+    int alloc_failed = 0;
+    for(int colour=0; colour < 4; colour++){
+        #pragma omp parallel for schedule(dynamic) reduction(|:massless,alloc_failed)
+        for(npy_intp b=0; b < nblocks; b++){
+            if(2*((b/nblock) % 2) + (b % nblock) % 2 != colour)
+                continue;
+            //An exception must not leave the parallel region: pass it on afterwards
+            try {
+                for(npy_intp i=start[b]; i < start[b+1]; i++)
+                    massless |= deposit(pos, radii, value, weights, nval, order[i], false);
+            }
+            catch (std::bad_alloc &) {
+                alloc_failed = 1;
+            }
+        }
+        if(alloc_failed)
+            throw std::bad_alloc();
+        if(massless)
+            return 1;
+    }
+    for(npy_intp i=start[nblocks]; i < start[nblocks+1]; i++)
+        if(deposit(pos, radii, value, weights, nval, order[i], true))
+            return 1;
+    return 0;
+}
+
+template <class T> int SphInterp<T>::deposit(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval, const npy_intp p, const bool shared)
+{
         //Temp variables
         float pp[2];
         pp[0]= *(float *)PyArray_GETPTR2(pos,p,1);
         pp[1]= *(float *)PyArray_GETPTR2(pos,p,2);
         const float rr= *((float *)PyArray_GETPTR1(radii,p));
-        const float val= *((float *)PyArray_GETPTR1(value,p));
+        //Value for each channel
+        double val[nchan];
+        const char * pval = PyArray_BYTES(value) + p*PyArray_STRIDE(value,0);
+        for(int k=0; k < nchan; k++)
+            val[k] = *((float *) (pval + (nchan > 1 ? k*PyArray_STRIDE(value,1) : 0)));
         double weight = 1;
         if (PyArray_DIM(weights,0) == nval){
             weight= *((double *)PyArray_GETPTR1(weights,p));
@@ -154,104 +376,320 @@ template <class T> int SphInterp<T>::do_work(PyArrayObject *pos, PyArrayObject *
                 weight = 1;
         }
         //Max size of kernel
-        const int upgx = floor(pp[0]+rr);
-        const int upgy = floor(pp[1]+rr);
-        const int lowgx = floor(pp[0]-rr);
-        const int lowgy = floor(pp[1]-rr);
+        const int fupgx = floor(pp[0]+rr);
+        const int fupgy = floor(pp[1]+rr);
+        const int flowgx = floor(pp[0]-rr);
+        const int flowgy = floor(pp[1]-rr);
         //Try to save some integrations if this particle is totally in this cell
-        if (lowgx==upgx && lowgy==upgy && lowgx >= 0 && lowgy >= 0){
-                sum.doSum(val/weight, lowgx,lowgy);
-                continue;
+        if (flowgx==fupgx && flowgy==fupgy && flowgx >= 0 && flowgy >= 0){
+                add_to_cell(1./weight, val, flowgx,flowgy);
+                return 0;
         }
-        /*Array for storing cell weights*/
-        double sph_w[upgy-lowgy+1][upgx-lowgx+1];
+        /* Only cells which land on the grid are computed: the grid itself,
+         * and if periodic the cells one period beyond each edge, which add_to_cells wraps around.
+         * Only a kernel wider than the box reaches further, and the part further out is dropped.*/
+        const int lim_low = periodic ? -(nx-1) : 0;
+        const int lim_up = periodic ? 2*(nx-1) : nx-1;
+        const int upgx = std::min(fupgx, lim_up);
+        const int upgy = std::min(fupgy, lim_up);
+        const int lowgx = std::max(flowgx, lim_low);
+        const int lowgy = std::max(flowgy, lim_low);
+        if(lowgx > upgx || lowgy > upgy)
+            return 0;
+        const bool clipped = (upgx != fupgx || upgy != fupgy || lowgx != flowgx || lowgy != flowgy);
+        const int wx = upgx-lowgx+1;
+        /*Cell weights, followed by the cumulative kernel at the cell corners.
+         * These are on the heap, as a wide kernel would not fit on the stack.*/
+        std::vector<double> work((npy_intp) (upgy-lowgy+1)*wx + (npy_intp) (upgy-lowgy+2)*(wx+1));
+        double * const sph_w = &work[0];
+        double * const corner = sph_w + (npy_intp) (upgy-lowgy+1)*wx;
 
         /*Total of cell weights*/
         double total=0;
-        /* First compute the cell weights.
-         * Subsample the cells if the smoothing length is O(1 cell).
-         * This is more accurate, and also avoids edge cases where the particle can rest just between a cell.*/
-        int nsub=2*((int)(2./rr))+1;
-        double subs[nsub];
-        /*Spread subsamples evenly across cell*/
-        for(int i=0; i < nsub; i++)
-            subs[i] = (i+1.)/(1.*nsub+1);
-        #pragma omp parallel for reduction(+:total)
-        for(int gy=lowgy;gy<=upgy;gy++)
-            for(int gx=lowgx;gx<=upgx;gx++){
-                sph_w[gy-lowgy][gx-lowgx]=0;
-                for(int iy=0; iy< nsub; iy++)
-                for(int ix=0; ix< nsub; ix++){
-                    double xx = gx-pp[0]+subs[ix];
-                    double yy = gy-pp[1]+subs[iy];
-                    double r0 = sqrt(xx*xx+yy*yy);
-                    sph_w[gy-lowgy][gx-lowgx]+=compute_sph_cell_weight(rr,r0)/nsub/nsub;
+        /* First compute the cell weights: the integral of the kernel over each cell,
+         * from the cumulative kernel at the cell corners, which neighbouring cells share.
+         * This is accurate for any smoothing length, even one much smaller than a cell,
+         * and the weights of a particle always add up to one.*/
+        if(box)
+            compute_box_corners(rr, lowgx-pp[0], wx+1, lowgy-pp[1], upgy-lowgy+2, corner);
+        else
+            compute_sph_corners(rr, lowgx-pp[0], wx+1, lowgy-pp[1], upgy-lowgy+2, corner);
+        #pragma omp parallel for if(shared)
+        for(int gy=0;gy<=upgy-lowgy;gy++){
+            const double * const c0 = corner + (npy_intp) gy*(wx+1);
+            const double * const c1 = c0 + wx+1;
+            for(int gx=0;gx<wx;gx++)
+                //Rounding can make cells the kernel does not reach slightly negative
+                sph_w[(npy_intp) gy*wx+gx] = std::max(c1[gx+1]-c0[gx+1]-c1[gx]+c0[gx], 0.);
+        }
+        if(clipped){
+            //The weights of the cells computed do not cover the whole kernel:
+            //the total is the kernel over the full extent, from its four outer corners.
+            double outer[4];
+            for(int cy=0; cy < 2; cy++)
+                for(int cx=0; cx < 2; cx++){
+                    const double x0 = (cx ? fupgx+1 : flowgx)-pp[0];
+                    const double y0 = (cy ? fupgy+1 : flowgy)-pp[1];
+                    if(box)
+                        compute_box_corners(rr, x0, 1, y0, 1, &outer[2*cy+cx]);
+                    else
+                        compute_sph_corners(rr, x0, 1, y0, 1, &outer[2*cy+cx]);
                 }
-                total+=sph_w[gy-lowgy][gx-lowgx];
-            }
-//         if(total > 1.05)
-//           tothigh++;
-//         if(total< 0.5)
-//           totlow++;
-        if(total == 0){
-//            fprintf(stderr,"Massless particle detected! rr=%g gy=%d gx=%d nsub = %d pp= %g %g \n",rr,upgy-lowgy,upgx-lowgx, nsub,-pp[0]+lowgx,-pp[1]+lowgy);
+            total = outer[3]-outer[2]-outer[1]+outer[0];
+        }
+        else{
+            //Summed in order, so that the total does not depend on the number of threads
+            for(npy_intp i=0;i<(npy_intp) (upgy-lowgy+1)*wx;i++)
+                    total+=sph_w[i];
+        }
+        if(total <= 0){
+//            fprintf(stderr,"Massless particle detected! rr=%g gy=%d gx=%d pp= %g %g \n",rr,upgy-lowgy,upgx-lowgx,-pp[0]+lowgx,-pp[1]+lowgy);
             return 1;
         }
+        add_to_cells(sph_w, val, total*weight, lowgx, lowgy, upgx, upgy, shared);
+        return 0;
+}
+
+template <class T> void SphInterp<T>::add_to_cells(const double * sph_w, const double * val, const double norm, const int lowgx, const int lowgy, const int upgx, const int upgy, const bool shared)
+{
+        const int wx = upgx-lowgx+1;
         /* Some cells will be only partially in the array: only partially add them.
          * Then add the right fraction to the total array*/
-
-        #pragma omp parallel for
+        #pragma omp parallel for if(shared)
         for(int gy=std::max(lowgy,0);gy<=std::min(upgy,nx-1);gy++)
             for(int gx=std::max(lowgx,0);gx<=std::min(upgx,nx-1);gx++){
-                sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx,gy);
+                add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx,gy);
             }
         //Deal with cells that have wrapped around the edges of the grid
         if (periodic){
             //Wrapping y over
-            #pragma omp parallel for
+            #pragma omp parallel for if(shared)
             for(int gy=nx-1;gy<=upgy;gy++){
                 //Wrapping only y over
                 for(int gx=std::max(lowgx,0);gx<=std::min(upgx,nx-1);gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx,gy-(nx-1));
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx,gy-(nx-1));
                 }
                 //y over, x over
                 for(int gx=nx-1;gx<=upgx;gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx-(nx-1),gy-(nx-1));
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx-(nx-1),gy-(nx-1));
                 }
                 //y over, x under
                 for(int gx=lowgx;gx<=0;gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx+(nx-1),gy-(nx-1));
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx+(nx-1),gy-(nx-1));
                 }
             }
             //Wrapping y under
-            #pragma omp parallel for
+            #pragma omp parallel for if(shared)
             for(int gy=lowgy;gy<=0;gy++){
                 //Only y under
                 for(int gx=std::max(lowgx,0);gx<=std::min(upgx,nx-1);gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx,gy+(nx-1));
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx,gy+(nx-1));
                 }
                 //y under, x over
                 for(int gx=nx-1;gx<=upgx;gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx-(nx-1),gy+(nx-1));
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx-(nx-1),gy+(nx-1));
                 }
                 //y under, x under
                 for(int gx=lowgx;gx<=0;gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx+(nx-1),gy+(nx-1));
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx+(nx-1),gy+(nx-1));
                 }
             }
             //Finally wrap only x
-            #pragma omp parallel for
+            #pragma omp parallel for if(shared)
             for(int gy=std::max(lowgy,0);gy<=std::min(upgy,nx-1);gy++){
                 //x over
                 for(int gx=nx-1;gx<=upgx;gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx-(nx-1),gy);
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx-(nx-1),gy);
                 }
                 //x under
                 for(int gx=lowgx;gx<=0;gx++){
-                    sum.doSum(val*sph_w[gy-lowgy][gx-lowgx]/total/weight,gx+(nx-1),gy);
+                    add_to_cell(sph_w[(gy-lowgy)*wx+gx-lowgx]/norm, val, gx+(nx-1),gy);
                 }
             }
         }
+}
+
+//Block size for the parallel 3D deposit, as DEPOSIT_BLOCK
+#define DEPOSIT_BLOCK_3D 32
+//Particles with larger smoothing lengths than this, in cells, are deposited with the kernel at each cell centre:
+//the cells are then much smaller than the kernel, and than the spacing of the 3D kernel table.
+//The top-hat kernel jumps to zero at its edge, so sampling it there is poor: compute_sph_corners_3d has its closed form, so is always used.
+#ifdef TOP_HAT_KERNEL
+#define DIRECT_KERNEL_3D HUGE_VAL
+#else
+#define DIRECT_KERNEL_3D 16
+#endif
+
+/*Interpolate particles onto an nx*nx*nx grid with the 3D SPH kernel, adding to field[nx*nx*gx+nx*gy+gz].
+ Particle p is at (pos[p,0], pos[p,1], pos[p,2]).
+ Unlike SphInterp, a periodic grid has period nx, as it is usually to be Fourier transformed.
+ The particles are deposited in parallel as in SphInterp::do_work, with the blocks coloured in eight colours.*/
+template <typename F> class SphInterp3D
+{
+    public:
+        SphInterp3D(F * field_i, int nx_i, bool periodic_i):
+          field(field_i), nx(nx_i), periodic(periodic_i)
+        {};
+        //Arguments as for SphInterp::do_work, but value must be 1D. Returns 1 if a massless particle was found.
+        int do_work(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval);
+    private:
+        int deposit(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval, const npy_intp p, const bool shared);
+        //Wrap a cell index onto the grid. Returns false if it is off a non-periodic grid.
+        inline bool wrap(int& g)
+        {
+            if(g >= 0 && g < nx)
+                return true;
+            if(!periodic)
+                return false;
+            g = ((g % nx) + nx) % nx;
+            return true;
+        }
+        inline void add_to_cell(const double input, const int gx, const int gy, const int gz)
+        {
+            field[((npy_intp) gx*nx+gy)*nx+gz] += input;
+        }
+        F * const field;
+        const int nx;
+        const bool periodic;
+};
+
+template <typename F> int SphInterp3D<F>::do_work(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval)
+{
+    const int nblock = (nx+DEPOSIT_BLOCK_3D-1)/DEPOSIT_BLOCK_3D;
+    const npy_intp nblocks = (npy_intp) nblock*nblock*nblock;
+    //Block of each particle, or nblocks for particles deposited one at a time
+    std::vector<npy_intp> block(nval);
+    for(npy_intp p=0;p<nval;p++){
+        const float rr= *((float *)PyArray_GETPTR1(radii,p));
+        npy_intp b = 0;
+        for(int d=0; d < 3; d++){
+            const float pp = *(float *)PyArray_GETPTR2(pos,p,d);
+            const int low = floor(pp-rr);
+            const int up = floor(pp+rr);
+            if(low < 0 || up > nx-1 || 2*(up-low+1) > DEPOSIT_BLOCK_3D){
+                b = nblocks;
+                break;
+            }
+            b = b*nblock + low/DEPOSIT_BLOCK_3D;
+        }
+        block[p] = b;
+    }
+    //Sort the particles by block, keeping them in order within each block
+    std::vector<npy_intp> start(nblocks+2, 0);
+    for(npy_intp p=0;p<nval;p++)
+        start[block[p]+1]++;
+    for(npy_intp b=0;b<=nblocks;b++)
+        start[b+1]+=start[b];
+    std::vector<npy_intp> order(nval);
+    {
+        std::vector<npy_intp> next(start.begin(), start.end()-1);
+        for(npy_intp p=0;p<nval;p++)
+            order[next[block[p]]++] = p;
+    }
+    int massless = 0;
+    int alloc_failed = 0;
+    for(int colour=0; colour < 8; colour++){
+        #pragma omp parallel for schedule(dynamic) reduction(|:massless,alloc_failed)
+        for(npy_intp b=0; b < nblocks; b++){
+            const npy_intp bx = b/((npy_intp) nblock*nblock), by = (b/nblock) % nblock, bz = b % nblock;
+            if(4*(bx % 2) + 2*(by % 2) + bz % 2 != colour)
+                continue;
+            //As in SphInterp::do_work
+            try {
+                for(npy_intp i=start[b]; i < start[b+1]; i++)
+                    massless |= deposit(pos, radii, value, weights, nval, order[i], false);
+            }
+            catch (std::bad_alloc &) {
+                alloc_failed = 1;
+            }
+        }
+        if(alloc_failed)
+            throw std::bad_alloc();
+        if(massless)
+            return 1;
     }
+    for(npy_intp i=start[nblocks]; i < start[nblocks+1]; i++)
+        if(deposit(pos, radii, value, weights, nval, order[i], true))
+            return 1;
     return 0;
 }
+
+template <typename F> int SphInterp3D<F>::deposit(PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_int nval, const npy_intp p, const bool shared)
+{
+        float pp[3];
+        for(int d=0; d < 3; d++)
+            pp[d] = *(float *)PyArray_GETPTR2(pos,p,d);
+        const float rr= *((float *)PyArray_GETPTR1(radii,p));
+        const double val = *((float *)PyArray_GETPTR1(value,p));
+        double weight = 1;
+        //As in SphInterp::deposit
+        if (PyArray_DIM(weights,0) == nval){
+            weight= *((double *)PyArray_GETPTR1(weights,p));
+            if (weight == 0)
+                weight = 1;
+        }
+        int low[3], nc[3];
+        for(int d=0; d < 3; d++){
+            low[d] = floor(pp[d]-rr);
+            nc[d] = (int) floor(pp[d]+rr) - low[d] + 1;
+        }
+        //Particle totally in one cell
+        if (nc[0] == 1 && nc[1] == 1 && nc[2] == 1){
+            if(wrap(low[0]) && wrap(low[1]) && wrap(low[2]))
+                add_to_cell(val/weight, low[0], low[1], low[2]);
+            return 0;
+        }
+        const npy_intp ncells = (npy_intp) nc[0]*nc[1]*nc[2];
+        std::vector<double> sph_w(ncells);
+        if(rr > DIRECT_KERNEL_3D){
+            #pragma omp parallel for if(shared)
+            for(int a=0; a < nc[0]; a++)
+                for(int b=0; b < nc[1]; b++)
+                    for(int c=0; c < nc[2]; c++){
+                        const double dx = low[0]+a+0.5-pp[0], dy = low[1]+b+0.5-pp[1], dz = low[2]+c+0.5-pp[2];
+                        sph_w[((npy_intp) a*nc[1]+b)*nc[2]+c] = kernel_3d(sqrt(dx*dx+dy*dy+dz*dz)/rr);
+                    }
+        }
+        else{
+            //The integral of the kernel over each cell, from the cumulative kernel at its eight corners
+            const int cy = nc[1]+1, cz = nc[2]+1;
+            std::vector<double> corner((npy_intp) (nc[0]+1)*cy*cz);
+            compute_sph_corners_3d(rr, low[0]-pp[0], nc[0]+1, low[1]-pp[1], cy, low[2]-pp[2], cz, &corner[0]);
+            const double * C = &corner[0];
+            for(int a=0; a < nc[0]; a++)
+                for(int b=0; b < nc[1]; b++)
+                    for(int c=0; c < nc[2]; c++){
+                        const npy_intp o = ((npy_intp) a*cy+b)*cz+c;
+                        const npy_intp ox = (npy_intp) cy*cz;
+                        //As in SphInterp::deposit, rounding must not make any weight negative
+                        sph_w[((npy_intp) a*nc[1]+b)*nc[2]+c] = std::max(C[o+ox+cz+1] - C[o+cz+1] - C[o+ox+1] - C[o+ox+cz]
+                                                              + C[o+1] + C[o+cz] + C[o+ox] - C[o], 0.);
+                    }
+        }
+        //Summed in order, so that the total does not depend on the number of threads
+        double total = 0;
+        for(npy_intp i=0; i < ncells; i++)
+            total += sph_w[i];
+        if(total == 0)
+            return 1;
+        const double norm = val/(total*weight);
+        //Images of a particle wider than the grid can wrap onto the same cell, so only split up narrower ones
+        #pragma omp parallel for if(shared && nc[0] <= nx)
+        for(int a=0; a < nc[0]; a++){
+            int gx = low[0]+a;
+            if(!wrap(gx))
+                continue;
+            for(int b=0; b < nc[1]; b++){
+                int gy = low[1]+b;
+                if(!wrap(gy))
+                    continue;
+                for(int c=0; c < nc[2]; c++){
+                    int gz = low[2]+c;
+                    if(!wrap(gz))
+                        continue;
+                    add_to_cell(sph_w[((npy_intp) a*nc[1]+b)*nc[2]+c]*norm, gx, gy, gz);
+                }
+            }
+        }
+        return 0;
+}
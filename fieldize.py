@@ -10,15 +10,13 @@
         Field  - grid to add interpolated points onto
 
     There are also helper functions (convert and convert_centered) to rescale arrays to grid units.
+
+    All three add to the field with tscadd, which is compiled, so they handle O(1e7) points in seconds.
 """
 import math
+import time
 import numpy as np
-
-#Try to import scipy.weave. If we can't, don't worry, we just use the unaccelerated versions
-try :
-    import scipy.weave
-except ImportError :
-    scipy=None
+from _fieldize_priv import _Mesh_Add
 
 def convert(pos, ngrid,box):
     """Rescales coordinates to grid units.
@@ -52,60 +50,43 @@ def check_input(pos, field):
         raise ValueError("Position array not wide enough for field")
     return 1
 
-def ngp(pos,values,field):
-    """Does nearest grid point for a 2D array.
+def ngp(pos,values,field,totweight=None,periodic=False):
+    """Does nearest grid point for a 2D or 3D array.
     Inputs:
         Values - list of field values to interpolate
         Points - coordinates of the field values
         Field  - grid to add interpolated points onto
+        totweight - If not None, an array like field to add the weights at each grid point to
+        periodic - Wrap points off the edges of the grid around, rather than discarding them
 
-    Points need to be in grid units
-
-    Note: This is implemented in scipy.weave and pure python (in case the weave breaks).
-    For O(1e5) points both versions are basically instantaneous.
-    For O(1e7) points the sipy.weave version is about 100 times faster.
+    Points need to be in grid units, with grid points at integer coordinates.
+    The field may be 2D or 3D: if it has fewer dimensions than the points, the extra coordinates are ignored.
     """
     if not check_input(pos,field):
         return field
-    nx=np.shape(values)[0]
     dims=np.size(np.shape(field))
+    nx=np.shape(field)[0]
     # Coordinates of nearest grid point (ngp).
-    ind=np.array(np.rint(pos),dtype=np.int)
-    #Sum over the 3rd axis here.
-    expr="""for(int j=0;j<nx;j++){
-            int ind1=ind(j,0);
-            int ind2=ind(j,1);
-            field(ind1,ind2)+=values(j);
-        }
-    """
-    expr3d="""for(int j=0;j<nx;j++){
-            int ind1=ind(j,0);
-            int ind2=ind(j,1);
-            int ind3=ind(j,2);
-            field(ind1,ind2,ind3)+=values(j);
-        }
-    """
-    try:
-        if dims==2:
-            scipy.weave.inline(expr,['nx','ind','values','field'],type_converters=scipy.weave.converters.blitz)
-        elif dims==3:
-            scipy.weave.inline(expr3d,['nx','ind','values','field'],type_converters=scipy.weave.converters.blitz)
-        else:
-            raise ValueError
-    except Exception:
-        #Fall back on slow python version.
-        for j in xrange(0,nx):
-            field[tuple(ind[j,0:dims])]+=values[j]
-    return field
+    kk=np.array(np.rint(pos[np.newaxis,:,0:dims]),dtype=np.int64)
+    ww=np.ones(np.shape(kk))
+    #Points within half a cell of the top edge round off the grid
+    tscedge(kk,ww,nx,periodic)
+    tscadd(field,kk,ww,values,totweight)
+    if totweight is None:
+        return field
+    else:
+        return (field,totweight)
 
 def cic(pos, value, field,totweight=None,periodic=False):
-    """Does Cloud-in-Cell for a 2D array.
+    """Does Cloud-in-Cell for a 2D or 3D array.
     Inputs:
         Values - list of field values to interpolate
         Points - coordinates of the field values
         Field  - grid to add interpolated points onto
+        totweight - If not None, an array like field to add the weights at each grid point to
+        periodic - Wrap points off the edges of the grid around, rather than discarding them
 
-    Points need to be in coordinates where np.max(points) = np.shape(field)
+    Points need to be in grid units, with grid points at integer coordinates.
     """
     # Some error handling.
     if not check_input(pos,field):
@@ -120,24 +101,24 @@ def cic(pos, value, field,totweight=None,periodic=False):
     # Calculate CIC weights.
     #-----------------------
 
-    # Coordinates of nearest grid point (ngp).
-    ng=np.array(np.rint(pos[:,0:dim]),dtype=np.int)
+    # Coordinates of the grid point below the sample.
+    # Grid points are at integer coordinates, as for ngp and tsc.
+    ng=np.array(np.floor(pos[:,0:dim]),dtype=np.int)
 
-    # Distance from sample to ngp.
-    dng=ng-pos[:,0:dim]
+    # Distance from that grid point to the sample.
+    dng=pos[:,0:dim]-ng
 
     #Setup two arrays for later:
     # kk is for the indices, and ww is for the weights.
     kk=np.empty([2,nval,dim])
     ww=np.empty([2,nval,dim])
-    # Index of ngp.
-    kk[1]=ng
-    # Weight of ngp.
-    ww[1]=0.5+np.abs(dng)
+    # Point below the sample.
+    kk[0]=ng
+    ww[0]=1-dng
 
-    # Point before ngp.
-    kk[0]=kk[1]-1  # Index.
-    ww[0]=0.5-np.abs(dng)
+    # Point above the sample.
+    kk[1]=kk[0]+1  # Index.
+    ww[1]=dng
 
     #Take care of the points at the boundaries
     tscedge(kk,ww,nx,periodic)
@@ -152,24 +133,9 @@ def cic(pos, value, field,totweight=None,periodic=False):
     # total(ifield)=n0**3 if sph.plot NE 'sph,temp' (not 1 because we use
     # xpos=posx*n0 --> cube length different from EDFW paper).
 
-    #index[j] -> kk[0][j,0],kk[0][j,2],kk[0][j,3] -> kk[0][j,:]
-
-    extraind=np.zeros(dim-1,dtype=int)
-    #Perform y=0, z=0 addition
-    tsc_xind(field,value,totweight,kk,ww,extraind)
-
-    if dim > 1:
-        #Perform z=0 addition
-        extraind[0]=1
-        tsc_xind(field,value,totweight,kk,ww,extraind)
+    tscadd(field,kk,ww,value,totweight)
 
-    if dim > 2:
-        extraind[1]=1
-        #Perform the rest of the addition
-        for yy in xrange(0,2):
-            extraind[0]=yy
-            tsc_xind(field,value,totweight,kk,ww,extraind)
-    if totweight == None:
+    if totweight is None:
         return field
     else:
         return (field,totweight)
@@ -296,26 +262,9 @@ def tsc(pos,value,field,totweight=None,periodic=False):
     # total(ifield)=n0**3 if sph.plot NE 'sph,temp' (not 1 because we use
     # xpos=posx*n0 --> cube length different from EDFW paper).
 
-    #index[j] -> kk[0][j,0],kk[0][j,2],kk[0][j,3] -> kk[0][j,:]
-
-    extraind=np.zeros(dim-1,dtype=int)
-    #Perform y=0, z=0 addition
-    tsc_xind(field,value,totweight,kk,ww,extraind)
-
-    if dim > 1:
-        #Perform z=0 addition
-        for yy in xrange(1,3):
-            extraind[0]=yy
-            tsc_xind(field,value,totweight,kk,ww,extraind)
-
-    if dim > 2:
-        #Perform the rest of the addition
-        for zz in xrange(1,3):
-            for yy in xrange(0,3):
-                extraind[0]=yy
-                extraind[1]=zz
-                tsc_xind(field,value,totweight,kk,ww,extraind)
-    if totweight == None:
+    tscadd(field,kk,ww,value,totweight)
+
+    if totweight is None:
         return field
     else:
         return (field,totweight)
@@ -325,19 +274,19 @@ def cic_str(pos,value,field,in_radii,periodic=False):
        that instead of each particle being stretched over one grid point,
        it is stretched over a cubic region with some radius.
 
-       Field must be 2d
+       Field must be 2d. The particles are added to it in place:
+       if it is a C-contiguous float32 or float64 array this needs no temporary array.
+       The deposit is done in parallel by _SPH_Fieldize, as for sph_str.
        Extra arguments:
             radii - Array of particle radii in grid units.
+            periodic - Wrap particles around the edges of the grid, with period nx-1 as for sph_str.
+                       Otherwise the parts of particles off the grid are discarded.
     """
     # Some error handling.
     if not check_input(pos,field):
         return field
 
-    nval=np.size(value)
-    dim=np.shape(field)
-    nx = dim[0]
-    dim=np.size(dim)
-    if dim != 2:
+    if np.size(np.shape(field)) != 2:
         raise ValueError("Non 2D grid not supported!")
     #Use a grid cell radius of 2/3 (4 \pi /3 )**(1/3) s
     #This means that l^3 = cell volume for AREPO (so it should be more or less exact)
@@ -350,99 +299,78 @@ def cic_str(pos,value,field,in_radii,periodic=False):
     #stretch it.
     ind = np.where(radii < 0.5)
     radii[ind]=0.5
-    #Weight of each cell
-    weight = value/(2*radii)**dim
-    #Upper and lower bounds
-    up = pos[:,1:dim+1]+np.repeat(np.transpose([radii,]),dim,axis=1)
-    low = pos[:,1:dim+1]-np.repeat(np.transpose([radii,]),dim,axis=1)
-    #Upper and lower grid cells to add to
-    upg = np.array(np.floor(up),dtype=int)
-    lowg = np.array(np.floor(low),dtype=int)
-    #Deal with the edges
-    if periodic:
-        raise ValueError("Periodic grid not supported")
-    else:
-        ind=np.where(up > nx-1)
-        up[ind] = nx
-        upg[ind]=nx-1
-        ind=np.where(low < 0)
-        low[ind]=0
-        lowg[ind]=0
-
-    expr="""for(int p=0;p<nval;p++){
-            //Temp variables
-            double wght = weight(p);
-            int ilx=lowg(p,0);
-            int ily=lowg(p,1);
-            int iux=upg(p,0);
-            int iuy=upg(p,1);
-            double lx=low(p,0);
-            double ly=low(p,1);
-            double ux=up(p,0);
-            double uy=up(p,1);
-            //Deal with corner values
-            field(ilx,ily)+=(ilx+1-lx)*(ily+1-ly)*wght;
-            field(iux,ily)+=(ux-iux)*(ily+1-ly)*wght;
-            field(ilx,iuy)+=(ilx+1-lx)*(uy-iuy)*wght;
-            field(iux,iuy)+=(ux-iux)*(uy-iuy)*wght;
-            //Edges in y
-            for(int gx=ilx+1;gx<iux;gx++){
-                field(gx,ily)+=(ily+1-ly)*wght;
-                field(gx,iuy)+=(uy-iuy)*wght;
-            }
-            //Central region
-            for(int gy=ily+1;gy< iuy;gy++){
-                //Edges.
-                field(ilx,gy)+=(ilx+1-lx)*wght;
-                field(iux,gy)+=(ux-iux)*wght;
-                //x-values
-                for(int gx=ilx+1;gx<iux;gx++){
-                    field(gx,gy)+=wght;
-                }
-            }
-        }
-    """
-    try:
-        scipy.weave.inline(expr,['nval','upg','lowg','field','up','low','weight'],type_converters=scipy.weave.converters.blitz)
-    except Exception:
-        for p in xrange(0,nval):
-            #Deal with corner values
-            field[lowg[p,0],lowg[p,1]]+=(lowg[p,0]+1-low[p,0])*(lowg[p,1]+1-low[p,1])*weight[p]
-            field[upg[p,0],lowg[p,1]]+=(up[p,0]-upg[p,0])*(lowg[p,1]+1-low[p,1])*weight[p]
-            field[lowg[p,0],upg[p,1]]+=(lowg[p,0]+1-low[p,0])*(up[p,1]-upg[p,1])*weight[p]
-            field[upg[p,0], upg[p,1]]+=(up[p,0]-upg[p,0])*(up[p,1]-upg[p,1])*weight[p]
-            #Edges in y
-            for gx in xrange(lowg[p,0]+1,upg[p,0]):
-                field[gx,lowg[p,1]]+=(lowg[p,1]+1-low[p,1])*weight[p]
-                field[gx,upg[p,1]]+=(up[p,1]-upg[p,1])*weight[p]
-            #Central region
-            for gy in xrange(lowg[p,1]+1,upg[p,1]):
-                #Edges in x
-                field[lowg[p,0],gy]+=(lowg[p,0]+1-low[p,0])*weight[p]
-                field[upg[p,0],gy]+=(up[p,0]-upg[p,0])*weight[p]
-                #x-values
-                for gx in xrange(lowg[p,0]+1,upg[p,0]):
-                    field[gx,gy]+=weight[p]
+    #Each cell gets the fraction of the particle's square which overlaps it
+    _sph_str(pos,value,field,radii,None,periodic,box=True)
     return field
 
-from _fieldize_priv import _SPH_Fieldize
-
-def sph_str(pos,value,field,radii,weights=None,periodic=False):
+from _fieldize_priv import _SPH_Fieldize, _SPH_Fieldize_3D
+
+#Time spent by sph_str in Morton sorting and in depositing, for the calls with morton=True
+morton_timing = {"particles":0, "sort":0., "deposit":0.}
+
+def _spread_bits(x):
+    """Spread the low 32 bits of a uint64 array out to the even bits"""
+    for (shift, mask) in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF), (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333), (1, 0x5555555555555555)):
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    return x
+
+def morton_order(pos):
+    """Find the order which sorts particles by the Morton (Z-order) index of the 2D grid cell they are in.
+    pos is as for sph_str, so the cell is given by pos[:,1] and pos[:,2].
+    Particles close in this order are close on the grid, so they are deposited onto cells already in cache."""
+    gx = np.floor(np.maximum(pos[:,1],0)).astype(np.uint64)
+    gy = np.floor(np.maximum(pos[:,2],0)).astype(np.uint64)
+    return np.argsort((_spread_bits(gx) << np.uint64(1)) | _spread_bits(gy))
+
+def morton_timing_report(reset=True):
+    """Describe the time spent in Morton sorting and depositing by sph_str since the last report"""
+    report = "Morton sorted "+str(morton_timing["particles"])+" particles in "+str(morton_timing["sort"])+" s, deposited in "+str(morton_timing["deposit"])+" s"
+    if reset:
+        morton_timing.update({"particles":0, "sort":0., "deposit":0.})
+    return report
+
+def sph_str(pos,value,field,radii,weights=None,periodic=False,morton=False):
     """Interpolate a particle onto a grid using an SPH kernel.
        This is similar to the cic_str() routine, but spherical.
 
-       Field must be 2d
+       Field must be 2d. The particles are added to it in place:
+       if it is a C-contiguous float32 or float64 array this needs no temporary array.
+       If value is 2D, with K columns, field should be K x nx x nx, and column k of value is added to field[k].
+       The kernel weights are only computed once for all K, so this is much faster than K separate calls.
        Extra arguments:
             radii - Array of particle radii in grid units.
             weights - Weights to divide each contribution by.
+            morton - Deposit the particles in Morton order of their grid cell (see morton_order),
+                     which is faster on large grids. The result only changes by the order of summation.
+                     The time taken is added to morton_timing.
     """
     # Some error handling.
     if np.size(pos)==0:
         return field
 
     dim=np.shape(field)
-    if np.size(dim) != 2:
-        raise ValueError("Non 2D grid not supported!")
+    if np.size(dim) != np.ndim(value)+1:
+        raise ValueError("Field must be 2D, or 3D with a channel for each column of value")
+    if morton:
+        t0 = time.time()
+        order = morton_order(pos)
+        pos = pos[order]
+        radii = radii[order]
+        value = value[order]
+        if weights is not None and np.size(weights) == np.size(value):
+            weights = weights[order]
+        t1 = time.time()
+        _sph_str(pos,value,field,radii,weights,periodic)
+        morton_timing["particles"] += np.size(order)
+        morton_timing["sort"] += t1-t0
+        morton_timing["deposit"] += time.time()-t1
+        return
+    _sph_str(pos,value,field,radii,weights,periodic)
+    return
+
+def _sph_str(pos,value,field,radii,weights,periodic,box=False):
+    """Deposit particles onto a 2D field with _SPH_Fieldize, for sph_str and (with box=True) cic_str"""
+    dim=np.shape(field)
     if weights == None:
         weights = np.array([0.])
     #Cast some array types
@@ -452,7 +380,112 @@ def sph_str(pos,value,field,radii,weights=None,periodic=False):
         radii = np.array(radii, dtype=np.float32)
     if value.dtype != np.float32:
         value = np.array(value, dtype=np.float32)
-    field += _SPH_Fieldize(pos, radii, value, weights,periodic,dim[0])
+    if field.flags.c_contiguous and field.flags.writeable and (field.dtype == np.float32 or field.dtype == np.float64):
+        _SPH_Fieldize(field, pos, radii, value, weights,periodic,box)
+    else:
+        tmp = np.zeros(dim, dtype=np.float64)
+        _SPH_Fieldize(tmp, pos, radii, value, weights,periodic,box)
+        field += tmp
+    return
+
+def sph_str_3d(pos,value,field,radii,weights=None,periodic=False):
+    """Interpolate particles onto a 3D grid using the 3D SPH kernel, eg, for powerspectrum.powerspectrum.
+       Particle p is added around field[pos[p,0],pos[p,1],pos[p,2]], in grid units, so cell i covers [i,i+1).
+       This is much faster than tsc for large grids, and is done in parallel.
+
+       Field must be nx x nx x nx. The particles are added to it in place:
+       if it is a C-contiguous float32 or float64 array this needs no temporary array.
+       Extra arguments are as for sph_str, except that a periodic grid has period nx, rather than nx-1.
+    """
+    if np.size(pos)==0:
+        return field
+    if np.size(np.shape(field)) != 3:
+        raise ValueError("Field must be 3D")
+    if weights is None:
+        weights = np.array([0.])
+    #Cast some array types
+    if pos.dtype != np.float32:
+        pos = np.array(pos, dtype=np.float32)
+    if radii.dtype != np.float32:
+        radii = np.array(radii, dtype=np.float32)
+    if value.dtype != np.float32:
+        value = np.array(value, dtype=np.float32)
+    if field.flags.c_contiguous and field.flags.writeable and (field.dtype == np.float32 or field.dtype == np.float64):
+        _SPH_Fieldize_3D(field, pos, radii, value, weights, periodic)
+    else:
+        tmp = np.zeros(np.shape(field), dtype=np.float64)
+        _SPH_Fieldize_3D(tmp, pos, radii, value, weights, periodic)
+        field += tmp
+    return field
+
+def coarse_scale(nx, nc):
+    """Factor to multiply grid coordinates and radii for an nx x nx periodic grid by,
+    to deposit onto an nc x nc grid covering the same region with the same period."""
+    return (nc-1.)/(nx-1.)
+
+def add_coarse(coarse, field, rows=1024):
+    """Add a coarse grid, deposited using coordinates scaled by coarse_scale, onto a finer field.
+    Both grids are periodic as in sph_str: the last row and column repeat the first,
+    so only the first nc-1 coarse cells along each axis are distinct.
+    Each of these is spread evenly over the fine cells whose centres it contains,
+    and the last row and column of the field repeat the first, so mass is conserved.
+    The field is updated rows rows at a time, so it may be a large np.memmap.
+    Returns the total the distinct cells of the field (all but the last row and column) increased by,
+    which differs from the mass deposited onto the coarse grid by rounding in the field."""
+    nx = np.shape(field)[0]
+    nc = np.shape(coarse)[0]
+    #Coarse cell containing each distinct fine cell centre
+    cmap = np.floor((np.arange(nx-1)+0.5)*coarse_scale(nx, nc)).astype(np.int64)
+    count = np.bincount(cmap, minlength=nc-1)
+    spread = coarse[:nc-1,:nc-1]/np.outer(np.maximum(count,1), np.maximum(count,1)).astype(np.float64)
+    #The last fine cell is the first again
+    cmap = np.append(cmap, cmap[0])
+    added = 0.
+    for start in xrange(0, nx, rows):
+        #Rows of this block which are distinct
+        end = min(start+rows, nx-1)
+        before = np.sum(field[start:end,:nx-1], dtype=np.float64)
+        field[start:start+rows] += spread[cmap[start:start+rows]][:, cmap]
+        added += np.sum(field[start:end,:nx-1], dtype=np.float64) - before
+    return added
+
+from _fieldize_priv import _SPH_Fieldize_Halos
+
+def sph_str_halos(pos,value,fields,radii,cofm,sub_radii,box):
+    """Interpolate particles onto the grids around a list of halos using an SPH kernel, in a single call.
+       Each particle is added to the grid of every halo its smoothing sphere reaches, allowing for periodic wrapping.
+       The grid of halo j covers the cube of half-width sub_radii[j] about cofm[j],
+       with coordinates as from convert_centered.
+       Inputs:
+            pos - Particle positions in box units
+            value - Values to interpolate
+            fields - List of 2D grids, one for each halo, to add the particles to in place.
+                     Grids which are not C-contiguous float32 or float64 arrays are added to via a temporary array.
+            radii - Particle smoothing lengths in box units
+            cofm - Halo centres, in box units
+            sub_radii - Halo radii, in box units
+            box - Size of the periodic box
+    """
+    if np.size(pos)==0:
+        return
+    #Grids the C code can add to in place, and temporary grids for the rest
+    direct = []
+    copied = []
+    for field in fields:
+        if field.flags.c_contiguous and field.flags.writeable and (field.dtype == np.float32 or field.dtype == np.float64):
+            direct.append(field)
+        else:
+            tmp = np.zeros(np.shape(field), dtype=np.float64)
+            direct.append(tmp)
+            copied.append((field, tmp))
+    pos = np.ascontiguousarray(pos, dtype=np.float32)
+    radii = np.ascontiguousarray(radii, dtype=np.float32)
+    value = np.ascontiguousarray(value, dtype=np.float32)
+    cofm = np.ascontiguousarray(cofm, dtype=np.float64)
+    sub_radii = np.ascontiguousarray(sub_radii, dtype=np.float64)
+    _SPH_Fieldize_Halos(direct, pos, radii, value, cofm, sub_radii, float(box))
+    for (field, tmp) in copied:
+        field += tmp
     return
 
 import scipy.integrate as integ
@@ -524,7 +557,8 @@ def tscedge(kk,ww,ngrid,periodic):
         #If periodic, the nearest grid indices need to wrap around
         #Note python has a sensible remainder operator
         #which always returns > 0 , unlike C
-        kk=kk%ngrid
+        #Modify kk in place, so the caller sees the wrapped indices
+        kk[:]=kk%ngrid
     else:
         #Find points outside the grid
         ind=np.where(np.logical_or((kk < 0),(kk > ngrid-1)))
@@ -534,80 +568,28 @@ def tscedge(kk,ww,ngrid,periodic):
         kk[ind]=0
 
 
-def tscadd(field,index,weight,value,totweight):
-    """This function is a helper for the tsc and cic routines. It adds
+def tscadd(field,kk,ww,value,totweight):
+    """This function is a helper for the ngp, tsc and cic routines. It adds
        the weighted value to the field and optionally calculates the total weight.
+       kk and ww are (npts, nval, dims) arrays of grid indices and weights along each axis:
+       each value is added to the npts**dims grid points around it,
+       with the product of the weights along each axis.
     Returns nothing, but alters field
     """
-    nx=np.size(value)
-    dims=np.size(np.shape(field))
-    total=totweight !=None
-    #Faster C version of this function: this is getting a little out of hand.
-    expr="""for(int j=0;j<nx;j++){
-        int ind1=index(j,0);
-        int ind2=index(j,1);
-        """
-    if dims == 3:
-        expr+="""int ind3=index(j,2);
-                 field(ind1,ind2,ind3)+=weight(j)*value(j);
-                 """
-        if total:
-            expr+=" totweight(ind1,ind2,ind3) +=weight(j);"
-    if dims == 2:
-        expr+="""field(ind1,ind2)+=weight(j)*value(j);
-              """
-        if total:
-            expr+=" totweight(ind1,ind2) +=weight(j);"
-    expr+="}"
-    try:
-        if dims==2 or dims == 3:
-            if total:
-                scipy.weave.inline(expr,['nx','index','value','field','weight','totweight'],type_converters=scipy.weave.converters.blitz)
-            else:
-                scipy.weave.inline(expr,['nx','index','value','field','weight'],type_converters=scipy.weave.converters.blitz)
-        else:
-            raise ValueError
-    except Exception:
-        wwval=weight*value
-        for j in xrange(0,nx):
-            ind=tuple(index[j,:])
-            field[ind]+=wwval[j]
-            if totweight != None:
-                totweight[ind]+=weight[j]
-    return
-
-def get_tscweight(ww,ii):
-    """Calculates the TSC weight for a particular set of axes.
-    ii should be a vector of length dims having values 0,1,2.
-    (for CIC a similar thing but ii has values 0,1)
-    eg, call as:
-        get_tscweight(ww,[0,0,0])
-    """
-    tscweight=1.
-    #tscweight = \Pi ww[1]*ww[2]*ww[3]
-    for j in xrange(0,np.size(ii)):
-        tscweight*=ww[ii[j],:,j]
-    return tscweight
-
-def tsc_xind(field,value,totweight,kk,ww,extraind):
-    """Perform the interpolation along the x-axis.
-    extraind argument contains the y and z indices, if needed.
-    So for a 1d interpolation, extraind=[], for 2d,
-    extraind=[y,], for 3d, extraind=[y,z]
-    Returns nothing, but alters field
-    """
-    dims=np.size(extraind)+1
-    dim_list=np.zeros(dims,dtype=int)
-    dim_list[1:dims]=extraind
-    index=kk[0]
-    #Set up the index to have the right kk values depending on the y,z axes
-    for i in xrange(1,dims):
-        index[:,i]=kk[extraind[i-1],:,i]
-    #Do the addition for each value of x
-    for i in xrange(0,np.shape(kk)[0]):
-        dim_list[0]=i
-        tscweight=get_tscweight(ww,dim_list)
-        index[:,0]=kk[i,:,0]
-        tscadd(field,index,tscweight,value,totweight)
+    kk=np.ascontiguousarray(kk,dtype=np.int64)
+    ww=np.ascontiguousarray(ww,dtype=np.float64)
+    value=np.ascontiguousarray(value,dtype=np.float64)
+    #The compiled routine needs contiguous float32 or float64 arrays, so add anything else via a temporary
+    if field.flags.c_contiguous and field.flags.writeable and (field.dtype == np.float32 or field.dtype == np.float64) and (totweight is None or (totweight.flags.c_contiguous and totweight.flags.writeable and totweight.dtype == field.dtype)):
+        _Mesh_Add(field,totweight,kk,ww,value)
+        return
+    tmp=np.zeros(np.shape(field))
+    tmpweight=None
+    if totweight is not None:
+        tmpweight=np.zeros(np.shape(field))
+    _Mesh_Add(tmp,tmpweight,kk,ww,value)
+    field+=tmp
+    if totweight is not None:
+        totweight+=tmpweight
     return
 
@@ -15,7 +15,11 @@ import os.path as path
 import cold_gas
 import halo_mass_function
 import fieldize
+import parallel_ingest
+import checkpoint
 import hsml
+import chunk_reader
+import derived_cache
 import scipy.integrate as integ
 import scipy.stats
 import mpfit
@@ -51,10 +55,22 @@ class HaloHI:
         minpart - Minimum size of halo to consider, in DM particle masses
         halo_list - If not None, only consider halos in the list
         reload_file - Ignore saved files if true
+        nproc - Number of processes to read snapshot files with. See parallel_ingest.
         self.sub_nHI_grid is a list of neutral hydrogen grids, in log(N_HI / cm^-2) units.
         self.sub_mass is a list of halo masses
-        self.sub_cofm is a list of halo positions"""
-    def __init__(self,snap_dir,snapnum,minpart=400,reload_file=False,savefile=None, gas=False, molec=True, start=0, end = 3000):
+        self.sub_cofm is a list of halo positions
+        self.checkpoint_interval is the time in seconds between checkpoints while gridding.
+        self.cache_derived, if true, caches the neutral fraction, smoothing length and so on of each
+        snapshot file on disk, for later passes and later runs (see derived_cache),
+        in self.derived_cache_dir or, if that is None, next to the snapshot files.
+        self.morton_deposit, if true, deposits the particles in Morton order (see fieldize.sph_str)
+        and prints the time spent sorting them when gridding in one process is done.
+        This is for the large grids of subclasses: the small halo grids here are all gridded in one call."""
+    checkpoint_interval = 600
+    cache_derived = False
+    derived_cache_dir = None
+    morton_deposit = False
+    def __init__(self,snap_dir,snapnum,minpart=400,reload_file=False,savefile=None, gas=False, molec=True, start=0, end = 3000, nproc=1):
         self.minpart=minpart
         self.snapnum=snapnum
         self.snap_dir=snap_dir
@@ -62,6 +78,7 @@ class HaloHI:
         self.set_units()
         self.start = start
         self.end = end
+        self.nproc = nproc
         if savefile == None:
             self.savefile=path.join(self.snap_dir,"snapdir_"+str(self.snapnum).rjust(3,'0'),"halohi_grid.hdf5")
         else:
@@ -263,27 +280,31 @@ class HaloHI:
         rmol = self.rmol(sg, ss)
         return rmol/(1+rmol)
 
-    def save_tmp(self, location):
-        """Save a partially completed file"""
-        f = h5py.File(self.tmpfile,'w')
-        grp_grid = f.create_group("GridHIData")
-        for i in xrange(0,self.nhalo):
-            grp_grid.create_dataset(str(i),data=self.sub_nHI_grid[i])
-
-        f.attrs["file"]=location
-        f.close()
+    def _get_checkpointer(self):
+        """Get the checkpointer for sub_nHI_grid, making it if needed"""
+        try:
+            return self._checkpointer
+        except AttributeError:
+            self._checkpointer = checkpoint.TileCheckpointer(self.tmpfile, list(self.sub_nHI_grid), self.checkpoint_interval)
+            return self._checkpointer
+
+    def save_tmp(self, location, force=False):
+        """Checkpoint a partially completed grid, containing the files up to location,
+        if checkpoint_interval has passed since the last one or force is set.
+        Only changed tiles are written, in the background. If force is set, wait for the write to finish."""
+        ckpt = self._get_checkpointer()
+        saved = ckpt.save(location, force)
+        if force:
+            ckpt.wait()
+        return saved
 
     def load_tmp(self):
         """
-        Load a partially completed file
+        Load a partially completed grid from the checkpoints
         """
         print "Starting loading tmp file"
         print self.tmpfile
-        f = h5py.File(self.tmpfile,'r')
-        grp = f["GridHIData"]
-        [ grp[str(i)].read_direct(self.sub_nHI_grid[i]) for i in xrange(0,self.nhalo)]
-        location = f.attrs["file"]
-        f.close()
+        location = self._get_checkpointer().restore()
         print "Successfully loaded tmp file. Next to do is:",location+1
         return location+1
 
@@ -296,33 +317,28 @@ class HaloHI:
         files = hdfsim.get_all_files(self.snapnum, self.snap_dir)
         #Larger numbers seem to be towards the beginning
         files.reverse()
-        restart = 10
         end = np.min([np.size(files),self.end])
-        for xx in xrange(start, end):
-            ff = files[xx]
-            f = h5py.File(ff,"r")
-            print "Starting file ",ff
-            bar=f["PartType0"]
-            ipos=np.array(bar["Coordinates"])
-            #Get HI mass in internal units
-            mass=np.array(bar["Masses"])
-            if not gas:
-                #Hydrogen mass fraction
-                try:
-                    mass *= np.array(bar["GFM_Metals"][:,0])
-                except KeyError:
-                    mass *= self.hy_mass
-                mass *= star.get_reproc_HI(bar)
-            smooth = hsml.get_smooth_length(bar)
-            [self.sub_gridize_single_file(ii,ipos,smooth,mass,self.sub_nHI_grid) for ii in xrange(0,self.nhalo)]
-            f.close()
-            #Explicitly delete some things.
-            del ipos
-            del mass
-            del smooth
-            if xx % restart == 0 or xx == end-1:
-                self.save_tmp(xx)
+        decode = lambda bar: self._read_nHI_chunk(bar, star, gas)
+        grid_chunk = lambda data, grids: self.gridize_single_file(data[0], data[1], data[2], grids)
+        if self.nproc > 1:
+            parallel_ingest.ingest_files(decode, grid_chunk, files, list(self.sub_nHI_grid), self.tmpfile, self.nproc, start, end, self.checkpoint_interval)
+        else:
+            #Read and decode the next file while this one is gridded
+            for (nfile, data) in chunk_reader.prefetch_chunks(files[start:end], 0, decode):
+                if data is not None:
+                    grid_chunk(data, self.sub_nHI_grid)
+                    continue
+                xx = start+nfile
+                self.save_tmp(xx, force=(xx == end-1))
+        #The deposits made by worker processes are only timed in those processes
+        if self.morton_deposit and self.nproc == 1:
+            print fieldize.morton_timing_report()
+
+        self.set_nHI_units()
+        return
 
+    def set_nHI_units(self):
+        """Convert sub_nHI_grid from the gridded mass to log10 of the column density"""
         #Deal with zeros: 0.1 will not even register for things at 1e17.
         #Also fix the units:
         #we calculated things in internal gadget /cell and we want atoms/cm^2
@@ -334,6 +350,35 @@ class HaloHI:
             np.log10(self.sub_nHI_grid[ii],self.sub_nHI_grid[ii])
         return
 
+    def _read_nHI_chunk(self, bar, star, gas=False):
+        """Get the positions, smoothing lengths and HI (or gas) masses of a block of particles.
+        Returns (ipos, smooth, mass)"""
+        ipos=bar["Coordinates"]
+        #Get HI mass in internal units
+        mass=np.array(bar["Masses"])
+        if not gas:
+            #Hydrogen mass fraction
+            try:
+                mass *= np.array(bar["GFM_Metals"][:,0])
+            except KeyError:
+                mass *= self.hy_mass
+            mass *= self._derived(bar, "RahmatiRT_HI", star.get_reproc_HI)
+        smooth = self._derived(bar, "hsml", hsml.get_smooth_length)
+        return (ipos, smooth, mass)
+
+    def _derived(self, bar, name, compute):
+        """Get a derived per-particle field of a block of particles, computed by compute(bar),
+        from the derived field cache if cache_derived is set."""
+        if not self.cache_derived:
+            return compute(bar)
+        try:
+            cache = self._derived_cache
+        except AttributeError:
+            #The parameters of the model computing each field are added by derived_cache.model_tag
+            tag = "z"+str(self.redshift)+".molec"+str(int(self.molec))
+            cache = self._derived_cache = derived_cache.DerivedCache(tag, self.derived_cache_dir)
+        return cache.get(bar, name, compute)
+
     def _find_particles_near_halo(self, ii, ipos, ismooth, mHI):
         """Find the particles near a halo, paying attention to periodic box conditions"""
         #Find particles near each halo
@@ -396,7 +441,19 @@ class HaloHI:
             return
 
         (coords,ismooth) = self._convert_interp_units(ii, ipos, ismooth)
-        fieldize.sph_str(coords,mHI,sub_nHI_grid[ii],ismooth,weights=weights)
+        fieldize.sph_str(coords,mHI,sub_nHI_grid[ii],ismooth,weights=weights,morton=self.morton_deposit)
+        return
+
+    def gridize_single_file(self,ipos,ismooth,mHI,sub_nHI_grid):
+        """Put the particles from one file onto the grid of every halo.
+        This is a single call to fieldize.sph_str_halos, which finds the particles near each halo itself,
+        so there is no per-halo python overhead for catalogues of many small halos."""
+        if self.once:
+            cellspkpc=(self.ngrid[0]/(2*self.sub_radii[0]))
+            avgsmth=np.mean(ismooth)
+            print "Av. smoothing length is ",avgsmth," kpc/h ",avgsmth*cellspkpc, "grid cells min: ",np.min(ismooth)*cellspkpc
+            self.once=False
+        fieldize.sph_str_halos(ipos,mHI,sub_nHI_grid,ismooth,self.sub_cofm,self.sub_radii,self.box)
         return
 
     def get_sigma_DLA_halo(self,halo,DLA_cut,DLA_upper_cut=42.):
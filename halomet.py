@@ -12,11 +12,12 @@ import convert_cloudy
 import cold_gas
 import os.path as path
 import hsml
+import chunk_reader
 import h5py
-import numexpr as ne
 import halohi as hi
 import boxhi as bi
-import fieldize
+import parallel_ingest
+import checkpoint
 
 class HaloMet(hi.HaloHI):
     """Class to find the integrated metal density around a halo.
@@ -74,14 +75,11 @@ class HaloMet(hi.HaloHI):
         for ff in files:
             f = h5py.File(ff,"r")
             print "Starting file ",ff
-            bar=f["PartType0"]
-            ipos=np.array(bar["Coordinates"])
-            smooth = hsml.get_smooth_length(bar)
-            [self.sub_gridize_single_file(ii,ipos,smooth,bar,self.sub_nHI_grid) for ii in xrange(0,self.nhalo)]
+            for bar in chunk_reader.read_chunks(f, 0):
+                ipos=bar["Coordinates"]
+                smooth = self._derived(bar, "hsml", hsml.get_smooth_length)
+                self.gridize_single_file(ipos,smooth,self._read_ion_chunk(bar),self.sub_nHI_grid)
             f.close()
-            #Explicitly delete some things.
-            del ipos
-            del smooth
         #Deal with zeros: 0.1 will not even register for things at 1e17.
         #Also fix the units:
         #we calculated things in internal gadget /cell and we want atoms/cm^2
@@ -94,20 +92,9 @@ class HaloMet(hi.HaloHI):
         [np.log10(grid,grid) for grid in self.sub_nHI_grid]
         return
 
-    def sub_gridize_single_file(self,ii,ipos,ismooth,bar,sub_nHI_grid,weights=None):
-        """Helper function for sub_nHI_grid
-            that puts data arrays loaded from a particular file onto the grid.
-            Arguments:
-                pos - Position array
-                rho - Density array to be interpolated
-                smooth - Smoothing lengths
-                sub_grid - Grid to add the interpolated data to
-        """
-        #Find particles near each halo
-        sub_pos=self.sub_cofm[ii]
-        grid_radius = self.sub_radii[ii]
-        #Need a local for numexpr
-        box = self.box
+    def _read_ion_chunk(self, bar):
+        """Get the mass of the ion of the species in each particle of a block, in internal units,
+        to be gridded onto every halo at once by gridize_single_file."""
         #Get gas mass in internal units
         mass=np.array(bar["Masses"])
         #Density in this species
@@ -127,60 +114,18 @@ class HaloMet(hi.HaloHI):
         #     [+ Z/16*4 ] for OIV from electrons.
         mu = 1.0/(0.76*(0.75+np.array(bar["ElectronAbundance"])) + 0.25)
         temp = np.array(bar["InternalEnergy"])*self.tscale*mu
-        #Gather all nearby cells, paying attention to periodic box conditions
-        for dim in np.arange(3):
-            jpos = sub_pos[dim]
-            jjpos = ipos[:,dim]
-            indj = np.where(ne.evaluate("(abs(jjpos-jpos) < grid_radius+ismooth) | (abs(jjpos-jpos+box) < grid_radius+ismooth) | (abs(jjpos-jpos-box) < grid_radius+ismooth)"))
-
-            if np.size(indj) == 0:
-                return
-
-            ipos = ipos[indj]
-
-            # Update smooth and rho arrays as well:
-            ismooth = ismooth[indj]
-            mass = mass[indj]
-            mass_frac = mass_frac[indj]
-            den = den[indj]
-
-            jjpos = ipos[:,dim]
-            # BC 1:
-            ind_bc1 = np.where(ne.evaluate("(abs(jjpos-jpos+box) < grid_radius+ismooth)"))
-            ipos[ind_bc1,dim] = ipos[ind_bc1,dim] + box
-            # BC 2:
-            ind_bc2 = np.where(ne.evaluate("(abs(jjpos-jpos-box) < grid_radius+ismooth)"))
-            ipos[ind_bc2,dim] = ipos[ind_bc2,dim] - box
-
-            #if np.size(ind_bc1)>0 or np.size(ind_bc2)>0:
-            #    print "Fixed some periodic cells!"
-
-        if np.size(ipos) == 0:
-            return
         mass_frac *= self.cloudy_table.ion(self.elem, self.ion, den, temp)
-
-        #coords in grid units
-        coords=fieldize.convert_centered(ipos-sub_pos,self.ngrid[ii],2*self.sub_radii[ii])
-        #NH0
-        cellspkpc=(self.ngrid[ii]/(2*self.sub_radii[ii]))
-        #Convert smoothing lengths to grid coordinates.
-        ismooth*=cellspkpc
-        if self.once:
-            avgsmth=np.mean(ismooth)
-            print ii," Av. smoothing length is ",avgsmth/cellspkpc," kpc/h ",avgsmth, "grid cells min: ",np.min(ismooth)
-            self.once=False
-        #interpolate the density
-        fieldize.sph_str(coords,mass*mass_frac,sub_nHI_grid[ii],ismooth,weights=weights)
-        return
+        return mass*mass_frac
 
 class BoxMet(bi.BoxHI):
     """
     Class to find the mass-weighted metallicity for a box.
     Inherits from BoxHI
     """
-    def __init__(self,snap_dir,snapnum,nslice=1,savefile=None, start=0, end=3000, ngrid=16384):
-        bi.BoxHI.__init__(self, snap_dir, snapnum, nslice, False, savefile, False,start=start, end=end,ngrid=ngrid)
-        self.sub_ZZ_grid=np.zeros([nslice, ngrid,ngrid])
+    def __init__(self,snap_dir,snapnum,nslice=1,savefile=None, start=0, end=3000, ngrid=16384, nproc=1, memmap=False, ntile=1):
+        bi.BoxHI.__init__(self, snap_dir, snapnum, nslice, False, savefile, False,start=start, end=end,ngrid=ngrid, nproc=nproc, memmap=memmap, ntile=ntile)
+        #Only the x projection
+        self.sub_ZZ_grid=self._alloc_grid("ZZ", np.float64, 1)
         try:
             thisstart = self.load_met_tmp(self.start)
         except (IOError,KeyError):
@@ -201,29 +146,17 @@ class BoxMet(bi.BoxHI):
         files = hdfsim.get_all_files(self.snapnum, self.snap_dir)
         #Larger numbers seem to be towards the beginning
         files.reverse()
-        restart = 10
         end = np.min([np.size(files),self.end])
-        for xx in xrange(start, end):
-            ff = files[xx]
-            f = h5py.File(ff,"r")
-            print "Starting file ",ff
-            bar=f["PartType0"]
-            ipos=np.array(bar["Coordinates"])
-            #Get HI mass in internal units
-            mass=np.array(bar["Masses"])
-            #Sometimes the metallicity is less than zero: fix that
-            met = np.array(bar["GFM_Metallicity"])
-            met[np.where(met <=0)] = 1e-50
-            mass *= met
-            smooth = hsml.get_smooth_length(bar)
-            [self.sub_gridize_single_file(ii,ipos,smooth,mass,self.sub_ZZ_grid) for ii in xrange(0,self.nhalo)]
-            f.close()
-            #Explicitly delete some things.
-            del ipos
-            del mass
-            del smooth
-            if xx % restart == 0 or xx == end-1:
-                self.save_met_tmp(xx)
+        grid_chunk = lambda data, grids: self.gridize_single_file(data[0], data[1], data[2], grids)
+        if self.nproc > 1:
+            parallel_ingest.ingest_files(self._read_ZZ_chunk, grid_chunk, files, list(self.sub_ZZ_grid), self.savefile+"."+str(self.start)+".met.tmp", self.nproc, start, end, self.checkpoint_interval)
+        else:
+            for (nfile, data) in chunk_reader.prefetch_chunks(files[start:end], 0, self._read_ZZ_chunk):
+                if data is not None:
+                    grid_chunk(data, self.sub_ZZ_grid)
+                    continue
+                xx = start+nfile
+                self.save_met_tmp(xx, force=(xx == end-1))
 
         #Deal with zeros: 0.1 will not even register for things at 1e17.
         #Also fix the units:
@@ -237,6 +170,19 @@ class BoxMet(bi.BoxHI):
             np.log10(self.sub_ZZ_grid[ii],self.sub_ZZ_grid[ii])
         return
 
+    def _read_ZZ_chunk(self, bar):
+        """Get the positions, smoothing lengths and metal masses of a block of particles.
+        Returns (ipos, smooth, mass)"""
+        ipos=bar["Coordinates"]
+        #Get HI mass in internal units
+        mass=np.array(bar["Masses"])
+        #Sometimes the metallicity is less than zero: fix that
+        met = np.array(bar["GFM_Metallicity"])
+        met[np.where(met <=0)] = 1e-50
+        mass *= met
+        smooth = self._derived(bar, "hsml", hsml.get_smooth_length)
+        return (ipos, smooth, mass)
+
     def save_file(self):
         """This does something a little perverse: open up self.savefile
         and save the metallicity values only for the indices found in the abslists group"""
@@ -250,25 +196,30 @@ class BoxMet(bi.BoxHI):
         mgrp.create_dataset("LLS",data=self.sub_ZZ_grid[llsind])
         f.close()
 
-    def save_met_tmp(self, location):
-        """Save a partially completed file"""
-        f = h5py.File(self.savefile+"."+str(self.start)+".met.tmp",'w')
-        grp_grid = f.create_group("GridZZData")
-        for i in xrange(0,self.nhalo):
-            grp_grid.create_dataset(str(i),data=self.sub_ZZ_grid[i])
-        f.attrs["met_file"]=location
-        f.close()
+    def _get_met_checkpointer(self):
+        """Get the checkpointer for sub_ZZ_grid, making it if needed"""
+        try:
+            return self._met_checkpointer
+        except AttributeError:
+            self._met_checkpointer = checkpoint.TileCheckpointer(self.savefile+"."+str(self.start)+".met.tmp", list(self.sub_ZZ_grid), self.checkpoint_interval)
+            return self._met_checkpointer
+
+    def save_met_tmp(self, location, force=False):
+        """Checkpoint a partially completed metal grid, as for save_tmp"""
+        ckpt = self._get_met_checkpointer()
+        if force or ckpt.due():
+            self.flush_tiles()
+        saved = ckpt.save(location, force)
+        if force:
+            ckpt.wait()
+        return saved
 
     def load_met_tmp(self, start):
         """
-        Load a partially completed file
+        Load a partially completed metal grid from the checkpoints
         """
         print self.savefile+"."+str(start)+".met.tmp"
-        f = h5py.File(self.savefile+"."+str(start)+".met.tmp",'r')
-        grp = f["GridZZData"]
-        [ grp[str(i)].read_direct(self.sub_ZZ_grid[i]) for i in xrange(0,self.nhalo)]
-        location = f.attrs["met_file"]
-        f.close()
+        location = self._get_met_checkpointer().restore()
         print "Successfully loaded metals from tmp file. Next to do is:",location+1
         return location+1
 
@@ -277,8 +228,8 @@ class FastBoxMet(bi.BoxHI):
     Class to find the mass-weighted metallicity for a box.
     Inherits from BoxHI
     """
-    def __init__(self,snap_dir,snapnum,nslice=1,savefile=None, start=0, end=3000, ngrid=16384, cdir=None):
-        bi.BoxHI.__init__(self, snap_dir, snapnum, nslice, False, savefile, False,start=start, end=end,ngrid=ngrid)
+    def __init__(self,snap_dir,snapnum,nslice=1,savefile=None, start=0, end=3000, ngrid=16384, cdir=None, nproc=1):
+        bi.BoxHI.__init__(self, snap_dir, snapnum, nslice, False, savefile, False,start=start, end=end,ngrid=ngrid, nproc=nproc)
         if cdir != None:
             self.cloudy_table = convert_cloudy.CloudyTable(self.redshift, cdir)
         else:
@@ -286,40 +237,66 @@ class FastBoxMet(bi.BoxHI):
 
     def set_ZZ_fast_dla(self, dla=True):
         """Faster metallicity computation for only those cells with a DLA"""
-        dlaind = self._load_dla_index(dla)
-        #Computing z distances
-        xhmass = self.set_zdir_grid(dlaind,gas=True, key="met")
-        hmass = self.set_zdir_grid(dlaind,gas=True,key="")
-        met = xhmass/hmass
-        f=h5py.File(self.savefile,'r+')
-        mgrp = f.create_group("Metallicities")
-        if dla:
-            mgrp.create_dataset("DLA",data=met)
-        else:
-            mgrp.create_dataset("LLS",data=met)
-        f.close()
+        self.set_fast_dla(dla=dla, zpos=False)
 
     def set_metal_species_fast_dla(self, elem, ion, dla=True):
         """Faster metallicity computation for only those cells with a DLA"""
+        self.set_fast_dla([(elem, ion)], dla, metals=False, zpos=False)
+
+    def set_fast_dla(self, species=(), dla=True, metals=True, zpos=True):
+        """Compute the metallicity, the column density of each species and the depth
+        of the DLAs (or LLS) in a single pass through the snapshot, and save them to the savefile
+        where get_dla_metallicity, get_ion_metallicity and _get_dla_zpos look for them.
+        Everything is for the selected projection, and saved under its suffix.
+        Arguments:
+            species - List of (elem, ion) pairs to compute the column density of
+            metals - Compute the metallicity
+            zpos - Compute the depth of the DLAs. Only done for DLAs, and only if not already saved.
+        """
         dlaind = self._load_dla_index(dla)
+        suffix = bi._proj_suffix(self.projection)
+        if zpos and dla:
+            f=h5py.File(self.savefile,'r')
+            zpos = not ("CrossSection"+suffix in f and "DLAzdir" in f["CrossSection"+suffix])
+            f.close()
+        else:
+            zpos = False
+        specs = [(elem, ion, True) for (elem, ion) in species]
+        if metals:
+            specs += [("met", -1, True), ("", -1, True)]
+        if zpos:
+            specs += [("zpos", -1, False)]
+        if len(specs) == 0:
+            return
         #Computing z distances
-        species = self.set_zdir_grid(dlaind,gas=True, key=elem, ion=ion)
-        f=h5py.File(self.savefile,'r+')
-        try:
-            mgrp = f.create_group(elem)
-            mmgrp = mgrp.create_group(str(ion))
-        except ValueError:
-            mmgrp = f[elem][str(ion)]
+        result = self.set_zdir_grids(dlaind, specs)
         if dla:
             datas="DLA"
         else:
             datas="LLS"
+        f=h5py.File(self.savefile,'r+')
+        for (ii, (elem, ion)) in enumerate(species):
+            self._replace_dataset(f, (elem, str(ion)), datas+suffix, result[ii])
+        if metals:
+            self._replace_dataset(f, ("Metallicities"+suffix,), datas, result[len(species)]/result[len(species)+1])
+        if zpos:
+            self._replace_dataset(f, ("CrossSection"+suffix,), "DLAzdir", result[-1]/10**self._load_dla_val(dla))
+        f.close()
+
+    def _replace_dataset(self, f, groups, name, data):
+        """Save data to the dataset name in the nested groups of f, making the groups if needed
+        and replacing any dataset already there"""
+        grp = f
+        for gname in groups:
+            try:
+                grp = grp.create_group(gname)
+            except ValueError:
+                grp = grp[gname]
         try:
-            del mmgrp[datas]
+            del grp[name]
         except KeyError:
             pass
-        mmgrp.create_dataset(datas,data=species)
-        f.close()
+        grp.create_dataset(name,data=data)
 
     def _get_secondary_array(self, ind, bar, elem="", ion=-1):
         """Get the array whose HI weighted amount we want to compute. Throws ValueError
@@ -335,8 +312,8 @@ class FastBoxMet(bi.BoxHI):
             met /= self.amasses[elem]
             if ion != -1:
                 star=cold_gas.RahmatiRT(self.redshift, self.hubble)
-                den=star.get_code_rhoH(bar)
-                temp = star.get_temp(bar)
+                den = self._derived(bar, "RahmatiRT_rhoH", star.get_code_rhoH)
+                temp = self._derived(bar, "RahmatiRT_temp", star.get_temp)
                 temp = temp[ind]
                 den = den[ind]
                 met *= self.cloudy_table.ion(elem, ion, den, temp)
@@ -348,9 +325,9 @@ class BoxCIV(bi.BoxHI):
     Class to find omega_CIV for a box.
     Inherits from BoxHI
     """
-    def __init__(self,snap_dir,snapnum,nslice=1,reload_file=True, savefile=None, start=0, end=3000, ngrid=16384):
+    def __init__(self,snap_dir,snapnum,nslice=1,reload_file=True, savefile=None, start=0, end=3000, ngrid=16384, nproc=1, memmap=False, ntile=1):
         self.ion=4
-        bi.BoxHI.__init__(self, snap_dir, snapnum, nslice, reload_file=reload_file, savefile=savefile, start=start, end=end,ngrid=ngrid)
+        bi.BoxHI.__init__(self, snap_dir, snapnum, nslice, reload_file=reload_file, savefile=savefile, start=start, end=end,ngrid=ngrid, nproc=nproc, memmap=memmap, ntile=ntile)
 
     def set_nHI_grid(self, gas=False, start=0):
         """Set up the grid around each halo where the HI is calculated.
@@ -363,35 +340,15 @@ class BoxCIV(bi.BoxHI):
         #Larger numbers seem to be towards the beginning
         files.reverse()
         end = np.min([np.size(files),self.end])
-        for xx in xrange(start, end):
-            ff = files[xx]
-            f = h5py.File(ff,"r")
-            print "Starting file ",ff
-            bar=f["PartType0"]
-            ipos=np.array(bar["Coordinates"])
-            #Get HI mass in internal units
-            mass=np.array(bar["Masses"])
-            #Carbon mass fraction
-            den = star.get_code_rhoH(bar)
-            temp = star.get_temp(bar)
-            mass_frac = np.array(bar["GFM_Metals"][:,2])
-            #Floor on the mass fraction of the metal
-            ind = np.where(mass_frac > 1e-10)
-            mass = mass[ind]*mass_frac[ind]
-            #High densities will have no CIV anyway.
-            den[np.where(den > 1e4)] = 9999.
-            den[np.where(den < 1e-7)] = 1.01e-7
-            temp[np.where(temp > 3e8)] = 3e8
-            temp[np.where(temp < 1e3)] = 1e3
-            mass *= self.cloudy_table.ion("C", self.ion, den[ind], temp[ind])
-            smooth = hsml.get_smooth_length(bar)[ind]
-            ipos = ipos[ind,:][0]
-            [self.sub_gridize_single_file(ii,ipos,smooth,mass,self.sub_nHI_grid) for ii in xrange(0,self.nhalo)]
-            f.close()
-            #Explicitly delete some things.
-            del ipos
-            del mass
-            del smooth
+        decode = lambda bar: self._read_CIV_chunk(bar, star)
+        grid_chunk = lambda data, grids: self.gridize_single_file(data[0], data[1], data[2], grids)
+        if self.nproc > 1:
+            parallel_ingest.ingest_files(decode, grid_chunk, files, list(self.sub_nHI_grid), self.tmpfile, self.nproc, start, end)
+        else:
+            for (nfile, data) in chunk_reader.prefetch_chunks(files[start:end], 0, decode):
+                if data is not None:
+                    grid_chunk(data, self.sub_nHI_grid)
+            self.flush_tiles()
         #Deal with zeros: 0.1 will not even register for things at 1e17.
         #Also fix the units:
         #we calculated things in internal gadget /cell and we want atoms/cm^2
@@ -404,6 +361,29 @@ class BoxCIV(bi.BoxHI):
             np.log10(self.sub_nHI_grid[ii],self.sub_nHI_grid[ii])
         return
 
+    def _read_CIV_chunk(self, bar, star):
+        """Get the positions, smoothing lengths and ion masses of a block of particles.
+        Returns (ipos, smooth, mass)"""
+        ipos=bar["Coordinates"]
+        #Get HI mass in internal units
+        mass=np.array(bar["Masses"])
+        #Carbon mass fraction
+        den = self._derived(bar, "RahmatiRT_rhoH", star.get_code_rhoH)
+        temp = self._derived(bar, "RahmatiRT_temp", star.get_temp)
+        mass_frac = np.array(bar["GFM_Metals"][:,2])
+        #Floor on the mass fraction of the metal
+        ind = np.where(mass_frac > 1e-10)
+        mass = mass[ind]*mass_frac[ind]
+        #High densities will have no CIV anyway.
+        den[np.where(den > 1e4)] = 9999.
+        den[np.where(den < 1e-7)] = 1.01e-7
+        temp[np.where(temp > 3e8)] = 3e8
+        temp[np.where(temp < 1e3)] = 1e3
+        mass *= self.cloudy_table.ion("C", self.ion, den[ind], temp[ind])
+        smooth = self._derived(bar, "hsml", hsml.get_smooth_length)[ind]
+        ipos = ipos[ind,:][0]
+        return (ipos, smooth, mass)
+
     def _rho_DLA(self, thresh=14, upthresh=50.):
         """Find the average density in DLAs in g/cm^3 (comoving). Helper for omega_DLA and rho_DLA."""
         #Average column density of HI in atoms cm^-2 (physical)
@@ -411,11 +391,14 @@ class BoxCIV(bi.BoxHI):
             self.sub_nHI_grid
         except AttributeError:
             self.load_hi_grid()
-        if thresh > 0:
-            grids=self.sub_nHI_grid
-            HImass = np.sum(10**grids[np.where((grids < upthresh)*(grids > thresh))])/np.size(grids)
-        else:
-            HImass = np.mean(10**self.sub_nHI_grid)
+        #Sum one slab at a time
+        HImass = 0
+        for grid in self.sub_nHI_grid:
+            if thresh > 0:
+                HImass += np.sum(10**grid[np.where((grid < upthresh)*(grid > thresh))])
+            else:
+                HImass += np.sum(10**grid)
+        HImass /= np.size(self.sub_nHI_grid)
         #Avg. Column density of HI in g cm^-2 (comoving)
         HImass = 12.011*self.protonmass * HImass/(1+self.redshift)**2
         #Length of column in comoving cm
@@ -425,9 +408,9 @@ class BoxCIV(bi.BoxHI):
 
 class HaloCIV(hi.HaloHI, BoxCIV):
     """Plots of the CIV around a single halo"""
-    def __init__(self,snap_dir,snapnum,minpart=400,ion=4,reload_file=True, savefile=None, start=0, end=3000):
+    def __init__(self,snap_dir,snapnum,minpart=400,ion=4,reload_file=True, savefile=None, start=0, end=3000, nproc=1):
         self.ion=ion
-        hi.HaloHI.__init__(self,snap_dir,snapnum,minpart=minpart,reload_file=reload_file,savefile=savefile, gas=False, molec=True, start=start, end = end)
+        hi.HaloHI.__init__(self,snap_dir,snapnum,minpart=minpart,reload_file=reload_file,savefile=savefile, gas=False, molec=True, start=start, end = end, nproc=nproc)
 
     def set_nHI_grid(self, gas=False, start=0):
         return BoxCIV.set_nHI_grid(self,gas,start)
@@ -0,0 +1,16 @@
+"""Merge the grids from several BoxHI runs over different ranges of snapshot files, and save the result.
+Each run should have been started with a different start (and end), eg from make_all_grids.pl.
+
+Usage: python merge_grids.py snap_dir snapnum nslice ngrid start1 [start2 ...]
+"""
+import sys
+import boxhi
+
+snap_dir=sys.argv[1]
+snapnum=int(sys.argv[2])
+nslice=int(sys.argv[3])
+ngrid=int(sys.argv[4])
+starts=[int(start) for start in sys.argv[5:]]
+
+ahalo=boxhi.BoxHI(snap_dir,snapnum, reload_file=True, nslice=nslice, ngrid=ngrid, memmap=True, merge=starts)
+ahalo.save_file()
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""Grid a set of snapshot files in parallel, using a pool of worker processes.
+
+Each worker grids a subset of the files onto a private partial grid,
+which it periodically checkpoints to disk together with the list of files it contains (see checkpoint).
+When all workers have finished, the partial grids are summed into the final grid.
+
+The lists of files stored with each partial grid form a completion ledger:
+a restarted run reads them, only grids the files not yet included anywhere,
+and then sums the old partial grids with the new ones.
+
+Note that the workers are forked from the calling process, so they inherit the object doing the gridding.
+If the calling process has already run an OpenMP region, some OpenMP runtimes will deadlock in the children.
+"""
+import glob
+import os
+import multiprocessing
+import numpy as np
+import chunk_reader
+import checkpoint
+
+#State shared with the worker processes. This is inherited when they are forked, so is never pickled.
+_worker_state = {}
+
+def completed_files(tmpbase):
+    """Read the completion ledger for a set of partial grids.
+    Returns a dictionary mapping each partial grid to the snapshot files it contains."""
+    ledger = {}
+    parts = set([ckpt.rsplit(".ckpt",1)[0] for ckpt in glob.glob(tmpbase+".part*.ckpt*")])
+    for part in parts:
+        #The ledger entry is saved with each checkpoint, so is consistent with the grid restored from it
+        files = checkpoint.TileCheckpointer(part, []).latest_state()
+        if files is not None:
+            ledger[part] = list(files)
+    return ledger
+
+def _ingest_worker(filenums):
+    """Grid a list of files onto a private partial grid. Runs in a worker process."""
+    decode = _worker_state["decode"]
+    grid_chunk = _worker_state["grid_chunk"]
+    files = _worker_state["files"]
+    interval = _worker_state["interval"]
+    #Name the partial grid after its first file, which is never in an earlier partial grid
+    partfile = _worker_state["tmpbase"]+".part"+str(filenums[0])
+    if _worker_state["memmap"]:
+        #The grid we are adding to is on disk, so keep the partial grid on disk as well
+        gridfiles = [partfile+".grid"+str(i) for i in xrange(len(_worker_state["shapes"]))]
+        grids = [np.memmap(gridfiles[i], dtype=dtype, mode='w+', shape=shape) for (i, (shape, dtype)) in enumerate(_worker_state["shapes"])]
+    else:
+        gridfiles = []
+        grids = [np.zeros(shape, dtype=dtype) for (shape, dtype) in _worker_state["shapes"]]
+    ckpt = checkpoint.TileCheckpointer(partfile, grids, interval)
+    done = []
+    for (nfile, data) in chunk_reader.prefetch_chunks([files[xx] for xx in filenums], _worker_state["ptype"], decode):
+        if data is not None:
+            grid_chunk(data, grids)
+            continue
+        done.append(filenums[nfile])
+        ckpt.save(done, force=(nfile == len(filenums)-1))
+    ckpt.wait()
+    del ckpt
+    del grids
+    for gridfile in gridfiles:
+        os.remove(gridfile)
+    return partfile
+
+def add_partial(partfile, grids):
+    """Add a partial grid from disk to the list of arrays grids, one array at a time"""
+    checkpoint.TileCheckpointer(partfile, grids).restore(add=True)
+
+def ingest_files(decode, grid_chunk, files, grids, tmpbase, nproc, start=0, end=None, interval=600, ptype=0):
+    """Grid the snapshot files files[start:end] onto grids using nproc worker processes.
+    Arguments:
+        decode - Function called as decode(bar) on each block of particles (see chunk_reader.prefetch_chunks),
+                 returning the data to grid. Each worker runs this in a background thread.
+        grid_chunk - Function called as grid_chunk(data, grids), which adds the data returned by decode
+                     to a list of arrays shaped like grids.
+        files - List of snapshot files
+        grids - List of arrays to add the gridded files to.
+                If these are np.memmaps, the partial grids of the workers are np.memmaps as well.
+        tmpbase - Partial grids are saved to tmpbase.part*
+        nproc - Number of worker processes
+        interval - Time in seconds between checkpoints of each partial grid
+        ptype - Particle type to read
+    Files already in a partial grid from an earlier run are not gridded again.
+    """
+    if end == None:
+        end = np.size(files)
+    ledger = completed_files(tmpbase)
+    done = set()
+    for part in ledger.keys():
+        done.update(ledger[part])
+    todo = [xx for xx in xrange(start, end) if xx not in done]
+    print "Gridding ",len(todo)," files with ",nproc," processes. ",len(done)," files already done."
+    #Deal files out round-robin so that each worker gets a similar mix of file sizes
+    groups = [todo[i::nproc] for i in xrange(nproc) if len(todo[i::nproc]) > 0]
+    parts = ledger.keys()
+    if len(groups) > 0:
+        _worker_state.update({"decode":decode, "grid_chunk":grid_chunk, "ptype":ptype, "files":files, "interval":interval, "tmpbase":tmpbase,
+                              "shapes":[(np.shape(grid),grid.dtype) for grid in grids],
+                              "memmap":isinstance(grids[0], np.memmap)})
+        pool = multiprocessing.Pool(len(groups))
+        try:
+            parts += pool.map(_ingest_worker, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            _worker_state.clear()
+    for part in parts:
+        add_partial(part, grids)
+    return
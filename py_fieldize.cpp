@@ -10,15 +10,31 @@ int check_type(PyArrayObject * arr, int npy_typename)
   return !PyArray_EquivTypes(PyArray_DESCR(arr), PyArray_DescrFromType(npy_typename));
 }
 
-//  int    3*nval arr  nval arr  nval arr   nx*nx arr  int     nval arr  (or 0)
-//['nval','pos',     'radii',    'value',   'field',   'nx',    'weights']
+/*Interpolate the particles onto a field of type F with nchan channels, adding to what is already there.
+ Returns 1 if a massless particle was found. Throws std::bad_alloc if memory for the deposit cannot be allocated.*/
+template <typename F> int sph_fieldize_into(F * field, const int nx, const int nchan, const int periodic, const int box, PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_intp nval)
+{
+#ifdef NO_KAHAN
+    SimpleSummer<F> sum(field, nx);
+    SphInterp<SimpleSummer<F> > worker(sum, nx, periodic, box);
+#else
+    KahanSummer<F> sum(field, nx, nchan);
+    SphInterp<KahanSummer<F> > worker(sum, nx, periodic, box);
+#endif
+    return worker.do_work(pos, radii, value, weights, nval);
+}
+
+//  nx*nx arr  3*nval arr  nval arr  nval arr   nval arr (or 0)  int         int (optional)
+//['field',    'pos',      'radii',  'value',   'weights',       'periodic', 'box']
+//For K channels, field is K*nx*nx and value nval*K
 extern "C" PyObject * Py_SPH_Fieldize(PyObject *self, PyObject *args)
 {
-    PyArrayObject *pos, *radii, *value, *weights;
-    int periodic, nx, ret;
-    if(!PyArg_ParseTuple(args, "O!O!O!O!ii",&PyArray_Type, &pos, &PyArray_Type, &radii, &PyArray_Type, &value, &PyArray_Type, &weights,&periodic, &nx) )
+    PyArrayObject *pyfield, *pos, *radii, *value, *weights;
+    int periodic, ret;
+    int box = 0;
+    if(!PyArg_ParseTuple(args, "O!O!O!O!O!i|i",&PyArray_Type, &pyfield, &PyArray_Type, &pos, &PyArray_Type, &radii, &PyArray_Type, &value, &PyArray_Type, &weights,&periodic, &box) )
     {
-        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use pos, radii, value, weights periodic=False, nx\n");
+        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use field, pos, radii, value, weights, periodic=False, box=False\n");
         return NULL;
     }
     if(check_type(pos, NPY_FLOAT) || check_type(radii, NPY_FLOAT) || check_type(value, NPY_FLOAT) || check_type(weights, NPY_DOUBLE))
@@ -26,89 +42,679 @@ extern "C" PyObject * Py_SPH_Fieldize(PyObject *self, PyObject *args)
           PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: pos, radii and value need float32, weights float64.\n");
           return NULL;
     }
+    if(check_type(pyfield, NPY_FLOAT) && check_type(pyfield, NPY_DOUBLE))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Field must be float32 or float64.\n");
+          return NULL;
+    }
+    //We add to the field directly, so it must be one writeable block of memory
+    const int fdim = PyArray_NDIM(pyfield);
+    if((fdim != 2 && fdim != 3) || PyArray_DIM(pyfield,fdim-2) != PyArray_DIM(pyfield,fdim-1) || !PyArray_ISCARRAY(pyfield))
+    {
+          PyErr_SetString(PyExc_ValueError, "Field must be a square, C-contiguous, writeable 2D array, or a 3D array of them.\n");
+          return NULL;
+    }
+    //One channel of the field for each column of value
+    const int nchan = fdim == 3 ? PyArray_DIM(pyfield,0) : 1;
+    if(PyArray_NDIM(value) != fdim-1 || (fdim == 3 && PyArray_DIM(value,1) != nchan))
+    {
+          PyErr_SetString(PyExc_ValueError, "value must be 1D for a 2D field, or have a column for each channel of a 3D field.\n");
+          return NULL;
+    }
     const npy_intp nval = PyArray_DIM(radii,0);
     if(nval != PyArray_DIM(value,0) || nval != PyArray_DIM(pos,0))
     {
       PyErr_SetString(PyExc_ValueError, "pos, radii and value should have the same length.\n");
       return NULL;
     }
-//     int totlow=0, tothigh=0;
-    //Field for the output.
-    npy_intp size[2]={nx,nx};
-    PyArrayObject * pyfield = (PyArrayObject *) PyArray_SimpleNew(2, size, NPY_DOUBLE);
-    PyArray_FILLWBYTE(pyfield, 0);
-    double * field = (double *) PyArray_DATA(pyfield);
-    //Copy of field array to store compensated bits for Kahan summation
-    if( !field ){
-      PyErr_SetString(PyExc_MemoryError, "Passed a null field array!.\n");
+    const int nx = PyArray_DIM(pyfield,fdim-1);
+    const bool is_double = !check_type(pyfield, NPY_DOUBLE);
+    bool bad_alloc = false;
+    //Do the work. We touch no python objects, so let other threads (eg, a prefetching reader) run.
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        if(is_double)
+            ret = sph_fieldize_into((double *) PyArray_DATA(pyfield), nx, nchan, periodic, box, pos, radii, value, weights, nval);
+        else
+            ret = sph_fieldize_into((float *) PyArray_DATA(pyfield), nx, nchan, periodic, box, pos, radii, value, weights, nval);
+    }
+    catch (std::bad_alloc &) {
+        bad_alloc = true;
+    }
+    Py_END_ALLOW_THREADS
+    if( bad_alloc ){
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the deposit!\n");
+      return NULL;
+    }
+    if( ret == 1 ){
+      PyErr_SetString(PyExc_ValueError, "Massless particle detected!");
       return NULL;
     }
-    //Do the work
+    Py_RETURN_NONE;
+}
+
+/*Interpolate the particles onto a tile of the grid, adding to what is already there. See TileSummer.*/
+template <typename F> int sph_fieldize_tile(F * field, const int nx, const int tnx, const int tny, const int x0, const int y0, const int periodic, PyArrayObject *pos, PyArrayObject *radii, PyArrayObject *value, PyArrayObject *weights, const npy_intp nval)
+{
+    TileSummer<F> sum(field, tnx, tny, x0, y0);
+    SphInterp<TileSummer<F> > worker(sum, nx, periodic);
+    return worker.do_work(pos, radii, value, weights, nval);
+}
+
+//  tnx*tny arr  3*nval arr  nval arr  nval arr  nval arr (or 0)  int         int  int  int
+//['field',      'pos',      'radii',  'value',  'weights',       'periodic', 'nx', 'x0', 'y0']
+extern "C" PyObject * Py_SPH_Fieldize_Tile(PyObject *self, PyObject *args)
+{
+    PyArrayObject *pyfield, *pos, *radii, *value, *weights;
+    int periodic, nx, x0, y0, ret;
+    if(!PyArg_ParseTuple(args, "O!O!O!O!O!iiii",&PyArray_Type, &pyfield, &PyArray_Type, &pos, &PyArray_Type, &radii, &PyArray_Type, &value, &PyArray_Type, &weights,&periodic, &nx, &x0, &y0) )
+    {
+        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use field, pos, radii, value, weights, periodic=False, nx, x0, y0\n");
+        return NULL;
+    }
+    if(check_type(pos, NPY_FLOAT) || check_type(radii, NPY_FLOAT) || check_type(value, NPY_FLOAT) || check_type(weights, NPY_DOUBLE))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: pos, radii and value need float32, weights float64.\n");
+          return NULL;
+    }
+    if(check_type(pyfield, NPY_FLOAT) && check_type(pyfield, NPY_DOUBLE))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Field must be float32 or float64.\n");
+          return NULL;
+    }
+    if(PyArray_NDIM(pyfield) != 2 || !PyArray_ISCARRAY(pyfield) || PyArray_NDIM(value) != 1)
+    {
+          PyErr_SetString(PyExc_ValueError, "Field must be a C-contiguous, writeable 2D array, and value 1D.\n");
+          return NULL;
+    }
+    const npy_intp nval = PyArray_DIM(radii,0);
+    if(nval != PyArray_DIM(value,0) || nval != PyArray_DIM(pos,0))
+    {
+      PyErr_SetString(PyExc_ValueError, "pos, radii and value should have the same length.\n");
+      return NULL;
+    }
+    const int tnx = PyArray_DIM(pyfield,0);
+    const int tny = PyArray_DIM(pyfield,1);
+    const bool is_double = !check_type(pyfield, NPY_DOUBLE);
+    bool bad_alloc = false;
+    //Do the work, letting other threads run
+    Py_BEGIN_ALLOW_THREADS
     try {
-#ifdef NO_KAHAN
-        SimpleSummer sum(field, nx);
-        SphInterp<SimpleSummer> worker(sum, nx, periodic);
-#else
-        KahanSummer sum(field, nx);
-        SphInterp<KahanSummer> worker(sum, nx, periodic);
-#endif
-        ret = worker.do_work(pos, radii, value, weights, nval);
+        if(is_double)
+            ret = sph_fieldize_tile((double *) PyArray_DATA(pyfield), nx, tnx, tny, x0, y0, periodic, pos, radii, value, weights, nval);
+        else
+            ret = sph_fieldize_tile((float *) PyArray_DATA(pyfield), nx, tnx, tny, x0, y0, periodic, pos, radii, value, weights, nval);
     }
     catch (std::bad_alloc &) {
-      PyErr_SetString(PyExc_MemoryError, "Could not allocate Kahan compensation array!\n");
+        bad_alloc = true;
+    }
+    Py_END_ALLOW_THREADS
+    if( bad_alloc ){
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the deposit!\n");
       return NULL;
     }
     if( ret == 1 ){
       PyErr_SetString(PyExc_ValueError, "Massless particle detected!");
       return NULL;
     }
-    //printf("Total high: %d total low: %d (%ld)\n",tothigh, totlow,nval);
-    PyObject * for_return = Py_BuildValue("O",pyfield);
-    Py_DECREF(pyfield);
-    return for_return;
+    Py_RETURN_NONE;
+}
+
+//  nx*nx*nx arr  3*nval arr  nval arr  nval arr  nval arr (or 0)  int
+//['field',       'pos',      'radii',  'value',  'weights',       'periodic']
+extern "C" PyObject * Py_SPH_Fieldize_3D(PyObject *self, PyObject *args)
+{
+    PyArrayObject *pyfield, *pos, *radii, *value, *weights;
+    int periodic, ret;
+    if(!PyArg_ParseTuple(args, "O!O!O!O!O!i",&PyArray_Type, &pyfield, &PyArray_Type, &pos, &PyArray_Type, &radii, &PyArray_Type, &value, &PyArray_Type, &weights,&periodic) )
+    {
+        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use field, pos, radii, value, weights, periodic=False\n");
+        return NULL;
+    }
+    if(check_type(pos, NPY_FLOAT) || check_type(radii, NPY_FLOAT) || check_type(value, NPY_FLOAT) || check_type(weights, NPY_DOUBLE))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: pos, radii and value need float32, weights float64.\n");
+          return NULL;
+    }
+    if(check_type(pyfield, NPY_FLOAT) && check_type(pyfield, NPY_DOUBLE))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Field must be float32 or float64.\n");
+          return NULL;
+    }
+    if(PyArray_NDIM(pyfield) != 3 || PyArray_DIM(pyfield,1) != PyArray_DIM(pyfield,0) || PyArray_DIM(pyfield,2) != PyArray_DIM(pyfield,0) || !PyArray_ISCARRAY(pyfield))
+    {
+          PyErr_SetString(PyExc_ValueError, "Field must be a cubic, C-contiguous, writeable 3D array.\n");
+          return NULL;
+    }
+    if(PyArray_NDIM(pos) != 2 || PyArray_DIM(pos,1) != 3 || PyArray_NDIM(value) != 1)
+    {
+          PyErr_SetString(PyExc_ValueError, "pos must have three columns, and value be 1D.\n");
+          return NULL;
+    }
+    const npy_intp nval = PyArray_DIM(radii,0);
+    if(nval != PyArray_DIM(value,0) || nval != PyArray_DIM(pos,0))
+    {
+      PyErr_SetString(PyExc_ValueError, "pos, radii and value should have the same length.\n");
+      return NULL;
+    }
+    const int nx = PyArray_DIM(pyfield,0);
+    const bool is_double = !check_type(pyfield, NPY_DOUBLE);
+    init_kernel_table_3d();
+    bool bad_alloc = false;
+    //Do the work, letting other threads run
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        if(is_double){
+            SphInterp3D<double> worker((double *) PyArray_DATA(pyfield), nx, periodic);
+            ret = worker.do_work(pos, radii, value, weights, nval);
+        }
+        else{
+            SphInterp3D<float> worker((float *) PyArray_DATA(pyfield), nx, periodic);
+            ret = worker.do_work(pos, radii, value, weights, nval);
+        }
+    }
+    catch (std::bad_alloc &) {
+        bad_alloc = true;
+    }
+    Py_END_ALLOW_THREADS
+    if( bad_alloc ){
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the deposit!\n");
+      return NULL;
+    }
+    if( ret == 1 ){
+      PyErr_SetString(PyExc_ValueError, "Massless particle detected!");
+      return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/*Find the particles whose smoothing sphere reaches the cube of half-width sub_radii about each halo centre,
+ allowing for periodic wrapping. The particles are sorted into cells about the size of a typical halo,
+ and only the cells within reach of each halo are searched.
+ How far a halo must search depends on the smoothing lengths of the particles, and a few diffuse
+ particles can have very large ones. So the particles are split into levels by smoothing length,
+ each with its own cell list, cells twice as large on each level as on the one below.
+ A level is searched out to the largest smoothing length it holds, so large particles only widen
+ the search on their own, coarse, level.
+ On return, near[j] lists the particles near halo j.*/
+void find_halo_particles(const float * pos, const float * smooth, const npy_intp npart, const double * cofm, const double * sub_radii, const int nhalo, const double box, std::vector<std::vector<npy_intp> >& near)
+{
+    std::vector<double> radii(sub_radii, sub_radii+nhalo);
+    std::nth_element(radii.begin(), radii.begin()+nhalo/2, radii.end());
+    //Do not use more cells than we have particles
+    const double maxcell = std::max(1., ceil(pow(npart, 1./3)));
+    const int ncell0 = std::max(1., std::min(std::min(floor(box/radii[nhalo/2]), maxcell), 256.));
+    //Number of cells along each side on each level, halving until there is one
+    std::vector<int> ncell(1, ncell0);
+    while(ncell.back() > 1)
+        ncell.push_back(ncell.back()/2);
+    const int nlevel = ncell.size();
+    //Each particle goes on the lowest level whose cells are at least as large as its smoothing length
+    std::vector<int> level(npart);
+    std::vector<double> maxsmooth(nlevel, 0);
+    for(npy_intp p=0; p < npart; p++){
+        int l = 0;
+        while(l < nlevel-1 && smooth[p] > box/ncell[l])
+            l++;
+        level[p] = l;
+        maxsmooth[l] = std::max(maxsmooth[l], (double) smooth[p]);
+    }
+    //Sort the particles by level, then by cell within the level
+    std::vector<npy_intp> first(nlevel+1, 0);
+    for(int l=0; l < nlevel; l++)
+        first[l+1] = first[l] + (npy_intp) ncell[l]*ncell[l]*ncell[l];
+    std::vector<npy_intp> cell(npart);
+    std::vector<npy_intp> start(first[nlevel]+1, 0);
+    for(npy_intp p=0; p < npart; p++){
+        const int nc = ncell[level[p]];
+        npy_intp cc = 0;
+        for(int d=0; d < 3; d++){
+            int ci = ((int) floor(pos[3*p+d]/(box/nc))) % nc;
+            if(ci < 0)
+                ci += nc;
+            cc = cc*nc + ci;
+        }
+        cell[p] = first[level[p]] + cc;
+        start[cell[p]+1]++;
+    }
+    for(npy_intp c=0; c < first[nlevel]; c++)
+        start[c+1] += start[c];
+    std::vector<npy_intp> order(npart);
+    {
+        std::vector<npy_intp> next(start.begin(), start.end()-1);
+        for(npy_intp p=0; p < npart; p++)
+            order[next[cell[p]]++] = p;
+    }
+    near.assign(nhalo, std::vector<npy_intp>());
+    int alloc_failed = 0;
+    #pragma omp parallel for schedule(dynamic) reduction(|:alloc_failed)
+    for(int j=0; j < nhalo; j++){
+        //An exception must not leave the parallel region: pass it on afterwards
+        try {
+            for(int l=0; l < nlevel; l++){
+                if(start[first[l+1]] == start[first[l]])
+                    continue;
+                const int nc = ncell[l];
+                const double cellsize = box/nc;
+                //The cells within reach of the halo along each axis, wrapped periodically
+                std::vector<int> range[3];
+                for(int d=0; d < 3; d++){
+                    const double reach = sub_radii[j] + maxsmooth[l];
+                    const int low = floor((cofm[3*j+d]-reach)/cellsize);
+                    const int up = floor((cofm[3*j+d]+reach)/cellsize);
+                    if(up - low + 1 >= nc)
+                        for(int c=0; c < nc; c++)
+                            range[d].push_back(c);
+                    else
+                        for(int c=low; c <= up; c++)
+                            range[d].push_back(((c % nc) + nc) % nc);
+                }
+                for(size_t cx=0; cx < range[0].size(); cx++)
+                for(size_t cy=0; cy < range[1].size(); cy++)
+                for(size_t cz=0; cz < range[2].size(); cz++){
+                    const npy_intp cc = first[l] + ((npy_intp) range[0][cx]*nc + range[1][cy])*nc + range[2][cz];
+                    for(npy_intp i=start[cc]; i < start[cc+1]; i++){
+                        const npy_intp p = order[i];
+                        bool close = true;
+                        for(int d=0; d < 3 && close; d++){
+                            //Distance to the nearest periodic image
+                            double dist = pos[3*p+d] - cofm[3*j+d];
+                            dist -= box*rint(dist/box);
+                            close = fabs(dist) < sub_radii[j] + smooth[p];
+                        }
+                        if(close)
+                            near[j].push_back(p);
+                    }
+                }
+            }
+            //Deposit in file order, whatever level the particles came from
+            std::sort(near[j].begin(), near[j].end());
+        }
+        catch (std::bad_alloc &) {
+            alloc_failed = 1;
+        }
+    }
+    if(alloc_failed)
+        throw std::bad_alloc();
+}
+
+//  list of nhalo arrs  npart*3 arr  npart arr  npart arr  nhalo*3 arr  nhalo arr    double
+//['fields',            'pos',       'smooth',  'value',   'cofm',      'sub_radii', 'box']
+extern "C" PyObject * Py_SPH_Fieldize_Halos(PyObject *self, PyObject *args)
+{
+    PyObject *pyfields;
+    PyArrayObject *pos, *smooth, *value, *cofm, *sub_radii;
+    double box;
+    if(!PyArg_ParseTuple(args, "OO!O!O!O!O!d",&pyfields, &PyArray_Type, &pos, &PyArray_Type, &smooth, &PyArray_Type, &value, &PyArray_Type, &cofm, &PyArray_Type, &sub_radii, &box) )
+    {
+        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use fields, pos, smooth, value, cofm, sub_radii, box\n");
+        return NULL;
+    }
+    if(check_type(pos, NPY_FLOAT) || check_type(smooth, NPY_FLOAT) || check_type(value, NPY_FLOAT) || check_type(cofm, NPY_DOUBLE) || check_type(sub_radii, NPY_DOUBLE))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: pos, smooth and value need float32, cofm and sub_radii float64.\n");
+          return NULL;
+    }
+    if(!PyArray_ISCARRAY_RO(pos) || !PyArray_ISCARRAY_RO(smooth) || !PyArray_ISCARRAY_RO(cofm) || !PyArray_ISCARRAY_RO(sub_radii)
+        || PyArray_NDIM(pos) != 2 || PyArray_DIM(pos,1) != 3 || PyArray_NDIM(cofm) != 2 || PyArray_DIM(cofm,1) != 3)
+    {
+          PyErr_SetString(PyExc_ValueError, "pos and cofm must be C-contiguous N x 3 arrays, and smooth and sub_radii C-contiguous.\n");
+          return NULL;
+    }
+    const npy_intp npart = PyArray_DIM(pos,0);
+    if(npart != PyArray_DIM(smooth,0) || npart != PyArray_DIM(value,0) || PyArray_NDIM(value) != 1)
+    {
+      PyErr_SetString(PyExc_ValueError, "pos, smooth and value should have the same length.\n");
+      return NULL;
+    }
+    const int nhalo = PyArray_DIM(cofm,0);
+    PyObject * fields = PySequence_Fast(pyfields, "fields should be a sequence of arrays, one for each halo.\n");
+    if( !fields )
+        return NULL;
+    if(PySequence_Fast_GET_SIZE(fields) != nhalo || PyArray_SIZE(sub_radii) != nhalo)
+    {
+      Py_DECREF(fields);
+      PyErr_SetString(PyExc_ValueError, "Need one field and one radius for each halo.\n");
+      return NULL;
+    }
+    for(int j=0; j < nhalo; j++){
+        PyObject * field = PySequence_Fast_GET_ITEM(fields, j);
+        if(!PyArray_Check(field) || PyArray_NDIM((PyArrayObject *) field) != 2 || PyArray_DIM((PyArrayObject *) field,0) != PyArray_DIM((PyArrayObject *) field,1)
+            || !PyArray_ISCARRAY((PyArrayObject *) field) || (check_type((PyArrayObject *) field, NPY_FLOAT) && check_type((PyArrayObject *) field, NPY_DOUBLE)))
+        {
+          Py_DECREF(fields);
+          PyErr_SetString(PyExc_ValueError, "Each field must be a square, C-contiguous, writeable float32 or float64 2D array.\n");
+          return NULL;
+        }
+    }
+    std::vector<std::vector<npy_intp> > near;
+    bool bad_alloc = false;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        find_halo_particles((float *) PyArray_DATA(pos), (float *) PyArray_DATA(smooth), npart, (double *) PyArray_DATA(cofm), (double *) PyArray_DATA(sub_radii), nhalo, box, near);
+    }
+    catch (std::bad_alloc &) {
+        bad_alloc = true;
+    }
+    Py_END_ALLOW_THREADS
+    if( bad_alloc ){
+      Py_DECREF(fields);
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate list of particles near halos!\n");
+      return NULL;
+    }
+    //Field of each halo
+    std::vector<void *> fdata(nhalo);
+    std::vector<int> ngrid(nhalo);
+    std::vector<char> is_double(nhalo);
+    for(int j=0; j < nhalo; j++){
+        PyArrayObject * field = (PyArrayObject *) PySequence_Fast_GET_ITEM(fields, j);
+        fdata[j] = PyArray_DATA(field);
+        ngrid[j] = PyArray_DIM(field,0);
+        is_double[j] = !check_type(field, NPY_DOUBLE);
+    }
+    //Particles near each halo, in the grid units of that halo, as for _SPH_Fieldize
+    std::vector<PyArrayObject *> hpos(nhalo, (PyArrayObject *) NULL), hradii(nhalo, (PyArrayObject *) NULL), hvalue(nhalo, (PyArrayObject *) NULL);
+    npy_intp one = 1;
+    PyArrayObject * weights = (PyArrayObject *) PyArray_ZEROS(1, &one, NPY_DOUBLE, 0);
+    bool failed = !weights;
+    for(int j=0; j < nhalo && !failed; j++){
+        npy_intp dims[2] = {(npy_intp) near[j].size(), 3};
+        if(dims[0] == 0)
+            continue;
+        hpos[j] = (PyArrayObject *) PyArray_SimpleNew(2, dims, NPY_FLOAT);
+        hradii[j] = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_FLOAT);
+        hvalue[j] = (PyArrayObject *) PyArray_SimpleNew(1, dims, NPY_FLOAT);
+        failed = !hpos[j] || !hradii[j] || !hvalue[j];
+    }
+    int ret = 0;
+    int alloc_failed = 0;
+    if( !failed ){
+        const float * ppos = (float *) PyArray_DATA(pos);
+        const float * psmooth = (float *) PyArray_DATA(smooth);
+        const double * pcofm = (double *) PyArray_DATA(cofm);
+        const double * pradii = (double *) PyArray_DATA(sub_radii);
+        //Each halo has its own field, so the halos can be done in parallel.
+        //The deposit onto each is then serial, as nested parallelism is off.
+        Py_BEGIN_ALLOW_THREADS
+        #pragma omp parallel for schedule(dynamic) reduction(|:ret,alloc_failed)
+        for(int j=0; j < nhalo; j++){
+            const npy_intp nval = near[j].size();
+            if(nval == 0)
+                continue;
+            float * hp = (float *) PyArray_DATA(hpos[j]);
+            float * hr = (float *) PyArray_DATA(hradii[j]);
+            float * hv = (float *) PyArray_DATA(hvalue[j]);
+            //As fieldize.convert_centered for positions, and HaloHI._convert_interp_units for smoothing lengths,
+            //including their single precision arithmetic
+            const float hscale = ngrid[j]/(2*pradii[j]);
+            for(npy_intp i=0; i < nval; i++){
+                const npy_intp p = near[j][i];
+                for(int d=0; d < 3; d++){
+                    //Nearest periodic image of the particle
+                    const float image = ppos[3*p+d] - box*rint((ppos[3*p+d] - pcofm[3*j+d])/box);
+                    const float dist = image - (float) pcofm[3*j+d];
+                    hp[3*i+d] = dist*(float) (ngrid[j]-1.)/(float) (2*pradii[j]) + (float) ((ngrid[j]-1.)/2.);
+                }
+                hr[i] = psmooth[p]*hscale;
+                hv[i] = *(float *) PyArray_GETPTR1(value, p);
+            }
+            try {
+                if(is_double[j])
+                    ret |= sph_fieldize_into((double *) fdata[j], ngrid[j], 1, 0, 0, hpos[j], hradii[j], hvalue[j], weights, nval);
+                else
+                    ret |= sph_fieldize_into((float *) fdata[j], ngrid[j], 1, 0, 0, hpos[j], hradii[j], hvalue[j], weights, nval);
+            }
+            catch (std::bad_alloc &) {
+                alloc_failed = 1;
+            }
+        }
+        Py_END_ALLOW_THREADS
+    }
+    for(int j=0; j < nhalo; j++){
+        Py_XDECREF(hpos[j]);
+        Py_XDECREF(hradii[j]);
+        Py_XDECREF(hvalue[j]);
+    }
+    Py_XDECREF(weights);
+    Py_DECREF(fields);
+    if( failed ){
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate particle arrays for halos!\n");
+      return NULL;
+    }
+    if( alloc_failed ){
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the deposit!\n");
+      return NULL;
+    }
+    if( ret == 1 ){
+      PyErr_SetString(PyExc_ValueError, "Massless particle detected!");
+      return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+/*Add each sample to the npts^dim grid points around it, for ngp, cic and tsc.
+ kk and ww are npts x nval x dim arrays: sample p goes to the grid points (kk[a0][p][0], kk[a1][p][1], ...)
+ with weight ww[a0][p][0]*ww[a1][p][1]*..., for every choice of a0, a1, ... in 0..npts-1.
+ totweight, if not NULL, gets the weights.*/
+template <typename F> void mesh_add(F * field, F * totweight, const npy_intp * shape, const int64_t * kk, const double * ww, const double * value, const npy_intp nval, const int npts, const int dim)
+{
+    //Loop over up to three axes, with the missing ones having a single point of weight 1
+    npy_intp stride[3] = {0,0,0};
+    int npt[3] = {1,1,1};
+    npy_intp s = 1;
+    for(int j=dim-1; j >= 0; j--){
+        stride[j] = s;
+        s *= shape[j];
+        npt[j] = npts;
+    }
+    //Offset between the same axis of a sample for successive points
+    const npy_intp apt = nval*dim;
+    for(npy_intp p=0; p < nval; p++){
+        const int64_t * pkk = kk+p*dim;
+        const double * pww = ww+p*dim;
+        for(int a=0; a < npt[0]; a++){
+            const npy_intp ia = pkk[a*apt]*stride[0];
+            const double wa = pww[a*apt];
+            for(int b=0; b < npt[1]; b++){
+                const npy_intp ib = ia + (dim > 1 ? pkk[b*apt+1]*stride[1] : 0);
+                const double wb = wa * (dim > 1 ? pww[b*apt+1] : 1);
+                for(int c=0; c < npt[2]; c++){
+                    const npy_intp idx = ib + (dim > 2 ? pkk[c*apt+2]*stride[2] : 0);
+                    const double w = wb * (dim > 2 ? pww[c*apt+2] : 1);
+                    field[idx] += w*value[p];
+                    if(totweight)
+                        totweight[idx] += w;
+                }
+            }
+        }
+    }
+}
+
+//  nx*nx(*nx) arr  same or None   npts*nval*dim int64 arr  npts*nval*dim arr  nval arr
+//['field',         'totweight',   'kk',                    'ww',              'value']
+extern "C" PyObject * Py_Mesh_Add(PyObject *self, PyObject *args)
+{
+    PyArrayObject *pyfield, *kk, *ww, *value;
+    PyObject *pytotweight;
+    if(!PyArg_ParseTuple(args, "O!OO!O!O!",&PyArray_Type, &pyfield, &pytotweight, &PyArray_Type, &kk, &PyArray_Type, &ww, &PyArray_Type, &value) )
+    {
+        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use field, totweight, kk, ww, value\n");
+        return NULL;
+    }
+    if(check_type(kk, NPY_INT64) || check_type(ww, NPY_DOUBLE) || check_type(value, NPY_DOUBLE) || (check_type(pyfield, NPY_FLOAT) && check_type(pyfield, NPY_DOUBLE)))
+    {
+          PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: field needs float32 or float64, kk int64, ww and value float64.\n");
+          return NULL;
+    }
+    PyArrayObject * totweight = NULL;
+    if(pytotweight != Py_None){
+        if(!PyArray_Check(pytotweight) || !PyArray_SAMESHAPE((PyArrayObject *) pytotweight, pyfield) || !PyArray_EquivTypes(PyArray_DESCR((PyArrayObject *) pytotweight), PyArray_DESCR(pyfield)) || !PyArray_ISCARRAY((PyArrayObject *) pytotweight))
+        {
+          PyErr_SetString(PyExc_ValueError, "totweight must be None, or a C-contiguous writeable array like field.\n");
+          return NULL;
+        }
+        totweight = (PyArrayObject *) pytotweight;
+    }
+    const int dim = PyArray_NDIM(pyfield);
+    if(!PyArray_ISCARRAY(pyfield) || !PyArray_ISCARRAY_RO(kk) || !PyArray_ISCARRAY_RO(ww) || !PyArray_ISCARRAY_RO(value)
+        || dim < 1 || dim > 3 || PyArray_NDIM(kk) != 3 || !PyArray_SAMESHAPE(kk, ww) || PyArray_DIM(kk,2) != dim || PyArray_DIM(kk,1) != PyArray_SIZE(value))
+    {
+          PyErr_SetString(PyExc_ValueError, "field must be a C-contiguous writeable array of 1 to 3 dimensions, and kk and ww C-contiguous npts x nval x dim arrays.\n");
+          return NULL;
+    }
+    const int npts = PyArray_DIM(kk,0);
+    const npy_intp nval = PyArray_DIM(kk,1);
+    const npy_intp * shape = PyArray_DIMS(pyfield);
+    const int64_t * pkk = (int64_t *) PyArray_DATA(kk);
+    for(npy_intp i=0; i < npts*nval; i++)
+        for(int j=0; j < dim; j++)
+            if(pkk[i*dim+j] < 0 || pkk[i*dim+j] >= shape[j])
+            {
+              PyErr_SetString(PyExc_IndexError, "Grid index out of range for field.\n");
+              return NULL;
+            }
+    Py_BEGIN_ALLOW_THREADS
+    if(!check_type(pyfield, NPY_DOUBLE))
+        mesh_add((double *) PyArray_DATA(pyfield), totweight ? (double *) PyArray_DATA(totweight) : (double *) NULL, shape, pkk, (double *) PyArray_DATA(ww), (double *) PyArray_DATA(value), nval, npts, dim);
+    else
+        mesh_add((float *) PyArray_DATA(pyfield), totweight ? (float *) PyArray_DATA(totweight) : (float *) NULL, shape, pkk, (double *) PyArray_DATA(ww), (double *) PyArray_DATA(value), nval, npts, dim);
+    Py_END_ALLOW_THREADS
+    Py_RETURN_NONE;
+}
+
+#define TARGET_INDEX_NAME "_fieldize_priv.TargetIndex"
+
+static void free_target_index(PyObject * capsule)
+{
+    delete (TargetIndex *) PyCapsule_GetPointer(capsule, TARGET_INDEX_NAME);
+}
+
+/*Build a TargetIndex from an int64 array of cell offsets. Returns NULL and sets a Python error on failure.*/
+TargetIndex * make_target_index(PyArrayObject * field_list, const int nx)
+{
+    if(check_type(field_list, NPY_INT64))
+    {
+          PyErr_SetString(PyExc_AttributeError, "field_list needs int64.\n");
+          return NULL;
+    }
+    PyArrayObject * cells = (PyArrayObject *) PyArray_GETCONTIGUOUS(field_list);
+    TargetIndex * index = NULL;
+    Py_BEGIN_ALLOW_THREADS
+    try {
+        index = new TargetIndex((int64_t *) PyArray_DATA(cells), PyArray_SIZE(cells), nx);
+    }
+    catch (std::bad_alloc &) {
+        index = NULL;
+    }
+    Py_END_ALLOW_THREADS
+    Py_DECREF(cells);
+    if( !index )
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate target index!\n");
+    return index;
+}
+
+//  nlist int64 arr   int
+//['field_list',     'nx']
+extern "C" PyObject * Py_Make_Target_Index(PyObject *self, PyObject *args)
+{
+    PyArrayObject *field_list;
+    int nx;
+    if(!PyArg_ParseTuple(args, "O!i",&PyArray_Type, &field_list, &nx) )
+    {
+        PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use field_list, nx\n");
+        return NULL;
+    }
+    TargetIndex * index = make_target_index(field_list, nx);
+    if( !index )
+        return NULL;
+    return PyCapsule_New(index, TARGET_INDEX_NAME, free_target_index);
 }
 
 extern "C" PyObject * Py_Discard_SPH_Fieldize(PyObject *self, PyObject *args)
 {
-    PyArrayObject *pos, *radii, *value, *weights, *field_list;
+    PyArrayObject *pos, *radii, *value, *weights;
+    PyObject *targets;
     int periodic, nx, ret;
-    if(!PyArg_ParseTuple(args, "O!O!O!O!O!ii",&PyArray_Type, &field_list, &PyArray_Type, &pos, &PyArray_Type, &radii, &PyArray_Type, &value, &PyArray_Type, &weights,&periodic, &nx) )
+    if(!PyArg_ParseTuple(args, "OO!O!O!O!ii",&targets, &PyArray_Type, &pos, &PyArray_Type, &radii, &PyArray_Type, &value, &PyArray_Type, &weights,&periodic, &nx) )
     {
         PyErr_SetString(PyExc_AttributeError, "Incorrect arguments: use field_list, pos, radii, value, weights periodic=False, nx\n");
         return NULL;
     }
-    if(check_type(field_list, NPY_INT64) || check_type(pos, NPY_FLOAT) || check_type(radii, NPY_FLOAT) || check_type(value, NPY_FLOAT) || check_type(weights, NPY_DOUBLE))
+    if(check_type(pos, NPY_FLOAT) || check_type(radii, NPY_FLOAT) || check_type(value, NPY_FLOAT) || check_type(weights, NPY_DOUBLE))
     {
-          PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: field_list needs int32, pos, radii and value need float32, weights float64.\n");
+          PyErr_SetString(PyExc_AttributeError, "Input arrays do not have appropriate type: pos, radii and value need float32, weights float64.\n");
           return NULL;
     }
+    if(PyArray_NDIM(value) != 1 && PyArray_NDIM(value) != 2)
+    {
+      PyErr_SetString(PyExc_ValueError, "value should be 1D, or 2D with a column for each quantity.\n");
+      return NULL;
+    }
     const npy_intp nval = PyArray_DIM(radii,0);
     if(nval != PyArray_DIM(value,0) || nval != PyArray_DIM(pos,0))
     {
       PyErr_SetString(PyExc_ValueError, "pos, radii and value should have the same length.\n");
       return NULL;
     }
-    //Field for the output.
-    npy_intp nlist = PyArray_SIZE(field_list);
-    PyArrayObject * pyfield = (PyArrayObject *) PyArray_SimpleNew(1, &nlist, NPY_DOUBLE);
+    //field_list is either an index made by _Make_Target_Index, or an array of cells to index now
+    TargetIndex * index;
+    TargetIndex * owned = NULL;
+    if(PyCapsule_CheckExact(targets)){
+        index = (TargetIndex *) PyCapsule_GetPointer(targets, TARGET_INDEX_NAME);
+        if( !index )
+            return NULL;
+    }
+    else if(PyArray_Check(targets)){
+        index = owned = make_target_index((PyArrayObject *) targets, nx);
+        if( !index )
+            return NULL;
+    }
+    else{
+        PyErr_SetString(PyExc_AttributeError, "field_list should be an int64 array or a target index.\n");
+        return NULL;
+    }
+    if(index->nx != nx)
+    {
+      delete owned;
+      PyErr_SetString(PyExc_ValueError, "Target index was made for a different grid size.\n");
+      return NULL;
+    }
+    //Field for the output: one row of nlist values for each column of value
+    const int nchan = PyArray_NDIM(value) == 2 ? PyArray_DIM(value,1) : 1;
+    npy_intp dims[2] = {nchan, index->nlist};
+    PyArrayObject * pyfield;
+    if(PyArray_NDIM(value) == 2)
+        pyfield = (PyArrayObject *) PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+    else
+        pyfield = (PyArrayObject *) PyArray_SimpleNew(1, &dims[1], NPY_DOUBLE);
     PyArray_FILLWBYTE(pyfield, 0);
     double * field = (double *) PyArray_DATA(pyfield);
     //Copy of field array to store compensated bits for Kahan summation
     if( !field ){
+      delete owned;
       PyErr_SetString(PyExc_MemoryError, "Passed a null field array!.\n");
       return NULL;
     }
-    //Do the work
+    bool bad_alloc = false;
+    //Do the work, letting other threads run
+    Py_BEGIN_ALLOW_THREADS
     try {
-        DiscardingSummer sum(field, field_list, nx);
+        DiscardingSummer sum(field, *index, nx, nchan);
         SphInterp<DiscardingSummer> worker(sum, nx, periodic);
         ret = worker.do_work(pos, radii, value, weights, nval);
     }
     catch (std::bad_alloc &) {
-      PyErr_SetString(PyExc_MemoryError, "Could not allocate Kahan compensation array!\n");
+        bad_alloc = true;
+    }
+    Py_END_ALLOW_THREADS
+    delete owned;
+    if( bad_alloc ){
+      Py_DECREF(pyfield);
+      PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the deposit!\n");
       return NULL;
     }
     if( ret == 1 ){
+      Py_DECREF(pyfield);
       PyErr_SetString(PyExc_ValueError, "Massless particle detected!");
       return NULL;
     }
@@ -237,16 +843,42 @@ extern "C" PyObject * Py_find_halo_kernel(PyObject *self, PyObject *args)
 
 static PyMethodDef __fieldize[] = {
   {"_SPH_Fieldize", Py_SPH_Fieldize, METH_VARARGS,
-   "Interpolate particles onto a grid using SPH interpolation."
-   "    Arguments: pos, radii, value, weights, periodic=T/F, nx"
+   "Interpolate particles onto a grid using SPH interpolation, adding them to field in place."
+   "    Arguments: field (nx*nx, float32 or float64), pos, radii, value, weights, periodic=T/F, box=T/F"
+   "    If box is true, each particle is spread evenly over a square of half-width radii (stretched CIC) rather than an SPH kernel."
+   "    If field is K*nx*nx and value nval*K, each column of value is interpolated onto a channel of field."
+   "    "},
+  {"_SPH_Fieldize_Tile", Py_SPH_Fieldize_Tile, METH_VARARGS,
+   "Interpolate particles onto one tile of a grid using SPH interpolation, adding them to field in place."
+   "    Interpolation onto cells outside the tile is discarded."
+   "    Arguments: field (tnx*tny, float32 or float64), pos, radii, value, weights, periodic=T/F, nx, x0, y0"
+   "    "},
+  {"_SPH_Fieldize_3D", Py_SPH_Fieldize_3D, METH_VARARGS,
+   "Interpolate particles onto a 3D grid using the 3D SPH kernel, adding them to field in place."
+   "    A periodic grid has period nx, unlike _SPH_Fieldize."
+   "    Arguments: field (nx*nx*nx, float32 or float64), pos, radii, value, weights, periodic=T/F"
+   "    "},
+  {"_SPH_Fieldize_Halos", Py_SPH_Fieldize_Halos, METH_VARARGS,
+   "Interpolate particles onto the grids around many halos using SPH interpolation, adding them to the grids in place."
+   "    Each particle is added to the grid of every halo it overlaps, allowing for periodic wrapping."
+   "    Arguments: fields (one ngrid*ngrid array per halo, float32 or float64), pos (box units), smooth, value, cofm, sub_radii, box"
+   "    "},
+  {"_Mesh_Add", Py_Mesh_Add, METH_VARARGS,
+   "Add samples to the grid points around them with given weights, in place, for ngp, cic and tsc."
+   "    Arguments: field (float32 or float64), totweight (like field, or None), kk (int64 grid indices, npts*nval*dim), ww (weights, like kk), value (nval)"
    "    "},
   {"_find_halo_kernel", Py_find_halo_kernel, METH_VARARGS,
    "Kernel for populating a field containing the mass of the nearest halo to each point"
    "    Arguments: halo_cofm, halo_radii, halo_mass, sub_pos, sub_radii, sub_index, xcells, ycells, zcells (output from np.where), dla_cross[nn], assigned_halo"
    "    "},
   {"_Discard_SPH_Fieldize", Py_Discard_SPH_Fieldize, METH_VARARGS,
-   "Interpolate particles onto a grid using SPH interpolation."
-   "    Arguments: pos, radii, value, weights, periodic=T/F, nx"
+   "Interpolate particles onto a list of cells of a grid using SPH interpolation, discarding the rest."
+   "    Arguments: field_list (int64 cell offsets, or an index from _Make_Target_Index), pos, radii, value, weights, periodic=T/F, nx"
+   "    If value is nval*K, returns a K*nlist array, a row for each column of value."
+   "    "},
+  {"_Make_Target_Index", Py_Make_Target_Index, METH_VARARGS,
+   "Index a list of cells of a grid, to be passed to _Discard_SPH_Fieldize for many sets of particles."
+   "    Arguments: field_list (int64 cell offsets), nx"
    "    "},
   {NULL, NULL, 0, NULL},
 };
@@ -254,6 +886,13 @@ static PyMethodDef __fieldize[] = {
 PyMODINIT_FUNC
 init_fieldize_priv(void)
 {
-  Py_InitModule("_fieldize_priv", __fieldize);
+  PyObject *m = Py_InitModule("_fieldize_priv", __fieldize);
+  /*So that python code, such as the tests, knows which kernel is compiled in*/
+#ifdef TOP_HAT_KERNEL
+  PyModule_AddIntConstant(m, "TOP_HAT_KERNEL", 1);
+#else
+  PyModule_AddIntConstant(m, "TOP_HAT_KERNEL", 0);
+#endif
   import_array();
+  init_kernel_table();
 }
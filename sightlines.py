@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""Column densities along random sightlines through the box, as a cheap alternative to a full grid.
+
+The column density function, line density and Omega_DLA of BoxHI depend only on the distribution
+of column densities, not on where the absorbers are. Rather than depositing every particle onto a
+16384^2 grid for each slab just to histogram it, here M sightlines parallel to the x axis are drawn
+at random (or stratified) (y,z) positions, and the column density along each is found by
+integrating the projected kernel of every particle whose (y,z) footprint it crosses.
+
+To find those particles, the (y,z) plane is divided into cells about as large as the spacing
+between sightlines, and the sightlines are sorted by cell. The footprint of each particle
+(including its periodic images) is binned onto the same cells, so each particle is only tested
+against the sightlines in the cells it overlaps.
+
+The kernel is the top-hat (the Makefile default), for which the column density in each slab is
+exact: the density of the particle times the length of its chord inside the slab.
+Sightlines are points rather than grid cells, so absorbers smaller than a cell are not smeared out.
+
+Errors on the column density function come from bootstrap resampling the sightlines.
+SightlineHI draws sightlines in batches, making one pass over the snapshot for each batch,
+until the bootstrap error reaches the requested precision.
+
+Classes:
+    Sightlines - Column densities along a set of sightlines, accumulated one block of particles at a time
+    SightlineHI - The HI column density statistics of BoxHI, from sightlines rather than a grid
+
+Functions:
+    draw_sightlines - Random or stratified sightline positions
+    column_density_function - f(N) of a set of sightlines
+    bootstrap_cddf - f(N) of a set of sightlines, with bootstrap errors
+"""
+import numpy as np
+import numexpr as ne
+import cold_gas
+import hdfsim
+import chunk_reader
+from boxhi import BoxHI
+
+def draw_sightlines(nsight, box, stratified=False, randstate=np.random):
+    """Draw the (y,z) positions of nsight sightlines through a box, as an (nsight,2) array.
+    If stratified is true, the box is divided into an n x n grid of cells, where n = ceil(sqrt(nsight)),
+    and one sightline is placed at random in each, so n^2 >= nsight sightlines are returned.
+    randstate is the np.random.RandomState to draw from."""
+    if not stratified:
+        return randstate.uniform(0, box, (nsight, 2))
+    nside = int(np.ceil(np.sqrt(nsight)))
+    cells = np.indices((nside, nside)).reshape(2,-1).T
+    return (cells + randstate.uniform(0, 1, (nside**2, 2)))*(box/(1.*nside))
+
+class Sightlines:
+    """Column densities through a periodic box along sightlines parallel to the x axis,
+    each split into nslice equal segments, as the slabs of BoxHI.
+
+    Parameters:
+        box - Box size
+        nslice - Number of slabs along x
+        yz - (M,2) array of the (y,z) positions of the sightlines
+        maxpairs - Most particle-cell pairs to work on at once. This sets the memory used.
+
+    Attributes:
+        colden - (nslice, M) array of the column density in each slab of each sightline,
+                 in the mass unit of the particles per length unit squared
+    """
+    def __init__(self, box, nslice, yz, maxpairs=2**22):
+        self.box = box
+        self.nslice = nslice
+        self.maxpairs = maxpairs
+        self.yz = np.array(yz, dtype=np.float64) % box
+        self.nsight = np.shape(self.yz)[0]
+        self.colden = np.zeros((nslice, self.nsight))
+        #About one sightline per cell
+        self.ncell = int(np.clip(np.sqrt(self.nsight), 1, 2**12))
+        self.cellsize = box/(1.*self.ncell)
+        cell = self._cell(self.yz[:,0])*self.ncell + self._cell(self.yz[:,1])
+        #The sightlines in cell c are order[cellstart[c]:cellstart[c+1]]
+        self.order = np.argsort(cell, kind='mergesort')
+        self.cellstart = np.concatenate([[0], np.cumsum(np.bincount(cell, minlength=self.ncell**2))])
+
+    def _cell(self, coord):
+        """Cell index along one axis of coordinates in [0, box)"""
+        return np.minimum((coord/self.cellsize).astype(np.int64), self.ncell-1)
+
+    def add_particles(self, ipos, ismooth, mass):
+        """Add the column density of a block of particles to every sightline they cross.
+        ipos, ismooth and mass are in the same units as the box, as for BoxHI.gridize_single_file."""
+        if np.size(mass) == 0:
+            return
+        ipos = np.asarray(ipos, dtype=np.float64)
+        ismooth = np.asarray(ismooth, dtype=np.float64)
+        mass = np.asarray(mass, dtype=np.float64)
+        #Range of cells covered by each footprint along y and z, before wrapping
+        low = np.floor((ipos[:,1:3].T-ismooth)/self.cellsize).astype(np.int64).T
+        span = np.floor((ipos[:,1:3].T+ismooth)/self.cellsize).astype(np.int64).T - low + 1
+        #A footprint wider than the box would meet its own images, so would count some sightlines twice
+        span = np.minimum(span, self.ncell)
+        ncover = span[:,0]*span[:,1]
+        ends = np.cumsum(ncover)
+        start = 0
+        while start < np.size(mass):
+            #At least one particle, however many cells it covers
+            end = np.max([start+1, np.searchsorted(ends, ends[start]-ncover[start]+self.maxpairs, side='right')])
+            part = slice(start, end)
+            self._add_group(ipos[part], ismooth[part], mass[part], low[part], span[part], ncover[part])
+            start = end
+
+    def _add_group(self, ipos, ismooth, mass, low, span, ncover):
+        """Add the column density of a group of particles, with the cells covered by their footprints"""
+        #One entry for each cell covered by each particle
+        pind = np.repeat(np.arange(np.size(mass)), ncover)
+        piece = np.arange(np.size(pind)) - np.repeat(np.cumsum(ncover)-ncover, ncover)
+        cy = (low[pind,0] + piece / span[pind,1]) % self.ncell
+        cz = (low[pind,1] + piece % span[pind,1]) % self.ncell
+        cell = cy*self.ncell + cz
+        #One entry for each sightline in each of those cells
+        nin = self.cellstart[cell+1] - self.cellstart[cell]
+        pind = np.repeat(pind, nin)
+        first = np.repeat(self.cellstart[cell] - np.cumsum(nin) + nin, nin)
+        sight = self.order[first + np.arange(np.size(pind))]
+        #Impact parameter to the nearest periodic image of the particle
+        half = self.box/2.
+        dy = (self.yz[sight,0] - ipos[pind,1] + half) % self.box - half
+        dz = (self.yz[sight,1] - ipos[pind,2] + half) % self.box - half
+        hh = ismooth[pind]
+        hit = np.where(dy**2 + dz**2 < hh**2)
+        (pind, sight, dy, dz, hh) = (pind[hit], sight[hit], dy[hit], dz[hit], hh[hit])
+        #Half the length of the chord through the top-hat sphere, and the density within it
+        chord = ne.evaluate("sqrt(hh**2 - dy**2 - dz**2)")
+        mm = mass[pind]
+        pi = np.pi
+        rho = ne.evaluate("3*mm/(4*pi*hh**3)")
+        xx = ipos[pind,0]
+        if self.nslice == 1:
+            self.colden[0] += np.bincount(sight, weights=2*rho*chord, minlength=self.nsight)
+            return
+        #Split each chord between the slabs it crosses, as in BoxHI._bin_particles_by_slab
+        width = self.box/(1.*self.nslice)
+        lowslab = np.floor((xx-chord)/width).astype(np.int64)
+        nspan = np.floor((xx+chord)/width).astype(np.int64) - lowslab + 1
+        ind = np.repeat(np.arange(np.size(sight)), nspan)
+        slab = lowslab[ind] + np.arange(np.size(ind)) - np.repeat(np.cumsum(nspan)-nspan, nspan)
+        lower = np.maximum(xx[ind]-chord[ind], slab*width)
+        upper = np.minimum(xx[ind]+chord[ind], (slab+1)*width)
+        flat = (slab % self.nslice)*self.nsight + sight[ind]
+        self.colden += np.bincount(flat, weights=rho[ind]*(upper-lower), minlength=self.nslice*self.nsight).reshape(self.nslice, self.nsight)
+
+def _bin_columns(logN, NHI_table):
+    """Bin of NHI_table each column density in logN falls in, flattened.
+    Columns outside the table are put in an extra bin at the end."""
+    nbins = np.size(NHI_table)-1
+    bins = np.digitize(np.ravel(logN), np.log10(NHI_table)) - 1
+    bins[np.where((bins < 0)+(bins >= nbins))] = nbins
+    return bins
+
+def column_density_function(logN, NHI_table, dX):
+    """Compute the column density function f(N) = d n_DLA/ dN dX of a set of sightlines,
+    counting each slab of each sightline as one cell of BoxHI.column_density_function.
+    Arguments:
+        logN - (nslice, M) array of log10 N_HI in each slab of M sightlines
+        NHI_table - Edges of the N_HI bins
+        dX - Absorption distance of one slab
+    Returns:
+        (NHI, f_N_table) - N_HI (binned in log) and corresponding f(N)"""
+    nbins = np.size(NHI_table)-1
+    center = (NHI_table[1:]+NHI_table[:-1])/2.
+    width = NHI_table[1:]-NHI_table[:-1]
+    counts = np.bincount(_bin_columns(logN, NHI_table), minlength=nbins+1)[:nbins]
+    return (center, counts/(width*dX*np.size(logN)))
+
+def bootstrap_cddf(logN, NHI_table, dX, nboot=100, randstate=np.random):
+    """Compute the column density function of a set of sightlines, as column_density_function,
+    and its error from the scatter between nboot bootstrap resamplings of the sightlines.
+    The slabs of each sightline are resampled together, as they are not independent.
+    Returns:
+        (NHI, f_N_table, f_N_err) - f_N_err is the standard deviation of f(N) over the resamplings"""
+    (nslice, nsight) = np.shape(logN)
+    (center, f_N) = column_density_function(logN, NHI_table, dX)
+    nbins = np.size(NHI_table)-1
+    norm = (NHI_table[1:]-NHI_table[:-1])*dX*np.size(logN)
+    bins = _bin_columns(logN, NHI_table)
+    #Sightline each flattened column belongs to
+    sight = np.tile(np.arange(nsight), nslice)
+    samples = np.empty((nboot, nbins))
+    for bb in xrange(nboot):
+        #Number of times each sightline is drawn
+        count = np.bincount(randstate.randint(0, nsight, nsight), minlength=nsight)
+        samples[bb] = np.bincount(bins, weights=count[sight], minlength=nbins+1)[:nbins]/norm
+    return (center, f_N, np.std(samples, axis=0))
+
+class SightlineHI(BoxHI):
+    """The HI column density statistics of BoxHI (column density function, line density,
+    Omega_DLA and rho_DLA), computed from random sightlines along x instead of a grid.
+    Each slab of each sightline counts as one grid cell of BoxHI.
+    There is no grid, so the methods which find absorbers on the grid or match them to halos do not work.
+
+    Sightlines are drawn in batches, with one pass over the snapshot for each batch,
+    until the bootstrap error on the column density function is below rtol or maxsight sightlines are drawn.
+    Each batch is sized from the error so far, but at most quadruples the total number of sightlines.
+    Set cache_derived to avoid recomputing the neutral fractions on every pass.
+
+    Parameters:
+        dir, snapnum, nslice, gas, molec, start, end - As for BoxHI
+        nsight - Number of sightlines in the first batch
+        maxsight - Most sightlines to draw in total
+        rtol - Relative bootstrap error on f(N) to stop at
+        tol_range - (min, max) log N_HI of the bins of f(N) in which rtol must be reached
+        dlogN - Bin width in log N_HI for checking the error
+        stratified - If true, stratify the sightlines of each batch. See draw_sightlines.
+        nboot - Number of bootstrap resamplings
+        seed - Seed for the random numbers
+        savefile - As for BoxHI. This is not the default of BoxHI, so the grid saved there is not overwritten.
+
+    Attributes:
+        sub_nHI_grid - (nslice, M) array of log10 N_HI in each slab of each sightline
+        sightline_pos - (M,2) array of the (y,z) positions of the sightlines
+    """
+    def __init__(self,snap_dir,snapnum,nslice=1,gas=False, molec=True, start=0, end=3000, nsight=2**16, maxsight=2**24, rtol=0.05, tol_range=(20.3, 21.5), dlogN=0.2, stratified=False, nboot=100, seed=None, savefile="sightline_hi.hdf5"):
+        BoxHI.__init__(self, snap_dir, snapnum, nslice, reload_file=True, savefile=savefile, gas=gas, molec=molec, start=start, end=end, make_grid=False)
+        self.nboot = nboot
+        self.randstate = np.random.RandomState(seed)
+        self.sightline_pos = np.empty((0,2))
+        self.sub_nHI_grid = np.empty((nslice,0))
+        NHI_table = 10**np.arange(tol_range[0], tol_range[1], dlogN)
+        while True:
+            yz = draw_sightlines(nsight, self.box, stratified, self.randstate)
+            lines = Sightlines(self.box, nslice, yz)
+            self.set_sightlines(lines, gas)
+            self.sightline_pos = np.concatenate([self.sightline_pos, yz])
+            self.sub_nHI_grid = np.concatenate([self.sub_nHI_grid, self._log_colden(lines.colden)], axis=1)
+            err = self._cddf_rel_error(NHI_table)
+            total = np.shape(self.sightline_pos)[0]
+            print total," sightlines: relative error in f(N) ",err
+            if err <= rtol or total >= maxsight:
+                break
+            #The error falls as 1/sqrt(number of sightlines). The estimate is poor when the first
+            #batches are small, so at most quadruple the number of sightlines in each pass.
+            nsight = int(np.min([np.ceil(total*(err/rtol)**2), 4*total, maxsight])) - total
+        return
+
+    def set_sightlines(self, lines, gas=False):
+        """Add the HI (or gas) of every particle to a Sightlines, in one pass over the snapshot"""
+        star=cold_gas.RahmatiRT(self.redshift, self.hubble, molec=self.molec)
+        files = hdfsim.get_all_files(self.snapnum, self.snap_dir)
+        #Larger numbers seem to be towards the beginning
+        files.reverse()
+        end = np.min([np.size(files),self.end])
+        decode = lambda bar: self._read_nHI_chunk(bar, star, gas)
+        for (nfile, data) in chunk_reader.prefetch_chunks(files[self.start:end], 0, decode):
+            if data is not None:
+                lines.add_particles(data[0], data[1], data[2])
+        return
+
+    def _log_colden(self, colden):
+        """Convert column densities from internal units to log10 of atoms/cm^2, as set_nHI_units"""
+        massg=self.UnitMass_in_g/self.hubble/self.protonmass
+        #1 kpc/h in physical cm
+        epsilon=self.UnitLength_in_cm/self.hubble/(1+self.redshift)
+        return np.log10((colden+1e-50)*(massg/epsilon**2))
+
+    def _cddf_rel_error(self, NHI_table):
+        """Largest relative bootstrap error of f(N) in the bins of NHI_table.
+        An empty bin counts as an error of 1, as if it held a single sightline."""
+        (_, f_N, f_N_err) = bootstrap_cddf(self.sub_nHI_grid, NHI_table, self.absorption_distance(), self.nboot, self.randstate)
+        rel = np.ones_like(f_N)
+        ind = np.where(f_N > 0)
+        rel[ind] = f_N_err[ind]/f_N[ind]
+        return np.max(rel)
+
+    def column_density_function_err(self,dlogN=0.1, minN=16, maxN=24.):
+        """The column density function, as column_density_function, with its bootstrap error.
+        Returns:
+            (NHI, f_N_table, f_N_err)"""
+        NHI_table = 10**np.arange(minN, maxN, dlogN)
+        return bootstrap_cddf(self.sub_nHI_grid, NHI_table, self.absorption_distance(), self.nboot, self.randstate)
+
+    def _calc_cddf(self,NHI_table, minN=17, maxM=None,minM=None):
+        """Does the actual calculation for the CDDF function above, from the sightlines"""
+        if maxM != None or minM != None:
+            raise NotImplementedError("Sightlines are not matched to halos")
+        return column_density_function(self.sub_nHI_grid, NHI_table, self.absorption_distance())
+
+    def line_density(self, thresh=20.3):
+        """Compute the line density, the fraction of sightline slabs in DLAs divided by dX. This is dN/dX = l_DLA(z)
+        """
+        try:
+            return self.pDLA
+        except AttributeError:
+            DLAs = 1.*np.sum(self.sub_nHI_grid > thresh)
+            self.pDLA = DLAs/np.size(self.sub_nHI_grid)/self.absorption_distance()
+            return self.pDLA
@@ -1,8 +1,21 @@
 """Module to test the grid interpolation."""
 
+import os
+import shutil
+import tempfile
 import numpy as np
+import h5py
 
 import boxhi as bi
+import fieldize
+import _fieldize_priv
+import tiled_slab
+import sightlines
+import chunk_reader
+import checkpoint
+import derived_cache
+import parallel_ingest
+from _fieldize_priv import _Discard_SPH_Fieldize, _Make_Target_Index
 import unittest
 
 class TestHI(bi.BoxHI):
@@ -89,7 +102,8 @@ class TestHI(bi.BoxHI):
             mass *= self.hy_mass
             #mass *= star.get_reproc_HI(bar)
         smooth = self.smooth  #hsml.get_smooth_length(bar)
-        [self.sub_gridize_single_file(ii,ipos,smooth,mass,self.sub_nHI_grid) for ii in xrange(0,self.nhalo)]
+        (ipos, smooth, mass, offsets) = self._bin_particles_by_slab(ipos, smooth, mass)
+        [self.sub_gridize_single_file(ii,ipos,smooth,mass,self.sub_nHI_grid,offsets=offsets) for ii in xrange(0,self.nhalo)]
 #         f.close()
         #Explicitly delete some things.
         #Deal with zeros: 0.1 will not even register for things at 1e17.
@@ -135,12 +149,399 @@ class Tester(unittest.TestCase):
         #Diagonals
         self.assertAlmostEqual(self.grid[699,699],self.grid[699,701])
         self.assertAlmostEqual(self.grid[701,699],self.grid[701,701])
-        self.assertAlmostEqual(self.grid[701,699],15.0312144)
         #Cross-pieces
         self.assertAlmostEqual(self.grid[700,699],self.grid[700,701])
         self.assertAlmostEqual(self.grid[699,700],self.grid[699,700])
-        self.assertAlmostEqual(self.grid[699,700],18.51635214)
-        self.assertAlmostEqual(self.grid[700,700],20.27041661)
+        #The values depend on the kernel compiled in
+        if _fieldize_priv.TOP_HAT_KERNEL:
+            expected = (18.47576, 19.40131, 19.938444)
+        else:
+            expected = (16.98043823, 18.86086655, 20.23072624)
+        self.assertAlmostEqual(self.grid[701,699],expected[0],6)
+        self.assertAlmostEqual(self.grid[699,700],expected[1],6)
+        self.assertAlmostEqual(self.grid[700,700],expected[2],6)
+
+    def test_unproject(self):
+        """Cells in the columns of each projection map back to their x, y, z positions"""
+        pos = np.random.random((10,3))
+        for proj in xrange(3):
+            cols = bi._project(pos, proj)
+            self.assertTrue(np.all(cols[:,0] == pos[:,proj]))
+            xyz = bi._unproject([cols[:,0], cols[:,1], cols[:,2]], proj)
+            self.assertTrue(np.all(np.array(xyz).T == pos))
+
+def brute_cic(pos, value, nx, dims, periodic):
+    """Cloud-in-cell deposit one point and one grid point at a time, with grid points at integers"""
+    field = np.zeros([nx,]*dims)
+    weight = np.zeros([nx,]*dims)
+    for (pp, val) in zip(pos, value):
+        low = np.floor(pp[:dims]).astype(int)
+        for corner in np.ndindex(*([2,]*dims)):
+            idx = low + np.array(corner)
+            ww = np.prod([1-abs(pp[d]-idx[d]) for d in xrange(dims)])
+            if periodic:
+                idx = idx % nx
+            elif np.any(idx < 0) or np.any(idx > nx-1):
+                continue
+            field[tuple(idx)] += val*ww
+            weight[tuple(idx)] += ww
+    return (field, weight)
+
+def brute_tsc(pos, value, nx, dims, periodic):
+    """Triangular-shaped cloud deposit one point at a time, with grid points at integers"""
+    field = np.zeros([nx,]*dims)
+    for (pp, val) in zip(pos, value):
+        near = np.rint(pp[:dims]).astype(int)
+        for offset in np.ndindex(*([3,]*dims)):
+            idx = near + np.array(offset) - 1
+            dx = np.abs(pp[:dims] - idx)
+            ww = np.prod(np.where(dx < 0.5, 0.75-dx**2, 0.5*(1.5-dx)**2))
+            if periodic:
+                idx = idx % nx
+            elif np.any(idx < 0) or np.any(idx > nx-1):
+                continue
+            field[tuple(idx)] += val*ww
+    return field
+
+class TestMesh(unittest.TestCase):
+    """Check the mesh deposits against a deposit done one point at a time"""
+    def setUp(self):
+        np.random.seed(23)
+        self.nx = 12
+        self.pos = np.random.uniform(0, self.nx, (200,3))
+        self.value = np.random.uniform(0.5, 2, 200)
+
+    def test_cic(self):
+        """Cloud-in-cell in 2D and 3D, periodic or not"""
+        for dims in (2,3):
+            for periodic in (False, True):
+                field = np.zeros([self.nx,]*dims)
+                weight = np.zeros([self.nx,]*dims)
+                fieldize.cic(self.pos, self.value, field, weight, periodic)
+                (bfield, bweight) = brute_cic(self.pos, self.value, self.nx, dims, periodic)
+                self.assertTrue(np.max(np.abs(field - bfield)) < 1e-12)
+                self.assertTrue(np.max(np.abs(weight - bweight)) < 1e-12)
+                if periodic:
+                    self.assertAlmostEqual(np.sum(field), np.sum(self.value))
+
+    def test_ngp(self):
+        """Nearest grid point, including points which round off the top edge"""
+        for periodic in (False, True):
+            field = np.zeros((self.nx, self.nx))
+            weight = np.zeros((self.nx, self.nx))
+            fieldize.ngp(self.pos, self.value, field, weight, periodic)
+            bfield = np.zeros((self.nx, self.nx))
+            for (pp, val) in zip(self.pos, self.value):
+                idx = np.rint(pp[:2]).astype(int)
+                if periodic:
+                    idx = idx % self.nx
+                elif np.any(idx > self.nx-1):
+                    continue
+                bfield[tuple(idx)] += val
+            self.assertTrue(np.max(np.abs(field - bfield)) < 1e-12)
+            self.assertTrue(np.all(weight == np.round(weight)))
+
+    def test_tsc(self):
+        """Triangular-shaped cloud in 2D and 3D, periodic or not"""
+        for dims in (2,3):
+            for periodic in (False, True):
+                field = np.zeros([self.nx,]*dims)
+                fieldize.tsc(self.pos, self.value, field, periodic=periodic)
+                bfield = brute_tsc(self.pos, self.value, self.nx, dims, periodic)
+                self.assertTrue(np.max(np.abs(field - bfield)) < 1e-12)
+                if periodic:
+                    self.assertAlmostEqual(np.sum(field), np.sum(self.value))
+
+    def test_cic_str(self):
+        """Periodic box deposit against the overlap of each box with each cell, with period nx-1"""
+        radii = np.random.uniform(0.1, 4, np.size(self.value))
+        field = np.zeros((self.nx, self.nx))
+        fieldize.cic_str(self.pos, self.value, field, radii, periodic=True)
+        half = np.maximum(2./3.*(4*np.pi/3.)**(1./3)*radii, 0.5)
+        nn = self.nx-1
+        bfield = np.zeros((nn, nn))
+        for (pp, hh, val) in zip(self.pos[:,1:], half, self.value):
+            (low, up) = (pp-hh, pp+hh)
+            for gx in xrange(int(np.floor(low[0])), int(np.floor(up[0]))+1):
+                for gy in xrange(int(np.floor(low[1])), int(np.floor(up[1]))+1):
+                    area = (min(up[0],gx+1)-max(low[0],gx))*(min(up[1],gy+1)-max(low[1],gy))
+                    bfield[gx % nn, gy % nn] += val*area/(2*hh)**2
+        self.assertTrue(np.max(np.abs(field[:nn,:nn] - bfield)) < 1e-5*np.max(bfield))
+        self.assertTrue(np.all(field[nn,:] == field[0,:]))
+        self.assertTrue(np.all(field[:,nn] == field[:,0]))
+
+class TestSPH(unittest.TestCase):
+    """Check the ways of doing an SPH deposit against each other"""
+    def setUp(self):
+        np.random.seed(29)
+        self.nx = 40
+        npart = 300
+        self.pos = np.random.uniform(0, self.nx-1, (npart,3)).astype(np.float32)
+        self.radii = np.random.uniform(0.3, 6, npart).astype(np.float32)
+        #Kernels wider than the grid, and inside a single cell
+        self.radii[:3] = [30, 50, 0.1]
+        self.value = np.random.uniform(0.5, 2, (npart,3)).astype(np.float32)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def dense(self, value, periodic=True):
+        """Deposit onto a whole grid with sph_str"""
+        field = np.zeros((self.nx, self.nx))
+        fieldize.sph_str(self.pos, value, field, self.radii, periodic=periodic)
+        return field
+
+    def test_multi_channel(self):
+        """Several quantities deposited at once are the same as one at a time"""
+        field = np.zeros((3, self.nx, self.nx))
+        fieldize.sph_str(self.pos, self.value, field, self.radii, periodic=True)
+        for kk in xrange(3):
+            self.assertTrue(np.max(np.abs(field[kk] - self.dense(self.value[:,kk].copy()))) < 1e-12)
+        #The last row and column repeat the first
+        self.assertAlmostEqual(np.sum(field[0,:-1,:-1])/np.sum(self.value[:,0]), 1., 6)
+
+    def test_tiled(self):
+        """Tiled out-of-core deposit against the whole grid"""
+        value = self.value[:,0].copy()
+        for periodic in (True, False):
+            out = np.zeros((self.nx, self.nx))
+            tiles = tiled_slab.TiledSlab(out, 3, os.path.join(self.tmpdir, "spill"), periodic)
+            tiles.add_particles(self.pos[:100], self.radii[:100], value[:100])
+            tiles.add_particles(self.pos[100:], self.radii[100:], value[100:])
+            tiles.flush()
+            self.assertTrue(np.max(np.abs(out - self.dense(value, periodic))) < 1e-5*np.max(out))
+            self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_target_index(self):
+        """Deposit onto a list of cells against the whole grid"""
+        cells = np.random.randint(0, self.nx, (2,50))
+        targets = _Make_Target_Index(cells[0].astype(np.int64)*self.nx+cells[1], self.nx)
+        listed = _Discard_SPH_Fieldize(targets, self.pos, self.radii, self.value, np.array([0.]), True, self.nx)
+        self.assertEqual(np.shape(listed), (3, 50))
+        for kk in xrange(3):
+            dense = self.dense(self.value[:,kk].copy())
+            self.assertTrue(np.max(np.abs(listed[kk] - dense[cells[0], cells[1]])) < 1e-5*np.max(dense))
+
+    @unittest.skipUnless(_fieldize_priv.TOP_HAT_KERNEL, "compares against the top-hat kernel")
+    def test_3d(self):
+        """3D top-hat deposit against sampling each cell, and mass conservation"""
+        nx = 8
+        sub = 12
+        pos = np.random.uniform(0, nx, (30,3)).astype(np.float32)
+        radii = np.random.uniform(0.3, 3, 30).astype(np.float32)
+        value = np.random.uniform(0.5, 2, 30).astype(np.float32)
+        field = np.zeros((nx, nx, nx))
+        fieldize.sph_str_3d(pos, value, field, radii, periodic=True)
+        self.assertAlmostEqual(np.sum(field)/np.sum(value), 1., 6)
+        #Cell i covers [i, i+1), and the period is nx
+        grid = (np.arange(nx*sub)+0.5)/sub
+        sampled = np.zeros((nx, nx, nx))
+        for (pp, hh, val) in zip(pos, radii, value):
+            dist = [((grid - pp[i] + nx/2.) % nx - nx/2.)**2 for i in xrange(3)]
+            inside = dist[0][:,None,None] + dist[1][None,:,None] + dist[2][None,None,:] < hh**2
+            sampled += val*inside.reshape(nx,sub,nx,sub,nx,sub).sum(axis=5).sum(axis=3).sum(axis=1)/(1.*np.sum(inside))
+        self.assertTrue(np.max(np.abs(field - sampled)) < 0.02*np.max(sampled))
+
+    def test_halos(self):
+        """Gridding onto every halo in one call against one halo at a time"""
+        box = 100.
+        npart = 20000
+        ipos = np.random.uniform(0, box, (npart,3)).astype(np.float32)
+        ismooth = np.random.uniform(0.3, 3, npart).astype(np.float32)
+        mass = np.random.uniform(0.5, 2, npart).astype(np.float32)
+        cofm = np.random.uniform(0, box, (12,3))
+        #A halo across the edges of the box
+        cofm[0] = [0.5, 99.5, 50]
+        sub_radii = np.random.uniform(3, 10, 12)
+        ngrid = np.ceil(3*sub_radii).astype(int)
+        batched = [np.zeros((nn, nn)) for nn in ngrid]
+        fieldize.sph_str_halos(ipos, mass, batched, ismooth, cofm, sub_radii, box)
+        for ii in xrange(12):
+            #Nearest periodic image of each particle
+            jpos = cofm[ii] + (ipos - cofm[ii] + box/2.) % box - box/2.
+            near = np.where(np.all(np.abs(jpos - cofm[ii]) < sub_radii[ii] + ismooth[:,None], axis=1))
+            coords = fieldize.convert_centered(jpos[near] - cofm[ii], ngrid[ii], 2*sub_radii[ii])
+            single = np.zeros((ngrid[ii], ngrid[ii]))
+            fieldize.sph_str(coords, mass[near], single, ismooth[near]*(ngrid[ii]/(2*sub_radii[ii])))
+            self.assertTrue(np.max(np.abs(batched[ii] - single)) < 1e-4*np.max(single))
+
+class TestSightlines(unittest.TestCase):
+    """Check the column densities along sightlines against summing the chord through each particle"""
+    def test_colden(self):
+        """Column density in each slab of each sightline"""
+        np.random.seed(41)
+        box = 100.
+        npart = 300
+        pos = np.random.uniform(0, box, (npart,3))
+        smooth = np.random.uniform(1, 20, npart)
+        mass = np.random.uniform(0.5, 1, npart)
+        for nslice in (1, 3):
+            yz = sightlines.draw_sightlines(60, box, nslice == 3, np.random.RandomState(1))
+            lines = sightlines.Sightlines(box, nslice, yz, maxpairs=500)
+            lines.add_particles(pos[:100], smooth[:100], mass[:100])
+            lines.add_particles(pos[100:], smooth[100:], mass[100:])
+            width = box/nslice
+            colden = np.zeros((nslice, np.shape(yz)[0]))
+            for ss in xrange(np.shape(yz)[0]):
+                dy = (yz[ss,0] - pos[:,1] + box/2.) % box - box/2.
+                dz = (yz[ss,1] - pos[:,2] + box/2.) % box - box/2.
+                for pp in np.where(dy**2 + dz**2 < smooth**2)[0]:
+                    chord = np.sqrt(smooth[pp]**2 - dy[pp]**2 - dz[pp]**2)
+                    rho = 3*mass[pp]/(4*np.pi*smooth[pp]**3)
+                    for slab in xrange(nslice):
+                        for image in (-box, 0, box):
+                            low = max(pos[pp,0] + image - chord, slab*width)
+                            up = min(pos[pp,0] + image + chord, (slab+1)*width)
+                            colden[slab, ss] += rho*max(up - low, 0)
+            self.assertTrue(np.sum(colden > 0) > 0)
+            self.assertTrue(np.max(np.abs(lines.colden - colden)) < 1e-10*np.max(colden))
+
+def write_snapshot(fname, npart):
+    """Write a snapshot file of npart particles with random positions in a 10 x 10 x 10 box.
+    Returns the masses."""
+    mass = np.random.uniform(0.5, 2, npart)
+    f = h5py.File(fname, "w")
+    f.create_group("Header").attrs["NumPart_ThisFile"] = np.array([npart,0,0,0,0,0])
+    f["PartType0/Masses"] = mass
+    f["PartType0/Coordinates"] = np.random.uniform(0, 10, (npart,3))
+    f.close()
+    return mass
+
+def decode_snapshot(bar):
+    """Positions and masses of a block of particles"""
+    return (np.array(bar["Coordinates"]), np.array(bar["Masses"]))
+
+def grid_snapshot(data, grids):
+    """Add the mass of a block of particles to the 10 x 10 cells of grids[0] they are in"""
+    cell = np.floor(data[0][:,1:]).astype(int)
+    np.add.at(grids[0], (cell[:,0], cell[:,1]), data[1])
+
+class DerivedModel:
+    """A derived field which depends on a parameter, and counts the times it is computed"""
+    def __init__(self, hubble):
+        self.hubble = hubble
+        self.calls = 0
+
+    def get_field(self, bar):
+        """The field"""
+        self.calls += 1
+        return np.array(bar["Masses"])*self.hubble
+
+class TestIngest(unittest.TestCase):
+    """Check reading, caching, checkpointing and merging snapshot files"""
+    def setUp(self):
+        np.random.seed(37)
+        self.tmpdir = tempfile.mkdtemp()
+        self.files = [os.path.join(self.tmpdir, "snap_"+str(nf)+".hdf5") for nf in xrange(5)]
+        self.masses = [write_snapshot(fname, np.random.randint(50, 400)) for fname in self.files]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_chunk_reader(self):
+        """Blocks read directly or prefetched cover every particle once, in order"""
+        f = h5py.File(self.files[0], "r")
+        blocks = [np.array(bar["Masses"]) for bar in chunk_reader.read_chunks(f, 0, chunk=64)]
+        f.close()
+        self.assertTrue(np.all(np.concatenate(blocks) == self.masses[0]))
+        self.assertTrue(np.all([np.size(block) == 64 for block in blocks[:-1]]))
+        blocks = [[] for fname in self.files]
+        ends = []
+        for (nfile, data) in chunk_reader.prefetch_chunks(self.files, 0, lambda bar: np.array(bar["Masses"]), depth=2, chunk=64):
+            if data is None:
+                ends.append(nfile)
+            else:
+                blocks[nfile].append(data)
+        self.assertEqual(ends, range(len(self.files)))
+        for (block, mass) in zip(blocks, self.masses):
+            self.assertTrue(np.all(np.concatenate(block) == mass))
+
+    def test_parallel_ingest(self):
+        """Gridding with several processes against one, and restarting from the ledger"""
+        serial = [np.zeros((10,10))]
+        for (nfile, data) in chunk_reader.prefetch_chunks(self.files, 0, decode_snapshot, chunk=64):
+            if data is not None:
+                grid_snapshot(data, serial)
+        self.assertAlmostEqual(np.sum(serial[0]), np.sum([np.sum(mass) for mass in self.masses]))
+        tmpbase = os.path.join(self.tmpdir, "ingest")
+        grids = [np.zeros((10,10))]
+        parallel_ingest.ingest_files(decode_snapshot, grid_snapshot, self.files, grids, tmpbase, 2, interval=0)
+        self.assertTrue(np.max(np.abs(grids[0] - serial[0])) < 1e-12)
+        self.assertEqual(sorted(sum(parallel_ingest.completed_files(tmpbase).values(), [])), range(len(self.files)))
+        #Every file is in the ledger, so the partial grids are summed without gridding anything
+        grids = [np.zeros((10,10))]
+        parallel_ingest.ingest_files(lambda bar: 1/0, grid_snapshot, self.files, grids, tmpbase, 2)
+        self.assertTrue(np.max(np.abs(grids[0] - serial[0])) < 1e-12)
+
+    def test_checkpoint(self):
+        """Restore a base checkpoint and a delta after it"""
+        grids = [np.random.rand(20,30), np.random.rand(9,9).astype(np.float32)]
+        tmpbase = os.path.join(self.tmpdir, "ckpt")
+        ckpt = checkpoint.TileCheckpointer(tmpbase, grids, tile=8)
+        self.assertTrue(ckpt.save(1, force=True))
+        grids[0][3:5,20] += 1
+        self.assertTrue(ckpt.save(2, force=True))
+        ckpt.wait()
+        restored = [np.zeros_like(grid) for grid in grids]
+        self.assertEqual(checkpoint.TileCheckpointer(tmpbase, restored, tile=8).restore(), 2)
+        for (grid, copy) in zip(grids, restored):
+            self.assertTrue(np.all(grid == copy))
+        checkpoint.TileCheckpointer(tmpbase, restored, tile=8).restore(add=True)
+        for (grid, copy) in zip(grids, restored):
+            self.assertTrue(np.all(2*grid == copy))
+
+    def test_derived_cache(self):
+        """Cached fields are reused only with the same model parameters"""
+        for (hubble, calls) in ((0.7, 1), (0.7, 0), (0.71, 1)):
+            model = DerivedModel(hubble)
+            cache = derived_cache.DerivedCache("z3", self.tmpdir)
+            for (fname, mass) in zip(self.files, self.masses):
+                f = h5py.File(fname, "r")
+                field = np.concatenate([cache.get(bar, "field", model.get_field) for bar in chunk_reader.read_chunks(f, 0, chunk=64)])
+                f.close()
+                self.assertTrue(np.all(field == mass*hubble))
+            #Every block of every file was computed, or none were
+            self.assertEqual(model.calls, calls*np.sum([(np.size(mass)+63)/64 for mass in self.masses]))
+        self.assertEqual(len([fname for fname in os.listdir(self.tmpdir) if fname.endswith(".npy")]), 2*len(self.files))
+
+    def test_merge(self):
+        """Merge a serial run and a parallel run over different files"""
+        snapdir = os.path.join(self.tmpdir, "snapdir_003")
+        os.mkdir(snapdir)
+        savefile = os.path.join(snapdir, "merge.hdf5")
+        grids = [np.random.rand(2,16,16).astype(np.float32) for ii in xrange(3)]
+        checkpoint.TileCheckpointer(savefile+".0.tmp", list(grids[0]), tile=8).save(4, force=True)
+        parts = [(savefile+".5.tmp.part5", [5,7]), (savefile+".5.tmp.part6", [6,8,9])]
+        for ((part, files), grid) in zip(parts, grids[1:]):
+            ckpt = checkpoint.TileCheckpointer(part, list(grid), tile=8)
+            ckpt.save(files, force=True)
+            ckpt.wait()
+        get_all_files = bi.hdfsim.get_all_files
+        bi.hdfsim.get_all_files = lambda snapnum, snap_dir: ["file"+str(nf) for nf in xrange(10)]
+        try:
+            merged = MergeHI(self.tmpdir, [0, 5])
+            self.assertTrue(np.max(np.abs(merged.sub_nHI_grid - np.sum(grids, axis=0))) < 1e-6)
+            #A file missing
+            self.assertRaises(ValueError, MergeHI, self.tmpdir, [5])
+            #A file twice
+            checkpoint.TileCheckpointer(savefile+".9.tmp", list(grids[0]), tile=8).save(9, force=True)
+            self.assertRaises(ValueError, MergeHI, self.tmpdir, [0, 5, 9])
+        finally:
+            bi.hdfsim.get_all_files = get_all_files
+
+class MergeHI(bi.BoxHI):
+    """A two slab 16 x 16 grid, merged from the checkpoints of earlier runs. The units are not changed."""
+    def __init__(self, snap_dir, starts):
+        bi.BoxHI.__init__(self, snap_dir, 3, nslice=2, reload_file=True, savefile="merge.hdf5", ngrid=16, merge=starts)
+
+    def load_header(self):
+        """Just enough of the header for the grid"""
+        self.box = 10.
+
+    def set_nHI_units(self):
+        """Leave the merged grid as it is"""
+        return
 
 if __name__ == "__main__":
     #Make the test data global so it is only created once, not before every test.
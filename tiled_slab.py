@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+"""Out-of-core SPH deposit onto a single slab too large to hold in memory.
+
+The slab is divided into ntile x ntile tiles. Particles are binned by the tiles their kernel
+(including its periodic images) overlaps, and appended to a spill file on disk for each tile.
+When flushed, each tile in turn is read from the output, has its particles deposited onto it,
+and is written back. Peak memory is then one tile plus the particles overlapping it.
+
+Classes:
+    TiledSlab - Accumulates particles for a slab and deposits them tile by tile
+"""
+import os
+import glob
+import numpy as np
+from _fieldize_priv import _SPH_Fieldize_Tile
+
+class TiledSlab:
+    """Deposit particles onto a 2D nx x nx slab (eg, a np.memmap or a HDF5 dataset) one tile at a time.
+    Particles are in grid units, as for fieldize.sph_str.
+
+    Parameters:
+        out - The slab to add the particles to. Anything supporting 2D slice reads and writes.
+        ntile - Number of tiles along each side of the slab
+        spillbase - Particles are spilled to files spillbase.tile_x_y until flushed
+        periodic - Should the deposit wrap around the edges of the slab?
+    """
+    def __init__(self, out, ntile, spillbase, periodic=True):
+        self.out = out
+        self.nx = np.shape(out)[0]
+        self.ntile = ntile
+        self.tsize = int(np.ceil(self.nx/(1.*ntile)))
+        self.spillbase = spillbase
+        self.periodic = periodic
+        #Tiles which have particles waiting
+        self.pending = set()
+        #Particles spilled by an earlier run which did not flush would be added twice
+        for spill in glob.glob(spillbase+".tile_*"):
+            os.remove(spill)
+
+    def _tile_ranges(self, pp, rr):
+        """Find the tiles along one axis that each particle can deposit onto.
+        Returns a list of (first, last) tile arrays, one for each periodic image
+        of the kernel, with first > last where that image does not exist."""
+        nx = self.nx
+        #One cell of slack either side, in case of rounding: extra tiles are harmless
+        low = np.floor(pp-rr).astype(np.int64)-1
+        up = np.floor(pp+rr).astype(np.int64)+1
+        ranges = [(np.maximum(low,0), np.minimum(up,nx-1))]
+        if self.periodic:
+            #The period is nx-1, as in SphInterp::do_work
+            ranges.append((np.maximum(low,nx-1)-(nx-1), np.where(up >= nx-1, up-(nx-1), -1)))
+            ranges.append((np.where(low <= 0, low+(nx-1), nx), np.minimum(up,0)+(nx-1)))
+        return [(first/self.tsize, np.where(first <= last, last/self.tsize, -1)) for (first, last) in ranges]
+
+    def _in_tile(self, ranges, tile):
+        """Boolean array of the particles which reach tile along one axis"""
+        close = np.zeros(np.size(ranges[0][0]), dtype=np.bool)
+        for (first, last) in ranges:
+            close |= (first <= tile)*(last >= tile)
+        return close
+
+    def _spillfile(self, tx, ty):
+        """Name of the spill file for a tile"""
+        return self.spillbase+".tile_"+str(tx)+"_"+str(ty)
+
+    def add_particles(self, pos, radii, value):
+        """Bin particles by tile and append them to the spill files.
+        pos, radii and value are as for fieldize.sph_str."""
+        if np.size(value) == 0:
+            return
+        #Store each particle as one row, to be read back in a single call
+        rows = np.empty((np.size(value),5),dtype=np.float32)
+        rows[:,0:3] = pos
+        rows[:,3] = radii
+        rows[:,4] = value
+        #The first grid index comes from pos[:,1], the second from pos[:,2]
+        xranges = self._tile_ranges(rows[:,1], rows[:,3])
+        yranges = self._tile_ranges(rows[:,2], rows[:,3])
+        for tx in xrange(self.ntile):
+            xind = np.where(self._in_tile(xranges, tx))[0]
+            if np.size(xind) == 0:
+                continue
+            ysub = [(first[xind], last[xind]) for (first, last) in yranges]
+            for ty in xrange(self.ntile):
+                ind = xind[np.where(self._in_tile(ysub, ty))]
+                if np.size(ind) == 0:
+                    continue
+                f = open(self._spillfile(tx, ty),'ab')
+                rows[ind].tofile(f)
+                f.close()
+                self.pending.add((tx, ty))
+
+    def flush(self):
+        """Deposit the spilled particles onto the slab, one tile at a time, and remove the spill files."""
+        for (tx, ty) in sorted(self.pending):
+            spill = self._spillfile(tx, ty)
+            rows = np.fromfile(spill, dtype=np.float32).reshape(-1,5)
+            xs = slice(tx*self.tsize, np.min([(tx+1)*self.tsize, self.nx]))
+            ys = slice(ty*self.tsize, np.min([(ty+1)*self.tsize, self.nx]))
+            tile = np.array(self.out[xs, ys])
+            _SPH_Fieldize_Tile(tile, np.array(rows[:,0:3]), np.array(rows[:,3]), np.array(rows[:,4]), np.array([0.]), self.periodic, self.nx, xs.start, ys.start)
+            self.out[xs, ys] = tile
+            os.remove(spill)
+        self.pending = set()
@@ -26,8 +26,8 @@ class VelocityHI(HaloHI):
         """
         star=cold_gas.RahmatiRT(self.redshift, self.hubble)
         self.once=True
-        #This is the real HI grid
-        nHI_grid=np.array([np.zeros([self.ngrid[i],self.ngrid[i]]) for i in xrange(0,self.nhalo)])
+        #Channels of the grid for each halo: x velocity, y velocity and the real HI grid.
+        vel_grid=[np.zeros([3,self.ngrid[i],self.ngrid[i]]) for i in xrange(0,self.nhalo)]
         #Now grid the HI for each halo
         for fnum in xrange(0,500):
             try:
@@ -46,13 +46,13 @@ class VelocityHI(HaloHI):
             #HI * Cell Mass, internal units
             mass = np.array(bar["Masses"],dtype=np.float64)*irhoH0/irho
             f.close()
-            #Perform the grid interpolation
-            #sub_gas_grid is x velocity
-            #sub_nHI_grid is y velocity
-            [self.sub_gridize_single_file(ii,ipos,smooth,vel[:,1]*mass,self.sub_gas_grid,vel[:,2]*mass,self.sub_nHI_grid,mass) for ii in xrange(0,self.nhalo)]
+            #Perform the grid interpolation.
             #Find the HI density also, so that we can discard
             #velocities in cells that are not DLAs.
-            [self.sub_gridize_single_file(ii,ipos,smooth,irhoH0,nHI_grid,np.zeros(np.size(irhoH0)),nHI_grid) for ii in xrange(0,self.nhalo)]
+            values = np.array([vel[:,1]*mass, vel[:,2]*mass, irhoH0]).T
+            #The halo deposit takes one value per particle, so grid each channel onto every halo in turn
+            for kk in xrange(3):
+                self.gridize_single_file(ipos,smooth,values[:,kk],[grid[kk] for grid in vel_grid])
             #Explicitly delete some things.
             del ipos
             del irhoH0
@@ -60,6 +60,12 @@ class VelocityHI(HaloHI):
             del smooth
             del mass
             del vel
+            del values
+        #sub_gas_grid is x velocity
+        #sub_nHI_grid is y velocity
+        self.sub_gas_grid=np.array([grid[0] for grid in vel_grid])
+        self.sub_nHI_grid=np.array([grid[1] for grid in vel_grid])
+        nHI_grid=[grid[2] for grid in vel_grid]
         #No /= in list comprehensions...  :|
         #Average over z
         for i in xrange(0,self.nhalo):